@@ -200,7 +200,7 @@
             pkgs.openssl
             pkgs.yubikey-manager
             (python.withPackages
-              (python-pkgs: with python-pkgs; [ offline-pki-editable ]))
+              (python-pkgs: with python-pkgs; [ offline-pki-editable pytest ]))
           ];
           shellHook = ''
             export OFFLINE_PKI_ROOT=$PWD
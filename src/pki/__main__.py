@@ -1,13 +1,13 @@
+import importlib
 import logging
-import logging.handlers
+import os
 import sys
+import time
+import typing
 import traceback
 import click
 from pathlib import Path
 
-from .certificate import certificate
-from .yubikey import yubikey
-
 logger = logging.getLogger("offline-pki")
 
 
@@ -30,9 +30,75 @@ class CustomFormatter(logging.Formatter):
         return f" At {relative_filename}:{relevant_frame.lineno}: {relevant_frame.line}"
 
 
-@click.group()
+class LazyGroup(click.Group):
+    """Group importing the module of a subcommand only when it is used.
+
+    Each subcommand has the same name as its module, so
+    `offline-pki yubikey info` does not pay for the imports of the
+    certificate or OCSP commands.
+    """
+
+    def __init__(self, *args, lazy_subcommands: tuple[str, ...] = (), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands
+
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted({*super().list_commands(ctx), *self.lazy_subcommands})
+
+    def get_command(
+        self, ctx: click.Context, cmd_name: str
+    ) -> typing.Optional[click.Command]:
+        if cmd_name in self.lazy_subcommands and cmd_name not in self.commands:
+            module = importlib.import_module(f".{cmd_name}", __package__)
+            self.add_command(getattr(module, cmd_name))
+        return super().get_command(ctx, cmd_name)
+
+
+@click.group(
+    cls=LazyGroup,
+    lazy_subcommands=("agent", "bench", "certificate", "ocsp", "shell", "yubikey"),
+)
 @click.option("--debug", is_flag=True, default=False)
-def cli(debug: bool) -> int:
+@click.option(
+    "--soft-keys",
+    envvar="OFFLINE_PKI_SOFT_KEYS",
+    help="Use software YubiKeys stored in this directory",
+    type=click.Path(file_okay=False, path_type=Path),
+)
+@click.option(
+    "--soft-latency",
+    envvar="OFFLINE_PKI_SOFT_LATENCY",
+    default=0.0,
+    help="Latency of each APDU for software YubiKeys (in ms)",
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    "--ledger",
+    envvar="OFFLINE_PKI_LEDGER",
+    help="Directory of the ledger of issued certificates",
+    type=click.Path(file_okay=False, path_type=Path),
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Log the time spent in YubiKey operations",
+)
+@click.option(
+    "--trace-file",
+    help="Write timing spans of YubiKey operations as Chrome trace events",
+    type=click.Path(dir_okay=False, writable=True),
+)
+@click.pass_context
+def cli(
+    ctx: click.Context,
+    debug: bool,
+    soft_keys: typing.Optional[Path],
+    soft_latency: float,
+    ledger: typing.Optional[Path],
+    profile: bool,
+    trace_file: typing.Optional[str],
+) -> int:
     """Simple offline PKI using YubiKeys as HSM.
 
     This program is a very barebone PKI for offline certificates. It requires at
@@ -48,10 +114,31 @@ def cli(debug: bool) -> int:
     ch = logging.StreamHandler()
     ch.setFormatter(CustomFormatter("%(levelname)s[%(name)s] %(message)s"))
     root.addHandler(ch)
-
-
-cli.add_command(yubikey)
-cli.add_command(certificate)
+    if soft_keys is not None:
+        logger.warning(f"Using software YubiKeys from {soft_keys}")
+        os.environ["OFFLINE_PKI_SOFT_KEYS"] = str(soft_keys)
+        os.environ["OFFLINE_PKI_SOFT_LATENCY"] = str(soft_latency)
+    if ledger is not None:
+        os.environ["OFFLINE_PKI_LEDGER"] = str(ledger)
+    if profile or trace_file:
+        from .tracing import Tracer
+
+        tracer = Tracer()
+        tracer.install()
+
+        def report():
+            tracer.uninstall()
+            tracer.record(
+                ctx.invoked_subcommand or "cli", tracer.origin, time.perf_counter()
+            )
+            if profile:
+                tracer.summary()
+            if trace_file:
+                with open(trace_file, "w") as output:
+                    tracer.write(output)
+                logger.info(f"Trace written to {trace_file}")
+
+        ctx.call_on_close(report)
 
 
 def main():
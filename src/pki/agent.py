@@ -0,0 +1,288 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import typing
+import click
+from pathlib import Path
+
+from .certificate import click_yes, confirm_signing
+from .csr import iter_csr_files
+from .yubikey import click_pin, yubikey_one, YUBIKEY
+
+logger = logging.getLogger("offline-pki.agent")
+
+
+def default_socket() -> str:
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return str(Path(runtime) / "offline-pki.sock")
+    return str(Path(click.get_app_dir("offline-pki")) / "agent.sock")
+
+
+def click_socket():
+    return click.option(
+        "--socket",
+        "socket_path",
+        default=default_socket,
+        envvar="OFFLINE_PKI_AGENT",
+        help="Path to the agent socket",
+        type=click.Path(dir_okay=False),
+    )
+
+
+class SigningAgent:
+    """Sign requests with an already opened PIV session.
+
+    The PIN should have been verified before. Any object with the same
+    `sign()` method as `PivSession` can be used, with the `Issuer` of its key.
+    Signed certificates are recorded in the ledger, if provided, and checked
+    against the policy, if provided.
+    """
+
+    def __init__(self, piv, issuer, ledger=None, policy=None):
+        self.piv = piv
+        self.issuer = issuer
+        self.ledger = ledger
+        self.policy = policy
+
+    def handle(self, request: dict) -> dict:
+        """Handle one request and return the response."""
+        command = request.get("command")
+        try:
+            if command == "sign":
+                return {"certificate": self.sign(**request.get("arguments", {}))}
+            if command == "ping":
+                return {"issuer": self.issuer.subject.rfc4514_string()}
+            raise ValueError(f"Unknown command {command}")
+        except Exception as e:
+            logger.error(f"Cannot handle {command} request: {e}")
+            return {"error": str(e) or e.__class__.__name__}
+
+    def sign(
+        self, csr: str, days: int, subject_name: typing.Optional[str] = None
+    ) -> str:
+        from . import dependencies as d
+        from .certificate import certificate_builder, merge_subject
+        from .csr import verify_csr
+        from .signing import sign_certificate_builder
+
+        request = d.x509.load_pem_x509_csr(csr.encode("ascii"))
+        verify_csr(request)
+        if not subject_name:
+            subject = request.subject
+        else:
+            subject = merge_subject(
+                self.issuer.subject, d.x509.Name.from_rfc4514_string(subject_name)
+            )
+        logger.info(f"Sign certificate for {subject.rfc4514_string()}")
+        if self.policy is not None:
+            self.policy.check(subject, request.extensions)
+        cert = certificate_builder(
+            request,
+            subject,
+            self.issuer.subject,
+            days,
+            self.issuer.authority_key_identifier,
+        )
+        signed_cert = sign_certificate_builder(
+            self.piv,
+            cert,
+            key_type=self.issuer.key_type,
+            public_key=self.issuer.public_key,
+        )
+        if self.ledger is not None:
+            # The certificate is only returned once recorded in the ledger
+            self.ledger.record(signed_cert, request)
+            self.ledger.flush()
+        return signed_cert.public_bytes(encoding=d.serialization.Encoding.PEM).decode(
+            "ascii"
+        )
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """Handle JSON requests, one per line, on a connection."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {"error": "invalid request"}
+            else:
+                if request.get("command") == "stop":
+                    self.server.stopping = True
+                    response = {}
+                else:
+                    response = self.server.agent.handle(request)
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+            if self.server.stopping:
+                return
+
+
+class AgentServer(socketserver.UnixStreamServer):
+    """Serve requests for a signing agent, one connection at a time."""
+
+    def __init__(self, path: str, agent: SigningAgent):
+        self.agent = agent
+        self.stopping = False
+        if os.path.exists(path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(path)
+                except OSError:
+                    # Left over by an agent which did not stop cleanly
+                    os.unlink(path)
+                else:
+                    raise RuntimeError(f"An agent is already running on {path}")
+        umask = os.umask(0o077)
+        try:
+            super().__init__(path, AgentHandler)
+        finally:
+            os.umask(umask)
+
+    def serve_until_stopped(self) -> None:
+        try:
+            while not self.stopping:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.unlink(self.server_address)
+
+
+class AgentClient:
+    """Send requests to a running agent."""
+
+    def __init__(self, path: str):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(path)
+        except OSError as e:
+            raise RuntimeError(f"Cannot connect to agent at {path}: {e}")
+        self.file = self.socket.makefile("rwb")
+
+    def request(self, command: str, **arguments) -> dict:
+        request = {"command": command, "arguments": arguments}
+        self.file.write(json.dumps(request).encode("utf-8") + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise RuntimeError("Agent closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"Agent error: {response['error']}")
+        return response
+
+    def close(self) -> None:
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@click.group()
+def agent() -> None:
+    """Signing agent keeping a YubiKey session open."""
+
+
+@agent.command("start")
+@click.option(
+    "--role",
+    type=click.Choice(["intermediate", "root"]),
+    default="intermediate",
+    help="YubiKey to keep open",
+)
+@click_pin("YubiKey")
+@click_socket()
+def agent_start(role: str, pin: str, socket_path: str) -> None:
+    """Keep a YubiKey session open and sign requests from a local socket.
+
+    The PIN is verified once. Requests are signed without confirmation until
+    the agent is stopped.
+    """
+    from . import dependencies as d
+    from .cache import get_issuer
+    from .ledger import Ledger
+    from .policy import Policy, load_policy
+
+    yk = YUBIKEY.ROOT if role == "root" else YUBIKEY.INTERMEDIATE
+    with yubikey_one(yk).open_connection(d.SmartCardConnection) as conn:
+        piv = d.PivSession(conn)
+        issuer = get_issuer(piv)
+        if issuer.self_signed != (yk == YUBIKEY.ROOT):
+            raise RuntimeError(f'The inserted key does not look like "{yk}"!')
+        if yk == YUBIKEY.ROOT:
+            policy = Policy([issuer.certificate])
+        else:
+            policy = load_policy(issuer)
+        piv.verify_pin(pin)
+        Path(socket_path).parent.mkdir(parents=True, exist_ok=True)
+        with Ledger() as ledger:
+            server = AgentServer(socket_path, SigningAgent(piv, issuer, ledger, policy))
+            logger.info(f"Agent listening on {socket_path}")
+            try:
+                server.serve_until_stopped()
+            except KeyboardInterrupt:
+                pass
+        logger.info("Agent stopped")
+
+
+@agent.command("sign")
+@click.option(
+    "--subject-name",
+    help="Subject name",
+    type=click.STRING,
+)
+@click.option(
+    "--days",
+    default=365,
+    help="Certificate validity in days",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--csr-file", help="CSR file to sign", type=click.File("rt"), default=sys.stdin
+)
+@click.option(
+    "--out-file",
+    help="Output file for signed certificates",
+    type=click.File("wt"),
+    default=sys.stdout,
+)
+@click_yes()
+@click_socket()
+def agent_sign(
+    subject_name: typing.Optional[str],
+    days: int,
+    csr_file: typing.TextIO,
+    out_file: typing.TextIO,
+    yes: bool,
+    socket_path: str,
+) -> None:
+    """Sign certificate requests with a running agent."""
+    with AgentClient(socket_path) as client:
+        issuer = client.request("ping")["issuer"]
+        confirm_signing(f"Sign these certificates with {issuer}?", yes, [csr_file])
+        for _, pem in iter_csr_files([csr_file]):
+            response = client.request(
+                "sign",
+                csr=pem.decode("ascii"),
+                days=days,
+                subject_name=subject_name,
+            )
+            out_file.write(response["certificate"])
+            out_file.flush()
+
+
+@agent.command("stop")
+@click_socket()
+def agent_stop(socket_path: str) -> None:
+    """Stop a running agent."""
+    with AgentClient(socket_path) as client:
+        client.request("stop")
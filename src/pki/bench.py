@@ -0,0 +1,527 @@
+import contextlib
+import json
+import logging
+import math
+import os
+import platform
+import tempfile
+import time
+import typing
+import click
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+logger = logging.getLogger("offline-pki.bench")
+
+
+class SoftwareSignature:
+    """Stand-in for a PIV session only able to sign with a software key.
+
+    The signature is done on the host, so only the host-side cost of each
+    signing path is measured.
+    """
+
+    def __init__(self):
+        from . import dependencies as d
+
+        self.private_key = d.ec.generate_private_key(d.ec.SECP384R1())
+
+    def sign(self, slot, key_type, message, hash_algorithm, padding=None):
+        from . import dependencies as d
+
+        if not isinstance(hash_algorithm, d.Prehashed):
+            h = d.hashes.Hash(hash_algorithm)
+            h.update(message)
+            message = h.finalize()
+            hash_algorithm = d.Prehashed(hash_algorithm)
+        return self.private_key.sign(message, d.ec.ECDSA(hash_algorithm))
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Percentile of the values, with linear interpolation."""
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class StageTimer:
+    """Record the duration of each stage over several runs."""
+
+    def __init__(self):
+        self.durations: dict[str, list[float]] = {}
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Statistics for each stage, in milliseconds."""
+        return {
+            stage: {
+                "count": len(durations),
+                "min": min(durations) * 1000,
+                "mean": sum(durations) / len(durations) * 1000,
+                "p50": percentile(durations, 50) * 1000,
+                "p95": percentile(durations, 95) * 1000,
+                "p99": percentile(durations, 99) * 1000,
+                "max": max(durations) * 1000,
+            }
+            for stage, durations in self.durations.items()
+        }
+
+
+@contextlib.contextmanager
+def soft_intermediate(latency: float) -> typing.Iterator[None]:
+    """Provide a temporary software YubiKey with an intermediate certificate."""
+    from . import dependencies as d
+    from .signing import sign_certificate_builder
+    from .softkey import SoftKey
+    from .yubikey import DEFAULT_MANAGEMENT, DEFAULT_PIN, list_devices
+
+    environ = dict(os.environ)
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp) / "intermediate"
+        directory.mkdir()
+        SoftKey.create(directory, 1)
+        os.environ["OFFLINE_PKI_SOFT_KEYS"] = tmp
+        os.environ["OFFLINE_PKI_SOFT_LATENCY"] = str(latency)
+        os.environ["OFFLINE_PKI_CACHE_DIR"] = str(Path(tmp) / "cache")
+        try:
+            ((device, _),) = list_devices()
+            with device.open_connection(d.SmartCardConnection) as conn:
+                piv = d.PivSession(conn)
+                piv.authenticate(DEFAULT_MANAGEMENT)
+                public_key = piv.generate_key(d.SLOT.SIGNATURE, d.KEY_TYPE.ECCP384)
+                piv.verify_pin(DEFAULT_PIN)
+                subject = d.x509.Name.from_rfc4514_string("CN=Benchmark")
+                cert = sign_certificate_builder(
+                    piv,
+                    d.x509.CertificateBuilder()
+                    .subject_name(subject)
+                    .issuer_name(subject)
+                    .public_key(public_key)
+                    .serial_number(d.x509.random_serial_number())
+                    .not_valid_before(datetime.now(timezone.utc))
+                    .not_valid_after(datetime.now(timezone.utc) + timedelta(days=1)),
+                )
+                piv.put_certificate(d.SLOT.SIGNATURE, cert)
+            yield
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+
+@click.group()
+def bench() -> None:
+    """Performance benchmarks."""
+
+
+@bench.command("signing")
+@click.option(
+    "--count",
+    default=100,
+    help="Number of certificates to sign",
+    type=click.IntRange(min=1),
+)
+def bench_signing(count: int) -> None:
+    """Compare certificate signing paths.
+
+    The on-token signature is replaced by a software signature, so the
+    difference is the per-certificate saving on the host.
+    """
+    from . import dependencies as d
+    from .signing import sign_certificate_builder
+
+    piv = SoftwareSignature()
+    subject = d.x509.Name.from_rfc4514_string("CN=Benchmark")
+    builder = (
+        d.x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(piv.private_key.public_key())
+        .serial_number(d.x509.random_serial_number())
+        .not_valid_before(datetime.now(timezone.utc))
+        .not_valid_after(datetime.now(timezone.utc) + timedelta(days=1))
+    )
+
+    def ykman_path():
+        d.sign_certificate_builder(
+            piv,
+            slot=d.SLOT.SIGNATURE,
+            key_type=d.KEY_TYPE.ECCP384,
+            builder=builder,
+            hash_algorithm=d.hashes.SHA384,
+        )
+
+    def native_path():
+        sign_certificate_builder(piv, builder)
+
+    results = {}
+    for name, fn in (("ykman", ykman_path), ("native", native_path)):
+        start = time.perf_counter()
+        for _ in range(count):
+            fn()
+        results[name] = (time.perf_counter() - start) / count
+        logger.info(f"{name: <8} {results[name] * 1000:8.3f} ms/certificate")
+    saving = results["ykman"] - results["native"]
+    logger.info(
+        f"Saving: {saving * 1000:.3f} ms/certificate "
+        f"({saving / results['ykman'] * 100:.1f}%)"
+    )
+
+
+@bench.command("ceremony")
+@click.option(
+    "--count",
+    default=100,
+    help="Number of certificates to sign",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--latency",
+    default=0.0,
+    help="Latency of each APDU (in ms)",
+    type=click.FloatRange(min=0),
+)
+def bench_ceremony(count: int, latency: float) -> None:
+    """Run a whole ceremony against software YubiKeys.
+
+    Software YubiKeys are created in a temporary directory, then the time
+    spent and the number of APDU exchanged are reported for YubiKey reset,
+    root and intermediate certificate creation and certificate signing.
+    """
+    from . import dependencies as d
+    from .certificate import certificate
+    from .softkey import SoftConnection, SoftKey
+    from .yubikey import yubikey
+    from click.testing import CliRunner
+
+    pin = "654321"
+    management_key = "ab" * 32
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        environ = {
+            "OFFLINE_PKI_SOFT_KEYS": str(directory / "keys"),
+            "OFFLINE_PKI_SOFT_LATENCY": str(latency),
+            "OFFLINE_PKI_CACHE_DIR": str(directory / "cache"),
+            "OFFLINE_PKI_LEDGER": str(directory / "ledger"),
+        }
+        for serial, role in enumerate(("root", "intermediate"), start=1):
+            (directory / "keys" / role).mkdir(parents=True)
+            SoftKey.create(directory / "keys" / role, serial)
+
+        logger.debug(f"Generate {count} CSR")
+        with open(directory / "bundle.csr", "wb") as bundle:
+            for nb in range(count):
+                key = d.ec.generate_private_key(d.ec.SECP256R1())
+                csr = (
+                    d.x509.CertificateSigningRequestBuilder()
+                    .subject_name(d.x509.Name.from_rfc4514_string(f"CN=host{nb}"))
+                    .sign(key, d.hashes.SHA256())
+                )
+                bundle.write(csr.public_bytes(d.serialization.Encoding.PEM))
+
+        steps = (
+            (
+                "reset",
+                yubikey,
+                [
+                    "reset",
+                    "--yes",
+                    f"--new-pin={pin}",
+                    "--new-puk=87654321",
+                    f"--new-management-key={management_key}",
+                ],
+                None,
+            ),
+            (
+                "root",
+                certificate,
+                ["root", "init", f"--management-key={management_key}"],
+                "y\nn\n",
+            ),
+            (
+                "intermediate",
+                certificate,
+                [
+                    "intermediate",
+                    f"--management-key={management_key}",
+                    f"--pin={pin}",
+                ],
+                "y\n",
+            ),
+            (
+                "sign",
+                certificate,
+                [
+                    "sign",
+                    f"--pin={pin}",
+                    f"--csr-file={directory / 'bundle.csr'}",
+                    f"--out-file={directory / 'bundle.crt'}",
+                ],
+                "y\n",
+            ),
+        )
+        runner = CliRunner(env=environ)
+        for name, command, args, input in steps:
+            apdus = SoftConnection.apdus
+            start = time.perf_counter()
+            result = runner.invoke(command, args, input=input)
+            elapsed = time.perf_counter() - start
+            if result.exit_code != 0:
+                raise RuntimeError(
+                    f"{name} failed: {result.exception or result.output}"
+                )
+            logger.info(
+                f"{name: <12} {elapsed * 1000:10.1f} ms "
+                f"{SoftConnection.apdus - apdus:6} APDU"
+            )
+        logger.info(f"{'per cert': <12} {elapsed / count * 1000:10.1f} ms")
+
+
+@bench.command("stages")
+@click.option(
+    "--count",
+    default=100,
+    help="Number of certificates to sign",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--latency",
+    default=0.0,
+    help="Latency of each APDU for the temporary software YubiKey (in ms)",
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    "--hardware",
+    is_flag=True,
+    default=False,
+    help="Use the plugged intermediate YubiKey instead of a temporary one",
+)
+@click.option("--pin", help="PIN code for the plugged YubiKey", type=click.STRING)
+@click.option(
+    "--out-file",
+    help="Output file for JSON results",
+    type=click.File("wt"),
+    default="-",
+)
+def bench_stages(
+    count: int,
+    latency: float,
+    hardware: bool,
+    pin: typing.Optional[str],
+    out_file: typing.TextIO,
+) -> None:
+    """Measure the latency of each stage of certificate signing.
+
+    Each certificate is signed from scratch, like with "certificate sign":
+    device enumeration, connection, certificate retrieval, CSR verification,
+    certificate assembly, PIN verification, signature and PEM encoding.
+    p50/p95/p99 of each stage are written as JSON, with the YubiKey and host
+    description, to compare firmware versions and hosts.
+
+    By default, a temporary software YubiKey is used. With --hardware, the
+    plugged YubiKey (or the software YubiKeys from --soft-keys) holding the
+    intermediate certificate is used instead.
+    """
+    from . import dependencies as d
+    from .cache import get_issuer
+    from .certificate import certificate_builder
+    from .csr import verify_csr
+    from .signing import sign_certificate_builder
+    from .yubikey import DEFAULT_PIN, YUBIKEY, list_devices, validate_pin
+
+    if hardware:
+        if pin is None:
+            pin = click.prompt(f"PIN code for {YUBIKEY.INTERMEDIATE}", hide_input=True)
+        validate_pin(None, None, pin)
+        backend: typing.ContextManager = contextlib.nullcontext()
+    else:
+        pin = DEFAULT_PIN
+        backend = soft_intermediate(latency)
+
+    logger.debug(f"Generate {count} CSR")
+    csrs = []
+    for nb in range(count):
+        key = d.ec.generate_private_key(d.ec.SECP256R1())
+        csr = (
+            d.x509.CertificateSigningRequestBuilder()
+            .subject_name(d.x509.Name.from_rfc4514_string(f"CN=host{nb}"))
+            .sign(key, d.hashes.SHA256())
+        )
+        csrs.append(csr.public_bytes(d.serialization.Encoding.PEM))
+
+    timer = StageTimer()
+    with backend:
+        for pem in csrs:
+            with timer("enumerate"):
+                devices = list(list_devices(YUBIKEY.INTERMEDIATE))
+            if len(devices) != 1:
+                raise RuntimeError(f"Expected one YubiKey, found {len(devices)}!")
+            device, info = devices[0]
+            with timer("open"):
+                conn = device.open_connection(d.SmartCardConnection)
+                piv = d.PivSession(conn)
+            try:
+                with timer("issuer"):
+                    issuer = get_issuer(piv)
+                with timer("csr"):
+                    csr = d.x509.load_pem_x509_csr(pem)
+                    verify_csr(csr)
+                with timer("builder"):
+                    builder = certificate_builder(
+                        csr,
+                        csr.subject,
+                        issuer.subject,
+                        365,
+                        issuer.authority_key_identifier,
+                    )
+                with timer("verify_pin"):
+                    piv.verify_pin(pin)
+                with timer("sign"):
+                    cert = sign_certificate_builder(
+                        piv,
+                        builder,
+                        key_type=issuer.key_type,
+                        public_key=issuer.public_key,
+                    )
+                with timer("pem"):
+                    cert.public_bytes(encoding=d.serialization.Encoding.PEM)
+            finally:
+                with timer("close"):
+                    conn.close()
+
+    summary = timer.summary()
+    for stage, stats in summary.items():
+        logger.info(
+            f"{stage: <16} p50 {stats['p50']:9.3f} ms  "
+            f"p95 {stats['p95']:9.3f} ms  p99 {stats['p99']:9.3f} ms"
+        )
+    results = {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "count": count,
+        "yubikey": {
+            "software": bool(os.environ.get("OFFLINE_PKI_SOFT_KEYS")) or not hardware,
+            "serial": info.serial,
+            "version": str(info.version),
+            "form_factor": str(info.form_factor),
+            "latency": None if hardware else latency,
+        },
+        "host": {
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "system": platform.platform(),
+            "python": platform.python_version(),
+        },
+        "stages": summary,
+    }
+    json.dump(results, out_file, indent=2)
+    out_file.write("\n")
+
+
+# Modules which should only be imported by the commands using them
+HEAVY_MODULES = (
+    "cryptography",
+    "ykman",
+    "yubikit",
+    "smartcard",
+    "multiprocessing",
+    "http",
+)
+
+STARTUP_COMMANDS = (
+    "--help",
+    "yubikey --help",
+    "certificate --help",
+    "ocsp --help",
+    "agent --help",
+)
+
+
+def import_time(args: list[str]) -> tuple[float, set[str]]:
+    """Import time of a command in ms, with the imported modules.
+
+    The time is the sum of the cumulative time of the top-level imports
+    reported by `python -X importtime`.
+    """
+    import subprocess
+    import sys
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", __package__, *args],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"offline-pki {' '.join(args)} failed: {result.stderr}")
+    total = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        modules.add(name.strip())
+        # Nested imports are indented below their parent
+        if not name[1:2].isspace():
+            total += int(cumulative)
+    return total / 1000, modules
+
+
+@bench.command("startup")
+@click.option(
+    "--command",
+    "commands",
+    multiple=True,
+    default=STARTUP_COMMANDS,
+    help="Command line to measure (can be repeated)",
+)
+@click.option(
+    "--runs",
+    default=5,
+    help="Number of runs of each command, the fastest is kept",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--budget",
+    default=150.0,
+    help="Maximum import time of each command (in ms)",
+    type=click.FloatRange(min=0),
+)
+def bench_startup(commands: tuple[str, ...], runs: int, budget: float) -> None:
+    """Check the import time of commands against a budget.
+
+    Each command is run with `python -X importtime`. It fails if a command
+    takes more than the budget to import its modules, or if it imports one of
+    the heavy dependencies (cryptography, yubikit, multiprocessing, ...)
+    while only showing its help.
+    """
+    failures = []
+    for command in commands:
+        args = command.split()
+        times = []
+        for _ in range(runs):
+            elapsed, modules = import_time(args)
+            times.append(elapsed)
+        elapsed = min(times)
+        heavy = sorted(
+            {module.split(".")[0] for module in modules} & set(HEAVY_MODULES)
+        )
+        logger.info(
+            f"{command: <20} {elapsed:8.1f} ms"
+            + (f" (imports {', '.join(heavy)})" if heavy else "")
+        )
+        if elapsed > budget:
+            failures.append(f"{command} takes {elapsed:.1f} ms")
+        if heavy and "--help" in args:
+            failures.append(f"{command} imports {', '.join(heavy)}")
+    if failures:
+        raise RuntimeError(
+            f"Startup budget of {budget:.0f} ms exceeded: " + "; ".join(failures)
+        )
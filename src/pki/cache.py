@@ -0,0 +1,98 @@
+import logging
+import os
+import click
+from pathlib import Path
+
+logger = logging.getLogger("offline-pki.cache")
+
+
+def cache_dir() -> Path:
+    directory = os.environ.get("OFFLINE_PKI_CACHE_DIR")
+    if directory:
+        return Path(directory)
+    return Path(click.get_app_dir("offline-pki")) / "certificates"
+
+
+class Issuer:
+    """Certificate stored on a YubiKey, with what is needed to sign with it."""
+
+    def __init__(self, certificate, key_type):
+        from . import dependencies as d
+
+        self.certificate = certificate
+        self.key_type = key_type
+        self.public_key = certificate.public_key()
+        self.subject = certificate.subject
+        try:
+            ski = certificate.extensions.get_extension_for_class(
+                d.x509.SubjectKeyIdentifier
+            ).value
+        except d.x509.ExtensionNotFound:
+            self.authority_key_identifier = (
+                d.x509.AuthorityKeyIdentifier.from_issuer_public_key(self.public_key)
+            )
+        else:
+            self.authority_key_identifier = (
+                d.x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ski)
+            )
+
+    @property
+    def self_signed(self) -> bool:
+        return (
+            self.certificate.issuer.rfc4514_string()
+            == self.certificate.subject.rfc4514_string()
+        )
+
+
+def fingerprint(public_key) -> str:
+    from . import dependencies as d
+
+    h = d.hashes.Hash(d.hashes.SHA256())
+    h.update(
+        public_key.public_bytes(
+            d.serialization.Encoding.DER,
+            d.serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+    )
+    return h.finalize().hex()
+
+
+def get_issuer(piv, slot=None) -> Issuer:
+    """Get the certificate of a slot, using the local cache when possible.
+
+    The cache is keyed by the YubiKey serial and the fingerprint of the public
+    key in the slot, as returned by its metadata. On a hit, the certificate
+    object is not read from the YubiKey.
+    """
+    from . import dependencies as d
+
+    slot = slot or d.SLOT.SIGNATURE
+    try:
+        metadata = piv.get_slot_metadata(slot)
+        serial = piv.get_serial()
+    except d.NotSupportedError:
+        logger.debug("Slot metadata not supported, certificate not cached")
+        return Issuer(piv.get_certificate(slot), d.KEY_TYPE.ECCP384)
+
+    path = cache_dir() / f"{serial}-{slot:02x}-{fingerprint(metadata.public_key)}.pem"
+    if path.exists():
+        try:
+            certificate = d.x509.load_pem_x509_certificate(path.read_bytes())
+        except ValueError as e:
+            logger.warning(f"Ignore invalid cached certificate {path}: {e}")
+        else:
+            if certificate.public_key() == metadata.public_key:
+                logger.debug(f"Use cached certificate {path}")
+                return Issuer(certificate, metadata.key_type)
+    certificate = piv.get_certificate(slot)
+    if certificate.public_key() != metadata.public_key:
+        raise RuntimeError(f"The certificate in slot {slot} does not match its key!")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(certificate.public_bytes(d.serialization.Encoding.PEM))
+        os.replace(tmp, path)
+        logger.debug(f"Certificate cached in {path}")
+    except OSError as e:
+        logger.warning(f"Cannot cache certificate in {path}: {e}")
+    return Issuer(certificate, metadata.key_type)
@@ -1,23 +1,27 @@
 import sys
 import logging
 import click
-import warnings
 import typing
+import functools
 import ipaddress
+import itertools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 from datetime import datetime, timedelta, timezone
-from cryptography.utils import CryptographyDeprecationWarning
-from cryptography.x509.general_name import GeneralName
 
-from .yubikey import click_management_key, click_pin, yubikey_one, YUBIKEY
+from .csr import CsrVerifier, iter_csr_files
+from .yubikey import click_management_key, click_pin, forget, yubikey_one, ROLE, YUBIKEY
+
+if typing.TYPE_CHECKING:
+    from cryptography.x509.general_name import GeneralName
 
 
 logger = logging.getLogger("offline-pki.certificate")
-warnings.filterwarnings(
-    "ignore", category=CryptographyDeprecationWarning, message=".*TripleDES.*"
-)
 
 
-def validate_constraint(value: str) -> GeneralName:
+def validate_constraint(value: str) -> "GeneralName":
     """Parse a constraint string and return the appropriate GeneralName object."""
     from . import dependencies as d
 
@@ -45,7 +49,7 @@ def validate_constraint(value: str) -> GeneralName:
     raise click.BadParameter(f"Unsupported constraint type: {prefix}")
 
 
-def validate_constraints(ctx, param, values) -> typing.Optional[list[GeneralName]]:
+def validate_constraints(ctx, param, values) -> typing.Optional[list["GeneralName"]]:
     """Parse constraint strings and return GeneralName objects."""
     if not values:
         return None
@@ -57,12 +61,149 @@ def validate_constraints(ctx, param, values) -> typing.Optional[list[GeneralName
     return result
 
 
+def merge_subject(issuer, subject):
+    """Copy the attributes missing from the subject from the issuer."""
+    from . import dependencies as d
+
+    missing = [
+        attribute
+        for attribute in issuer
+        if attribute.oid not in [attr.oid for attr in subject]
+    ]
+    return d.x509.Name(missing + [attr for attr in subject])
+
+
+def validate_duration(ctx, param, value: str) -> timedelta:
+    """Parse a duration such as 30d, 12h or 2w (days by default)."""
+    units = {"h": "hours", "d": "days", "w": "weeks"}
+    unit = units.get(value[-1:].lower())
+    try:
+        return timedelta(**{unit or "days": int(value[:-1] if unit else value)})
+    except ValueError:
+        raise click.BadParameter(f"Invalid duration {value}, use 30d, 12h or 2w")
+
+
+def click_prefetch():
+    return click.option(
+        "--prefetch",
+        default=8,
+        help="Number of CSR prepared in advance while signing",
+        type=click.IntRange(min=1),
+    )
+
+
+def click_yes():
+    return click.option(
+        "--yes",
+        is_flag=True,
+        default=False,
+        help="Sign without confirmation, for CSR piped on the standard input",
+    )
+
+
+def confirm_signing(message: str, yes: bool, sources: list[typing.TextIO]) -> None:
+    """Ask the operator to confirm the signature.
+
+    When the CSR were piped on the standard input, the answer is read from the
+    terminal instead.
+    """
+    from .csr import is_stdin
+
+    if yes:
+        return
+    if not any(is_stdin(source) for source in sources) or sys.stdin.isatty():
+        click.confirm(message, abort=True)
+        return
+    try:
+        with open("/dev/tty") as tty:
+            click.echo(f"{message} [y/N]: ", nl=False, err=True)
+            answer = tty.readline().strip().lower()
+    except OSError:
+        raise click.UsageError("No terminal to confirm, use --yes to sign anyway")
+    if answer not in ("y", "yes"):
+        raise click.Abort()
+
+
+def signing_message(shown: int, count: int, issuer: str = "") -> str:
+    """Confirmation message for a batch of which only a few CSR were shown."""
+    if count == 1:
+        return f"Sign this certificate{issuer}?"
+    if count <= shown:
+        return f"Sign all these certificates{issuer}?"
+    return (
+        f"Sign all the {count} certificates requested{issuer}, "
+        f"only the first {shown} being shown?"
+    )
+
+
+def click_jobs():
+    return click.option(
+        "--jobs",
+        default=os.cpu_count() or 1,
+        help="Number of processes used to check CSR signatures",
+        type=click.IntRange(min=1),
+    )
+
+
+def certificate_builder(
+    csr,
+    subject,
+    issuer,
+    days: int,
+    authority_key_identifier=None,
+    partition=None,
+    profile=None,
+):
+    """Build a certificate from a CSR, copying over its extensions.
+
+    If provided, the authority key identifier and the CRL distribution points
+    of the CRL partition of the certificate are added, unless the CSR already
+    has them. With a profile, its compiled extensions are used instead, and
+    only the CSR extensions allowed by the profile are copied.
+    """
+    from . import dependencies as d
+
+    serial = d.x509.random_serial_number()
+    cert = (
+        d.x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(issuer)
+        .public_key(csr.public_key())
+        .serial_number(serial)
+        .not_valid_before(datetime.now(timezone.utc))
+        .not_valid_after(datetime.now(timezone.utc) + timedelta(days=days))
+    )
+    if profile is not None:
+        extensions = profile.extensions(csr.public_key(), csr.extensions)
+    else:
+        extensions = [
+            (extension.value, extension.critical) for extension in csr.extensions
+        ]
+        if authority_key_identifier is not None and not any(
+            isinstance(value, d.x509.AuthorityKeyIdentifier) for value, _ in extensions
+        ):
+            extensions.append((authority_key_identifier, False))
+    if partition is not None and not any(
+        isinstance(value, d.x509.CRLDistributionPoints) for value, _ in extensions
+    ):
+        extensions.append((partition.distribution_points(serial), False))
+    for value, critical in extensions:
+        logger.debug(f"Add extension {value}")
+        cert = cert.add_extension(value, critical)
+    return cert
+
+
 @click.group()
 def certificate() -> None:
     """Certificate management."""
 
 
-@certificate.command("root")
+@certificate.group()
+def root() -> None:
+    """Certificate Root Management."""
+
+
+@root.command("init")
 @click_management_key(YUBIKEY.ROOT)
 @click.option(
     "--subject-name", default="CN=Root CA", help="Subject name", type=click.STRING
@@ -83,19 +224,30 @@ def certificate() -> None:
 )
 @click.option(
     "--days",
-    default=365 * 20,
-    help="Root certificate validity in days",
+    help="Root certificate validity in days (root profile by default)",
     type=click.IntRange(min=1),
 )
-def certificate_root(
+@click.option(
+    "--all",
+    "all_keys",
+    is_flag=True,
+    default=False,
+    help="Store the root certificate on all plugged reset YubiKeys at once",
+)
+def root_init(
     management_key: bytes,
     subject_name: str,
-    permitted: typing.Optional[list[GeneralName]],
-    excluded: typing.Optional[list[GeneralName]],
-    days: int,
+    permitted: typing.Optional[list["GeneralName"]],
+    excluded: typing.Optional[list["GeneralName"]],
+    days: typing.Optional[int],
+    all_keys: bool,
 ) -> None:
     """Initialize a new root certificate.
 
+    With --all, the root certificate and key are stored in parallel on all
+    the plugged YubiKeys with an empty signature slot. They are then read
+    back to check that all copies are identical.
+
     When specifying constraints, the format is either:
     - DNS:example.com
     - EMAIL:example.com
@@ -103,40 +255,26 @@ def certificate_root(
     - DN:"C=FR,O=Example Corp"
     """
     from . import dependencies as d
+    from .profile import load_profile
 
+    profile = load_profile("root")
     logger.debug("Generate a new private key")
     private_key = d.ec.generate_private_key(d.ec.SECP384R1())
     subject = d.x509.Name.from_rfc4514_string(subject_name)
     logger.debug("Generate a new certificate")
     cert_builder = (
-        (
-            d.x509.CertificateBuilder()
-            .subject_name(subject)
-            .issuer_name(subject)
-            .public_key(private_key.public_key())
-            .serial_number(1)
-            .not_valid_before(datetime.now(timezone.utc))
-            .not_valid_after(datetime.now(timezone.utc) + timedelta(days=days))
-        )
-        .add_extension(
-            d.x509.BasicConstraints(ca=True, path_length=None),
-            critical=True,
-        )
-        .add_extension(
-            d.x509.KeyUsage(
-                digital_signature=True,
-                content_commitment=False,
-                key_encipherment=False,
-                data_encipherment=False,
-                key_agreement=False,
-                key_cert_sign=True,
-                crl_sign=True,
-                encipher_only=False,
-                decipher_only=False,
-            ),
-            critical=True,
+        d.x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(private_key.public_key())
+        .serial_number(1)
+        .not_valid_before(datetime.now(timezone.utc))
+        .not_valid_after(
+            datetime.now(timezone.utc) + timedelta(days=days or profile.days)
         )
     )
+    for value, critical in profile.extensions(private_key.public_key()):
+        cert_builder = cert_builder.add_extension(value, critical)
     if permitted or excluded:
         cert_builder = cert_builder.add_extension(
             d.x509.NameConstraints(
@@ -149,9 +287,21 @@ def certificate_root(
         "Certificate: %s",
         cert.public_bytes(encoding=d.serialization.Encoding.PEM).decode("utf-8"),
     )
+    if all_keys:
+        replicate_root(cert, private_key, management_key)
+        return
+    copied: list[int] = []
     while True:
-        with yubikey_one(YUBIKEY.ROOT).open_connection(d.SmartCardConnection) as conn:
+        with yubikey_one(
+            YUBIKEY.ROOT, exclude=copied, expected={ROLE.EMPTY, ROLE.ROOT}
+        ).open_connection(d.SmartCardConnection) as conn:
             piv = d.PivSession(conn)
+            copied.append(piv.get_serial())
+            click.confirm(
+                f"Store the root key on YubiKey {copied[-1]}, "
+                "replacing its signature key?",
+                abort=True,
+            )
             piv.authenticate(management_key)
             piv.put_certificate(d.SLOT.SIGNATURE, cert, compress=True)
             piv.put_key(
@@ -160,10 +310,88 @@ def certificate_root(
                 d.PIN_POLICY.ONCE,
                 d.TOUCH_POLICY.NEVER,
             )
+            forget(copied[-1])
         if not click.confirm("Copy root certificate to another YubiKey?"):
             break
 
 
+def store_root(device, cert, private_key, management_key: bytes) -> None:
+    """Store the root certificate and key on a YubiKey."""
+    from . import dependencies as d
+
+    with device.open_connection(d.SmartCardConnection) as conn:
+        piv = d.PivSession(conn)
+        piv.authenticate(management_key)
+        piv.put_certificate(d.SLOT.SIGNATURE, cert, compress=True)
+        piv.put_key(
+            d.SLOT.SIGNATURE,
+            private_key,
+            d.PIN_POLICY.ONCE,
+            d.TOUCH_POLICY.NEVER,
+        )
+
+
+def check_root(device, cert) -> None:
+    """Check the root certificate and key stored on a YubiKey."""
+    from . import dependencies as d
+
+    with device.open_connection(d.SmartCardConnection) as conn:
+        piv = d.PivSession(conn)
+        public_key = piv.get_slot_metadata(d.SLOT.SIGNATURE).public_key
+        stored = piv.get_certificate(d.SLOT.SIGNATURE)
+    if public_key != cert.public_key():
+        raise RuntimeError("The stored key does not match the root certificate")
+    if stored.fingerprint(d.hashes.SHA256()) != cert.fingerprint(d.hashes.SHA256()):
+        raise RuntimeError("The stored certificate is not the root certificate")
+
+
+def replicate_root(cert, private_key, management_key: bytes) -> None:
+    """Store the root certificate and key on all plugged reset YubiKeys."""
+    from .yubikey import classify, list_devices
+
+    devices = []
+    for device, info in list_devices(YUBIKEY.ROOT):
+        if classify(device, info) != ROLE.EMPTY:
+            logger.warning(f"[{info.serial}] Signature slot not empty, skipped")
+            continue
+        devices.append((device, info.serial))
+    if not devices:
+        raise RuntimeError("No reset YubiKey found!")
+    click.confirm(
+        f"Store the root certificate on {len(devices)} YubiKeys "
+        f"({', '.join(str(serial) for _, serial in devices)})?",
+        abort=True,
+    )
+
+    failures = []
+    with ThreadPoolExecutor(len(devices)) as executor:
+        for step, function, args in (
+            ("store", store_root, (cert, private_key, management_key)),
+            ("check", check_root, (cert,)),
+        ):
+            futures = {
+                executor.submit(function, device, *args): serial
+                for device, serial in devices
+                if serial not in failures
+            }
+            for future in as_completed(futures):
+                serial = futures[future]
+                forget(serial)
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"[{serial}] Root certificate {step} failed: {e}")
+                    failures.append(serial)
+                else:
+                    logger.info(f"[{serial}] Root certificate {step} successful!")
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} YubiKeys do not hold the root certificate: "
+            + ", ".join(str(serial) for serial in sorted(failures))
+        )
+    logger.info(f"Root certificate stored on {len(devices)} YubiKeys")
+
+
 @certificate.command("intermediate")
 @click_management_key(YUBIKEY.INTERMEDIATE)
 @click_pin(YUBIKEY.ROOT)
@@ -175,25 +403,33 @@ def certificate_root(
 )
 @click.option(
     "--days",
-    default=365 * 4,
-    help="Intermediate certificate validity in days",
+    help="Intermediate certificate validity in days (sub-ca profile by default)",
     type=click.IntRange(min=1),
 )
 def certificate_intermediate(
-    management_key: bytes, pin: str, subject_name: str, days: int
+    management_key: bytes, pin: str, subject_name: str, days: typing.Optional[int]
 ) -> None:
     """Initialize a new intermediate certificate.
 
     If the subject name is missing an attribute compared to the root certificate,
-    they are copied over.
+    they are copied over. The extensions come from the sub-ca profile.
     """
     from . import dependencies as d
+    from .cache import get_issuer
+    from .ledger import Ledger
+    from .profile import load_profile
+    from .signing import sign_certificate_builder
 
-    with yubikey_one(YUBIKEY.INTERMEDIATE).open_connection(
-        d.SmartCardConnection
-    ) as conn:
-        logger.debug("Generate private key for intermediate certificate")
+    with yubikey_one(
+        YUBIKEY.INTERMEDIATE, expected={ROLE.EMPTY, ROLE.INTERMEDIATE}
+    ).open_connection(d.SmartCardConnection) as conn:
         piv = d.PivSession(conn)
+        click.confirm(
+            f"Generate the intermediate key on YubiKey {piv.get_serial()}, "
+            "replacing its signature key?",
+            abort=True,
+        )
+        logger.debug("Generate private key for intermediate certificate")
         piv.authenticate(management_key)
         public_key = piv.generate_key(
             d.SLOT.SIGNATURE,
@@ -201,58 +437,37 @@ def certificate_intermediate(
             d.PIN_POLICY.ONCE,
             d.TOUCH_POLICY.NEVER,
         )
+        forget(piv.get_serial())
     with yubikey_one(YUBIKEY.ROOT).open_connection(d.SmartCardConnection) as conn:
         logger.debug("Create intermediate certificate")
         piv = d.PivSession(conn)
-        root = piv.get_certificate(d.SLOT.SIGNATURE)
-        if root.issuer.rfc4514_string() != root.subject.rfc4514_string():
+        root = get_issuer(piv)
+        if not root.self_signed:
             raise RuntimeError("The inserted key does not look like a root YubiKey!")
         issuer = root.subject
-        subject = d.x509.Name.from_rfc4514_string(subject_name)
-        missing = [
-            attribute
-            for attribute in issuer
-            if attribute.oid not in [attr.oid for attr in subject]
-        ]
-        subject = d.x509.Name(missing + [attr for attr in subject])
+        subject = merge_subject(issuer, d.x509.Name.from_rfc4514_string(subject_name))
         logger.debug(f"Subject name is {subject.rfc4514_string()}")
+        profile = load_profile("sub-ca", root.authority_key_identifier)
         cert = (
-            (
-                d.x509.CertificateBuilder()
-                .subject_name(subject)
-                .issuer_name(issuer)
-                .public_key(public_key)
-                .serial_number(d.x509.random_serial_number())
-                .not_valid_before(datetime.now(timezone.utc))
-                .not_valid_after(datetime.now(timezone.utc) + timedelta(days=days))
-            )
-            .add_extension(
-                d.x509.BasicConstraints(ca=True, path_length=None),
-                critical=True,
-            )
-            .add_extension(
-                d.x509.KeyUsage(
-                    digital_signature=True,
-                    content_commitment=False,
-                    key_encipherment=False,
-                    data_encipherment=False,
-                    key_agreement=False,
-                    key_cert_sign=True,
-                    crl_sign=True,
-                    encipher_only=False,
-                    decipher_only=False,
-                ),
-                critical=True,
+            d.x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(issuer)
+            .public_key(public_key)
+            .serial_number(d.x509.random_serial_number())
+            .not_valid_before(datetime.now(timezone.utc))
+            .not_valid_after(
+                datetime.now(timezone.utc) + timedelta(days=days or profile.days)
             )
         )
+        for value, critical in profile.extensions(public_key):
+            cert = cert.add_extension(value, critical)
         piv.verify_pin(pin)
-        signed_cert = d.sign_certificate_builder(
-            piv,
-            slot=d.SLOT.SIGNATURE,
-            key_type=d.KEY_TYPE.ECCP384,
-            builder=cert,
-            hash_algorithm=d.hashes.SHA384,
+        signed_cert = sign_certificate_builder(
+            piv, cert, key_type=root.key_type, public_key=root.public_key
         )
+    # Recorded before it is stored on the intermediate YubiKey
+    with Ledger() as ledger:
+        ledger.record(signed_cert)
     with yubikey_one(YUBIKEY.INTERMEDIATE).open_connection(
         d.SmartCardConnection
     ) as conn:
@@ -260,6 +475,7 @@ def certificate_intermediate(
         piv = d.PivSession(conn)
         piv.authenticate(management_key)
         piv.put_certificate(d.SLOT.SIGNATURE, signed_cert, compress=True)
+        forget(piv.get_serial())
 
 
 @certificate.command("sign")
@@ -271,12 +487,25 @@ def certificate_intermediate(
 )
 @click.option(
     "--days",
-    default=365,
-    help="Certificate validity in days",
+    help="Certificate validity in days (365, or from the profile by default)",
     type=click.IntRange(min=1),
 )
 @click.option(
-    "--csr-file", help="CSR file to sign", type=click.File("rt"), default=sys.stdin
+    "--cert-profile",
+    "profile_name",
+    help="Certificate profile, such as server, client or short-lived",
+    type=click.STRING,
+)
+@click.option(
+    "--csr-file",
+    help="CSR file to sign (can be repeated)",
+    type=click.File("rt"),
+    multiple=True,
+)
+@click.option(
+    "--csr-dir",
+    help="Directory containing CSR files to sign",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
 )
 @click.option(
     "--out-file",
@@ -284,103 +513,751 @@ def certificate_intermediate(
     type=click.File("wt"),
     default=sys.stdout,
 )
+@click.option(
+    "--out-dir",
+    help="Output directory for signed certificates",
+    type=click.Path(file_okay=False, writable=True, path_type=Path),
+)
+@click.option(
+    "--crl-url",
+    help="URL of partitioned CRL, {shard} being replaced by the partition",
+    type=click.STRING,
+)
+@click.option(
+    "--crl-shards",
+    default=1,
+    help="Number of CRL partitions, by serial range",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--root-cert",
+    help="Root certificate, for its name constraints (found in the cache otherwise)",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+)
+@click_yes()
+@click_prefetch()
+@click_jobs()
 def certificate_sign(
     pin: str,
     subject_name: str,
-    days: int,
-    csr_file: typing.TextIO,
+    days: typing.Optional[int],
+    profile_name: typing.Optional[str],
+    csr_file: tuple[typing.TextIO, ...],
+    csr_dir: typing.Optional[Path],
     out_file: typing.TextIO,
+    out_dir: typing.Optional[Path],
+    crl_url: typing.Optional[str],
+    crl_shards: int,
+    root_cert: typing.Optional[Path],
+    yes: bool,
+    prefetch: int,
+    jobs: int,
 ) -> None:
-    """Sign a certificate request with the intermediate certificate.
+    """Sign certificate requests with the intermediate certificate.
 
     If no subject name is provided, the one from the CSR is used.
+
+    Each CSR file may contain several concatenated CSR. They are parsed and
+    signed one by one, and each certificate is written as soon as it is
+    signed. Several CSR files can also be signed at once by repeating
+    --csr-file or by using --csr-dir. In this case, each certificate is
+    written to --out-dir, using the name of the CSR file with a ".crt"
+    extension. In all cases, the YubiKey is only plugged once and the PIN is
+    only verified once.
+
+    While a certificate is signed by the YubiKey, the next CSR are checked in
+    parallel and prepared in the background. Invalid CSR are reported and
+    skipped without aborting the batch.
+
+    Before signing, the subject and SAN of each certificate are checked
+    against the name constraints of the intermediate and root certificates.
+    Certificates which would violate them are reported and skipped.
+
+    With --crl-url, a CRL distribution point is added to each certificate,
+    pointing to the CRL of its partition, as generated by `certificate crl`
+    with the same --url and --shards.
+
+    With --cert-profile, the extensions come from the profile, compiled once for
+    all the CSR, and only the extensions it allows are copied from the CSR.
     """
     from . import dependencies as d
+    from .cache import get_issuer
+    from .crl import Partition
+    from .ledger import Ledger
+    from .pipeline import Pipeline
+    from .policy import PolicyError, load_policy
+    from .profile import load_profile
+    from .signing import sign_certificate_builder
 
-    logger.debug("load CSR file and check signature")
-    csr = d.x509.load_pem_x509_csr(csr_file.read().encode("ascii"))
-    public_key = csr.public_key()
-    if (
-        isinstance(public_key, d.rsa.RSAPublicKey)
-        and csr.signature_hash_algorithm is not None
-    ):
-        public_key.verify(
-            csr.signature,
-            csr.tbs_certrequest_bytes,
-            d.padding.PKCS1v15(),
-            csr.signature_hash_algorithm,
-        )
-    elif isinstance(public_key, d.ec.EllipticCurvePublicKey):
-        if csr.signature_hash_algorithm is None:
-            raise ValueError("No hash algorithm in CSR")
-        public_key.verify(
-            csr.signature,
-            csr.tbs_certrequest_bytes,
-            d.ec.ECDSA(csr.signature_hash_algorithm),
-        )
-    else:
-        raise ValueError(f"unsupported public key {public_key}")
+    partition = None
+    if crl_url is not None:
+        try:
+            partition = Partition(crl_url, crl_shards)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    sources = list(csr_file)
+    if csr_dir is not None:
+        sources += [
+            click.open_file(str(path), "rt")
+            for path in sorted(csr_dir.iterdir())
+            if path.suffix in (".csr", ".pem", ".req")
+        ]
+    if not sources:
+        sources = [click.get_text_stream("stdin")]
+    if len(sources) > 1 and out_dir is None:
+        raise click.UsageError("--out-dir is needed when signing several CSR files")
+
+    outputs = {}
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for source in sources:
+            output = out_dir / f"{Path(source.name).stem}.crt"
+            if output in outputs.values():
+                raise click.UsageError(f"Several CSR would be written to {output}")
+            outputs[source.name] = output
 
     with yubikey_one(YUBIKEY.INTERMEDIATE).open_connection(
         d.SmartCardConnection
     ) as conn:
         piv = d.PivSession(conn)
-        intermediate = piv.get_certificate(d.SLOT.SIGNATURE)
-        if (
-            intermediate.issuer.rfc4514_string()
-            == intermediate.subject.rfc4514_string()
-        ):
+        intermediate = get_issuer(piv)
+        if intermediate.self_signed:
             raise RuntimeError(
                 "The inserted key does not look like an intermediate YubiKey!"
             )
-
-        logger.debug("build certificate")
         issuer = intermediate.subject
-        if not subject_name:
-            subject = csr.subject
-        else:
-            subject = d.x509.Name.from_rfc4514_string(subject_name)
-            missing = [
-                attribute
-                for attribute in issuer
-                if attribute.oid not in [attr.oid for attr in subject]
-            ]
-            subject = d.x509.Name(missing + [attr for attr in subject])
-        logger.info(f"Subject name is {subject.rfc4514_string()}")
-        cert = (
-            d.x509.CertificateBuilder()
-            .subject_name(subject)
-            .issuer_name(issuer)
-            .public_key(public_key)
-            .serial_number(d.x509.random_serial_number())
-            .not_valid_before(datetime.now(timezone.utc))
-            .not_valid_after(datetime.now(timezone.utc) + timedelta(days=days))
+        policy = load_policy(intermediate, root_cert)
+        profile = None
+        if profile_name is not None:
+            profile = load_profile(profile_name, intermediate.authority_key_identifier)
+            days = days or profile.days
+        days = days or 365
+
+        def prepare(item):
+            name, pem = item
+            csr = d.x509.load_pem_x509_csr(pem)
+            logger.debug("build certificate")
+            if not subject_name:
+                subject = csr.subject
+            else:
+                subject = merge_subject(
+                    issuer, d.x509.Name.from_rfc4514_string(subject_name)
+                )
+            logger.info(f"Subject name is {subject.rfc4514_string()}")
+            try:
+                policy.check(subject, csr.extensions)
+            except PolicyError as e:
+                verifier.reject(name, str(e))
+                return None
+            return (
+                name,
+                csr,
+                certificate_builder(
+                    csr,
+                    subject,
+                    issuer,
+                    days,
+                    intermediate.authority_key_identifier,
+                    partition,
+                    profile,
+                ),
+            )
+
+        # Read all the CSR, to tell how many will be signed
+        items = list(iter_csr_files(sources))
+        verifier = CsrVerifier(jobs, prefetch)
+        pipeline = Pipeline(
+            prepare,
+            verifier.valid(items),
+            workers=min(prefetch, os.cpu_count() or 1),
+            # Nothing is prepared in the background until confirmation, so
+            # that only the subjects of the CSR shown are logged.
+            depth=1,
         )
-        for extension in csr.extensions:
-            logger.debug(f"Add extension {extension.value}")
-            cert = cert.add_extension(extension.value, extension.critical)
+        # Only look ahead for a second CSR to ask for confirmation.
+        pending = (item for item in pipeline if item is not None)
+        first = list(itertools.islice(pending, 2))
+        if not first:
+            verifier.check()
+            raise RuntimeError("No CSR found!")
         # TODO: it would be useful to display the certificate, but there seems
         # to be no method for that.
-        click.confirm("Sign this certificate?", abort=True)
+        confirm_signing(signing_message(len(first), len(items)), yes, sources)
+        pipeline.depth = prefetch
+
+        output = None
+
+        def write(name: str, pem: str) -> None:
+            nonlocal output
+            if not outputs:
+                out_file.write(pem)
+                out_file.flush()
+                return
+            if output is None or output.name != str(outputs[name]):
+                if output is not None:
+                    output.close()
+                output = open(outputs[name], "w")
+                logger.info(f"Signed certificates saved to {outputs[name]}")
+            output.write(pem)
+            output.flush()
 
         piv.verify_pin(pin)
-        signed_cert = d.sign_certificate_builder(
-            piv,
-            slot=d.SLOT.SIGNATURE,
-            key_type=d.KEY_TYPE.ECCP384,
-            builder=cert,
-            hash_algorithm=d.hashes.SHA384,
+        with Ledger() as ledger:
+            for name, csr, cert in itertools.chain(first, pending):
+                with pipeline.stage():
+                    signed_cert = sign_certificate_builder(
+                        piv,
+                        cert,
+                        key_type=intermediate.key_type,
+                        public_key=intermediate.public_key,
+                    )
+                pem = signed_cert.public_bytes(
+                    encoding=d.serialization.Encoding.PEM
+                ).decode("ascii")
+                # Certificates are written once recorded in the ledger
+                ledger.record(signed_cert, csr, functools.partial(write, name, pem))
+        if output is not None:
+            output.close()
+        pipeline.report("YubiKey signing")
+        verifier.check()
+
+
+@certificate.command("profiles")
+def certificate_profiles() -> None:
+    """Check and list the certificate profiles.
+
+    The built-in profiles are root, sub-ca, server, client and short-lived.
+    They can be changed, and new ones added, in the TOML file set by
+    OFFLINE_PKI_PROFILES. Each profile is written as a JSON line.
+    """
+    from .profile import load_profile, load_profiles, profiles_path
+
+    logger.debug(f"Profiles file is {profiles_path()}")
+    for name, options in load_profiles().items():
+        load_profile(name)
+        click.echo(json.dumps({"name": name, **options}, sort_keys=True))
+
+
+@certificate.command("ledger")
+@click.option("--serial", help="Serial number (hexadecimal)", type=click.STRING)
+@click.option("--subject", help="Subject name", type=click.STRING)
+def certificate_ledger(serial: typing.Optional[str], subject: typing.Optional[str]):
+    """Look up issued certificates in the ledger.
+
+    Entries are written as JSON lines. Without filter, all entries are
+    written.
+    """
+    from .ledger import Ledger
+
+    with Ledger() as ledger:
+        if serial is not None:
+            try:
+                entries = ledger.by_serial(int(serial.replace(":", ""), 16))
+            except (ValueError, OverflowError):
+                raise click.BadParameter(f"Invalid serial number: {serial}")
+        elif subject is not None:
+            entries = ledger.by_subject(subject)
+        else:
+            entries = ledger
+        for item in entries:
+            click.echo(json.dumps(item, sort_keys=True))
+
+
+@certificate.command("search")
+@click.option("--dns", multiple=True, help="DNS name covered, or *.domain")
+@click.option("--ip", multiple=True, help="IP address")
+@click.option("--email", multiple=True, help="Email address")
+@click.option("--rdn", multiple=True, help="Subject attribute, such as CN=name")
+@click.option("--spki", multiple=True, help="SHA-256 fingerprint of the public key")
+def certificate_search(
+    dns: tuple[str, ...],
+    ip: tuple[str, ...],
+    email: tuple[str, ...],
+    rdn: tuple[str, ...],
+    spki: tuple[str, ...],
+) -> None:
+    """Search issued certificates in the ledger.
+
+    Certificates matching all the criteria are written as JSON lines. A DNS
+    name matches the certificates for this name or for a wildcard covering
+    it, and *.domain matches all the certificates for names in the domain.
+    Criteria are looked up in an inverted index of the ledger.
+    """
+    from . import dependencies as d
+    from .ledger import Ledger, dns_query
+
+    queries = [dns_query(name) for name in dns]
+    for address in ip:
+        try:
+            queries.append([f"ip:{ipaddress.ip_address(address)}"])
+        except ValueError:
+            raise click.BadParameter(f"Invalid IP address: {address}")
+    queries += [[f"email:{address}"] for address in email]
+    for attribute in rdn:
+        oid, _, value = attribute.partition("=")
+        try:
+            name = d.x509.Name.from_rfc4514_string(f"{oid.strip().upper()}={value}")
+        except ValueError:
+            raise click.BadParameter(f"Invalid subject attribute: {attribute}")
+        queries += [[f"rdn:{attr.rfc4514_string()}"] for attr in name]
+    queries += [[f"spki:{fingerprint.replace(':', '')}"] for fingerprint in spki]
+    if not queries:
+        raise click.UsageError("At least one search criterion is needed")
+    with Ledger() as ledger:
+        for item in ledger.search(queries):
+            click.echo(json.dumps(item, sort_keys=True))
+
+
+@certificate.command("expiring")
+@click.option(
+    "--within",
+    default="30d",
+    help="Expiring within this duration (30d, 12h, 2w)",
+    callback=validate_duration,
+)
+@click.option(
+    "--renewed/--no-renewed",
+    default=False,
+    help="Include the certificates which were already renewed",
+)
+@click.option(
+    "--revoked/--no-revoked",
+    default=False,
+    help="Include the revoked certificates, with their revocation",
+)
+def certificate_expiring(within: timedelta, renewed: bool, revoked: bool) -> None:
+    """List the certificates of the ledger about to expire.
+
+    Entries are written as JSON lines, by expiry. They are found with the
+    expiry index of the ledger, without reading the other entries. Revoked
+    certificates are skipped, as they should not be renewed.
+    """
+    from .crl import RevocationStore
+    from .ledger import Ledger
+
+    revocations = RevocationStore().by_serial()
+    now = datetime.now(timezone.utc)
+    with Ledger() as ledger:
+        for item in ledger.expiring(now, now + within):
+            if not renewed and ledger.renewed(item):
+                continue
+            revocation = revocations.get((item["issuer"], int(item["serial"], 16)))
+            if revocation is not None:
+                if not revoked:
+                    continue
+                item = {**item, "revoked": revocation}
+            click.echo(json.dumps(item, sort_keys=True))
+
+
+def renewal_builder(cert, issuer, days: typing.Optional[int], partition=None):
+    """Build a certificate renewing another one, with a new serial number.
+
+    The subject, public key and extensions are kept, except for the authority
+    key identifier, replaced by the one of the issuer, and the CRL
+    distribution points when a CRL partition is provided. Without `days`, the
+    validity period is kept.
+    """
+    from . import dependencies as d
+
+    serial = d.x509.random_serial_number()
+    now = datetime.now(timezone.utc)
+    validity = (
+        timedelta(days=days)
+        if days is not None
+        else cert.not_valid_after_utc - cert.not_valid_before_utc
+    )
+    builder = (
+        d.x509.CertificateBuilder()
+        .subject_name(cert.subject)
+        .issuer_name(issuer.subject)
+        .public_key(cert.public_key())
+        .serial_number(serial)
+        .not_valid_before(now)
+        .not_valid_after(now + validity)
+    )
+    replaced: tuple[type, ...] = (d.x509.AuthorityKeyIdentifier,)
+    if partition is not None:
+        replaced += (d.x509.CRLDistributionPoints,)
+    for extension in cert.extensions:
+        if not isinstance(extension.value, replaced):
+            builder = builder.add_extension(extension.value, extension.critical)
+    builder = builder.add_extension(issuer.authority_key_identifier, critical=False)
+    if partition is not None:
+        builder = builder.add_extension(
+            partition.distribution_points(serial), critical=False
         )
-        out_file.write(
-            signed_cert.public_bytes(encoding=d.serialization.Encoding.PEM).decode(
-                "ascii"
+    return builder
+
+
+@certificate.command("renew")
+@click_pin(YUBIKEY.INTERMEDIATE)
+@click.option(
+    "--within",
+    default="30d",
+    help="Renew certificates expiring within this duration (30d, 12h, 2w)",
+    callback=validate_duration,
+)
+@click.option(
+    "--days",
+    help="Validity of renewed certificates in days, instead of the previous one",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--out-dir",
+    required=True,
+    help="Output directory for renewed certificates",
+    type=click.Path(file_okay=False, writable=True, path_type=Path),
+)
+@click.option(
+    "--report",
+    default="-",
+    help="Output file for the renewal report",
+    type=click.File("wt"),
+)
+@click.option(
+    "--crl-url",
+    help="URL of partitioned CRL, {shard} being replaced by the partition",
+    type=click.STRING,
+)
+@click.option(
+    "--crl-shards",
+    default=1,
+    help="Number of CRL partitions, by serial range",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--root-cert",
+    help="Root certificate, for its name constraints (found in the cache otherwise)",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+)
+def certificate_renew(
+    pin: str,
+    within: timedelta,
+    days: typing.Optional[int],
+    out_dir: Path,
+    report: typing.TextIO,
+    crl_url: typing.Optional[str],
+    crl_shards: int,
+    root_cert: typing.Optional[Path],
+) -> None:
+    """Renew the certificates issued by the intermediate key about to expire.
+
+    The certificates are taken from the ledger, and re-signed in a single
+    session with new serial numbers, keeping their subject, public key and
+    extensions. Each renewed certificate is written to --out-dir, named after
+    its serial number, and recorded in the ledger. The report has a JSON line
+    for each renewed certificate.
+
+    Revoked certificates are never renewed, as their key may be compromised.
+    As with `certificate sign`, certificates violating the name constraints
+    of the intermediate and root certificates are reported and not renewed.
+    """
+    from . import dependencies as d
+    from .cache import get_issuer
+    from .crl import Partition, RevocationStore
+    from .ledger import Ledger
+    from .policy import PolicyError, load_policy
+    from .signing import sign_certificate_builder
+
+    partition = None
+    if crl_url is not None:
+        try:
+            partition = Partition(crl_url, crl_shards)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+
+    with yubikey_one(YUBIKEY.INTERMEDIATE).open_connection(
+        d.SmartCardConnection
+    ) as conn:
+        piv = d.PivSession(conn)
+        intermediate = get_issuer(piv)
+        if intermediate.self_signed:
+            raise RuntimeError(
+                "The inserted key does not look like an intermediate YubiKey!"
             )
+        name = intermediate.subject.rfc4514_string()
+        policy = load_policy(intermediate, root_cert)
+        revoked = {
+            int(item["serial"], 16): item for item in RevocationStore().revoked(name)
+        }
+        now = datetime.now(timezone.utc)
+        rejected = []
+
+        def write(item: dict, signed_cert) -> None:
+            path = out_dir / f"{signed_cert.serial_number:x}.crt"
+            path.write_bytes(
+                signed_cert.public_bytes(encoding=d.serialization.Encoding.PEM)
+            )
+            report.write(
+                json.dumps(
+                    {
+                        "subject": item["subject"],
+                        "serial": item["serial"],
+                        "not_after": item["not_after"],
+                        "renewed_serial": f"{signed_cert.serial_number:x}",
+                        "renewed_not_after": (
+                            signed_cert.not_valid_after_utc.isoformat()
+                        ),
+                        "file": str(path),
+                    },
+                    sort_keys=True,
+                )
+                + "\n"
+            )
+            report.flush()
+
+        with Ledger() as ledger:
+            expiring = []
+            for item in ledger.expiring(now, now + within):
+                if item["issuer"] != name or ledger.renewed(item):
+                    continue
+                revocation = revoked.get(int(item["serial"], 16))
+                if revocation is not None:
+                    logger.warning(
+                        f"Skip {item['subject']} ({item['serial']}), revoked "
+                        f"({revocation['reason']})"
+                    )
+                    continue
+                cert = ledger.certificate(item)
+                try:
+                    policy.check(cert.subject, cert.extensions)
+                except PolicyError as e:
+                    logger.error(f"Skip {item['subject']} ({item['serial']}): {e}")
+                    rejected.append(item)
+                    continue
+                expiring.append((item, cert))
+            if not expiring:
+                logger.info("No certificate to renew")
+            else:
+                click.confirm(f"Renew {len(expiring)} certificates?", abort=True)
+                piv.verify_pin(pin)
+                out_dir.mkdir(parents=True, exist_ok=True)
+            for item, cert in expiring:
+                signed_cert = sign_certificate_builder(
+                    piv,
+                    renewal_builder(cert, intermediate, days, partition),
+                    key_type=intermediate.key_type,
+                    public_key=intermediate.public_key,
+                )
+                # Certificates are written once recorded in the ledger
+                ledger.record(
+                    signed_cert, recorded=functools.partial(write, item, signed_cert)
+                )
+    if expiring:
+        logger.info(f"{len(expiring)} certificates renewed in {out_dir}")
+    if rejected:
+        raise RuntimeError(
+            f"{len(rejected)} certificates not renewed, violating name constraints!"
         )
 
-@certificate.group()
 
-def root() -> None:
-    """Certificate Root Management."""
+@certificate.command("revoke")
+@click.option(
+    "--serial",
+    required=True,
+    help="Serial number (hexadecimal)",
+    type=click.STRING,
+)
+@click.option(
+    "--reason",
+    default="unspecified",
+    help="Revocation reason",
+    type=click.Choice(
+        [
+            "unspecified",
+            "keyCompromise",
+            "cACompromise",
+            "affiliationChanged",
+            "superseded",
+            "cessationOfOperation",
+            "certificateHold",
+            "privilegeWithdrawn",
+            "aACompromise",
+        ]
+    ),
+)
+@click.option(
+    "--issuer",
+    help="Issuer name, for certificates missing from the ledger",
+    type=click.STRING,
+)
+def certificate_revoke(serial: str, reason: str, issuer: typing.Optional[str]):
+    """Revoke a certificate.
+
+    The revocation is recorded in the revocation store, next to the ledger,
+    and is published by the next CRL of the issuer.
+    """
+    from . import dependencies as d
+    from .crl import RevocationStore
+    from .ledger import Ledger
+
+    try:
+        number = int(serial.replace(":", ""), 16)
+    except ValueError:
+        raise click.BadParameter(f"Invalid serial number: {serial}")
+    if issuer is None:
+        with Ledger() as ledger:
+            issuers = {item["issuer"] for item in ledger.by_serial(number)}
+        if not issuers:
+            raise RuntimeError(
+                f"Certificate {number:x} not found in the ledger, use --issuer"
+            )
+        if len(issuers) > 1:
+            raise RuntimeError(
+                f"Several certificates {number:x} found in the ledger, use --issuer"
+            )
+        issuer = issuers.pop()
+    else:
+        issuer = d.x509.Name.from_rfc4514_string(issuer).rfc4514_string()
+    RevocationStore().revoke(number, issuer, reason, datetime.now(timezone.utc))
+    logger.info(f"Certificate {number:x} issued by {issuer} revoked")
+
+
+@certificate.command("crl")
+@click.option(
+    "--ca",
+    default="intermediate",
+    help="Key signing the CRL",
+    type=click.Choice(["root", "intermediate"]),
+)
+@click_pin("YubiKey")
+@click.option(
+    "--days",
+    default=30,
+    help="CRL validity in days",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--format",
+    "output_format",
+    default="pem",
+    help="Output format",
+    type=click.Choice(["pem", "der"]),
+)
+@click.option(
+    "--out-file",
+    default="-",
+    help="Output file, for a single CRL",
+    type=click.File("wb"),
+)
+@click.option(
+    "--out-dir",
+    help="Output directory, for partitioned CRL",
+    type=click.Path(file_okay=False, writable=True, path_type=Path),
+)
+@click.option(
+    "--url",
+    help="URL of partitioned CRL, {shard} being replaced by the partition",
+    type=click.STRING,
+)
+@click.option(
+    "--shards",
+    default=1,
+    help="Number of partitions, by serial range",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--delta",
+    is_flag=True,
+    help="Only generate delta CRL, since the last full CRL",
+)
+@click.option(
+    "--all",
+    "all_shards",
+    is_flag=True,
+    help="Generate the CRL of unchanged partitions too",
+)
+def certificate_crl(
+    ca: str,
+    pin: str,
+    days: int,
+    output_format: str,
+    out_file: typing.BinaryIO,
+    out_dir: typing.Optional[Path],
+    url: typing.Optional[str],
+    shards: int,
+    delta: bool,
+    all_shards: bool,
+) -> None:
+    """Generate a CRL signed by the root or the intermediate key.
+
+    The revoked certificates come from the revocation store. They are encoded
+    and written in a streaming way, so that large CRL do not have to fit in
+    memory.
+
+    With --out-dir, the certificates are partitioned by serial range, as done
+    by `certificate sign` with the same --crl-url and --crl-shards, and each
+    partition has its own CRL. Only the CRL of partitions with new revoked
+    certificates are generated, unless --all is used. Full CRL come with an
+    empty delta CRL, and --delta only generates delta CRL.
+    """
+    from . import dependencies as d
+    from .cache import get_issuer
+    from .crl import CrlState, Partition, RevocationStore, publish, write_crl
+    from .signing import PivPrivateKey
+
+    partition = None
+    if out_dir is None:
+        if url is not None or shards > 1 or delta or all_shards:
+            raise click.UsageError(
+                "--url, --shards, --delta and --all are only used with --out-dir"
+            )
+    elif url is None:
+        raise click.UsageError("--url is needed with --out-dir")
+    else:
+        try:
+            partition = Partition(url, shards)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+
+    yk = YUBIKEY.ROOT if ca == "root" else YUBIKEY.INTERMEDIATE
+    with yubikey_one(yk).open_connection(d.SmartCardConnection) as conn:
+        piv = d.PivSession(conn)
+        issuer = get_issuer(piv)
+        if issuer.self_signed != (yk == YUBIKEY.ROOT):
+            raise RuntimeError(f"The inserted key does not look like a {ca} YubiKey!")
+        piv.verify_pin(pin)
+        signer = PivPrivateKey(
+            piv, key_type=issuer.key_type, public_key=issuer.public_key
+        )
+        store = RevocationStore()
+        state = CrlState(issuer)
+
+        def revoked():
+            return store.revoked(issuer.subject.rfc4514_string())
+
+        if partition is not None:
+            written = publish(
+                signer,
+                issuer,
+                revoked,
+                partition,
+                state,
+                out_dir,
+                days,
+                pem=output_format == "pem",
+                delta=delta,
+                everything=all_shards,
+            )
+            logger.info(f"{len(written)} CRL written to {out_dir}")
+            return
+        this_update = datetime.now(timezone.utc)
+        count = write_crl(
+            signer,
+            issuer,
+            revoked(),
+            this_update,
+            this_update + timedelta(days=days),
+            [
+                (d.x509.CRLNumber(state.next_number()), False),
+                (issuer.authority_key_identifier, False),
+            ],
+            out_file,
+            pem=output_format == "pem",
+        )
+    out_file.flush()
+    logger.info(f"CRL with {count} revoked certificates saved to {out_file.name}")
+
 
 @root.command("sign")
 @click_pin(YUBIKEY.ROOT)
@@ -399,82 +1276,102 @@ def root() -> None:
     help="Certificate validity in days",
     type=click.IntRange(min=1),
 )
+@click_yes()
+@click_prefetch()
+@click_jobs()
 def root_sign(
-        pin: str,
-        csr_file: typing.TextIO,
-        out_file: typing.TextIO,
-        days: int,
+    pin: str,
+    csr_file: typing.TextIO,
+    out_file: typing.TextIO,
+    days: int,
+    yes: bool,
+    prefetch: int,
+    jobs: int,
 ) -> None:
-    """Sign a certificate request with the root certificate."""
-    from . import dependencies as d
+    """Sign certificate requests with the root certificate.
 
-    logger.debug("Load CSR file and check signature")
-    csr = d.x509.load_pem_x509_csr(csr_file.read().encode("ascii"))
-    public_key = csr.public_key()
-
-    # Verify CSR Signature
-    if (
-            isinstance(public_key, d.rsa.RSAPublicKey)
-            and csr.signature_hash_algorithm is not None
-    ):
-        public_key.verify(
-            csr.signature,
-            csr.tbs_certrequest_bytes,
-            d.padding.PKCS1v15(),
-            csr.signature_hash_algorithm,
-        )
-    elif isinstance(public_key, d.ec.EllipticCurvePublicKey):
-        if csr.signature_hash_algorithm is None:
-            raise ValueError("No hash algorithm in CSR")
-        public_key.verify(
-            csr.signature,
-            csr.tbs_certrequest_bytes,
-            d.ec.ECDSA(csr.signature_hash_algorithm),
-        )
-    else:
-        raise ValueError(f"Unsupported public key {public_key}")
+    The CSR file may contain several concatenated CSR. They are parsed and
+    signed one by one, and each certificate is written as soon as it is
+    signed. While a certificate is signed by the YubiKey, the next CSR are
+    checked in parallel and prepared in the background. Invalid CSR are
+    reported and skipped without aborting the batch, as well as the ones
+    violating the name constraints of the root certificate.
+    """
+    from . import dependencies as d
+    from .cache import get_issuer
+    from .ledger import Ledger
+    from .pipeline import Pipeline
+    from .policy import Policy, PolicyError
+    from .signing import sign_certificate_builder
 
     with yubikey_one(YUBIKEY.ROOT).open_connection(d.SmartCardConnection) as conn:
         piv = d.PivSession(conn)
-        root_cert = piv.get_certificate(d.SLOT.SIGNATURE)
+        root_cert = get_issuer(piv)
 
-        if root_cert.issuer.rfc4514_string() != root_cert.subject.rfc4514_string():
+        if not root_cert.self_signed:
             raise RuntimeError("The inserted key does not look like a root YubiKey!")
-
-        logger.debug("Building certificate")
         issuer = root_cert.subject
-        subject = csr.subject
 
-        cert = (
-            d.x509.CertificateBuilder()
-            .subject_name(subject)
-            .issuer_name(issuer)
-            .public_key(public_key)
-            .serial_number(d.x509.random_serial_number())
-            .not_valid_before(datetime.now(timezone.utc))
-            .not_valid_after(datetime.now(timezone.utc) + timedelta(days=days))
-        )
-
-        # Copy CSR Extensions
-        for extension in csr.extensions:
-            logger.debug(f"Add extension {extension.value}")
-            cert = cert.add_extension(extension.value, extension.critical)
+        policy = Policy([root_cert.certificate])
 
-        click.confirm("Sign this certificate with the root CA?", abort=True)
+        def prepare(item):
+            name, pem = item
+            csr = d.x509.load_pem_x509_csr(pem)
+            logger.debug("Building certificate")
+            logger.info(f"Subject name is {csr.subject.rfc4514_string()}")
+            try:
+                policy.check(csr.subject, csr.extensions)
+            except PolicyError as e:
+                verifier.reject(name, str(e))
+                return None
+            return csr, certificate_builder(
+                csr, csr.subject, issuer, days, root_cert.authority_key_identifier
+            )
 
-        piv.verify_pin(pin)
-        signed_cert = d.sign_certificate_builder(
-            piv,
-            slot=d.SLOT.SIGNATURE,
-            key_type=d.KEY_TYPE.ECCP384,
-            builder=cert,
-            hash_algorithm=d.hashes.SHA384,
+        # Read all the CSR, to tell how many will be signed
+        items = list(iter_csr_files([csr_file]))
+        verifier = CsrVerifier(jobs, prefetch)
+        pipeline = Pipeline(
+            prepare,
+            verifier.valid(items),
+            workers=min(prefetch, os.cpu_count() or 1),
+            # Nothing is prepared in the background until confirmation, so
+            # that only the subjects of the CSR shown are logged.
+            depth=1,
         )
-
-        out_file.write(
-            signed_cert.public_bytes(encoding=d.serialization.Encoding.PEM).decode(
-                "ascii"
-            )
+        # Only look ahead for a second CSR to ask for confirmation.
+        pending = (item for item in pipeline if item is not None)
+        first = list(itertools.islice(pending, 2))
+        if not first:
+            verifier.check()
+            raise RuntimeError("No CSR found!")
+        confirm_signing(
+            signing_message(len(first), len(items), " with the root CA"),
+            yes,
+            [csr_file],
         )
+        pipeline.depth = prefetch
+
+        def write(pem: str) -> None:
+            out_file.write(pem)
+            out_file.flush()
+
+        piv.verify_pin(pin)
+        with Ledger() as ledger:
+            for csr, cert in itertools.chain(first, pending):
+                with pipeline.stage():
+                    signed_cert = sign_certificate_builder(
+                        piv,
+                        cert,
+                        key_type=root_cert.key_type,
+                        public_key=root_cert.public_key,
+                    )
+                pem = signed_cert.public_bytes(
+                    encoding=d.serialization.Encoding.PEM
+                ).decode("ascii")
+                # Certificates are written once recorded in the ledger
+                ledger.record(signed_cert, csr, functools.partial(write, pem))
+        pipeline.report("YubiKey signing")
+        verifier.check()
 
-    logger.info(f"Signed certificate saved to {out_file.name}")
\ No newline at end of file
+    logger.info(f"Signed certificates saved to {out_file.name}")
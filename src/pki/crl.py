@@ -0,0 +1,417 @@
+import base64
+import itertools
+import json
+import logging
+import os
+import tempfile
+import typing
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from .ledger import ledger_dir
+
+logger = logging.getLogger("offline-pki.crl")
+
+REVOCATIONS = "revocations.jsonl"
+CRL_STATE = "crl-state.json"
+# Serial numbers are random positive 20 bytes integers
+SERIAL_BITS = 159
+# ecdsa-with-SHA384
+SIGNATURE_ALGORITHM = bytes.fromhex("300a06082a8648ce3d040303")
+CHUNK = 64 * 1024
+
+
+def der_length(length: int) -> bytes:
+    if length < 0x80:
+        return bytes([length])
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([0x80 | len(encoded)]) + encoded
+
+
+def der(tag: int, content: bytes) -> bytes:
+    return bytes([tag]) + der_length(len(content)) + content
+
+
+def der_integer(value: int) -> bytes:
+    return der(0x02, value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True))
+
+
+def der_time(value: datetime) -> bytes:
+    value = value.astimezone(timezone.utc)
+    if value.year < 2050:
+        return der(0x17, value.strftime("%y%m%d%H%M%SZ").encode("ascii"))
+    return der(0x18, value.strftime("%Y%m%d%H%M%SZ").encode("ascii"))
+
+
+def der_extension(extension, critical: bool = False) -> bytes:
+    """Encode an extension from its cryptography value."""
+    content = der_oid(extension.oid.dotted_string)
+    if critical:
+        content += der(0x01, b"\xff")
+    content += der(0x04, extension.public_bytes())
+    return der(0x30, content)
+
+
+def der_oid(dotted: str) -> bytes:
+    arcs = [int(arc) for arc in dotted.split(".")]
+    content = bytes([arcs[0] * 40 + arcs[1]])
+    for arc in arcs[2:]:
+        encoded = [arc & 0x7F]
+        arc >>= 7
+        while arc:
+            encoded.append(0x80 | (arc & 0x7F))
+            arc >>= 7
+        content += bytes(reversed(encoded))
+    return der(0x06, content)
+
+
+class RevocationStore:
+    """Append-only store of revoked certificates, next to the ledger."""
+
+    def __init__(self, directory: typing.Optional[Path] = None):
+        self.directory = directory or ledger_dir()
+        self.path = self.directory / REVOCATIONS
+
+    def __iter__(self) -> typing.Iterator[dict]:
+        if not self.path.exists():
+            return
+        with open(self.path, "rb") as revocations:
+            for line in revocations:
+                yield json.loads(line)
+
+    def revoked(self, issuer: str) -> typing.Iterator[dict]:
+        """Revocations of the certificates of an issuer."""
+        return (item for item in self if item["issuer"] == issuer)
+
+    def by_serial(self) -> dict[tuple[str, int], dict]:
+        """Revocations indexed by issuer and serial number."""
+        return {(item["issuer"], int(item["serial"], 16)): item for item in self}
+
+    def revoke(self, serial: int, issuer: str, reason: str, date: datetime) -> dict:
+        for item in self.revoked(issuer):
+            if int(item["serial"], 16) == serial:
+                raise RuntimeError(f"Certificate {serial:x} is already revoked!")
+        item = {
+            "serial": f"{serial:x}",
+            "issuer": issuer,
+            "reason": reason,
+            "date": date.isoformat(),
+        }
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as revocations:
+            revocations.write(json.dumps(item, sort_keys=True) + "\n")
+            revocations.flush()
+            os.fsync(revocations.fileno())
+        return item
+
+
+class CrlState:
+    """CRL numbers and published partitions of an issuer, next to the ledger.
+
+    The CRL numbers are shared by all the CRL of an issuer, full or delta.
+    For each partition, the number of the last full CRL and its count of
+    revoked certificates are kept as the base of delta CRL, along with the
+    count of revoked certificates last published.
+    """
+
+    def __init__(self, issuer, directory: typing.Optional[Path] = None):
+        from .cache import fingerprint
+
+        self.path = (directory or ledger_dir()) / CRL_STATE
+        self.states = json.loads(self.path.read_text()) if self.path.exists() else {}
+        self.state = self.states.setdefault(
+            fingerprint(issuer.public_key), {"number": 0}
+        )
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.states, indent=2, sort_keys=True))
+        os.replace(tmp, self.path)
+
+    def next_number(self) -> int:
+        """Increment and return the CRL number."""
+        self.state["number"] += 1
+        self.save()
+        return self.state["number"]
+
+    def partition(self, shards: int) -> None:
+        """Forget the published partitions if their number changed."""
+        if self.state.get("shards") != shards:
+            self.state.update(shards=shards, bases={}, published={})
+
+    def base(self, shard: int) -> typing.Optional[dict]:
+        return self.state["bases"].get(str(shard))
+
+    def published(self, shard: int) -> typing.Optional[int]:
+        return self.state["published"].get(str(shard))
+
+    def publish(self, shard: int, count: int, base: typing.Optional[int] = None):
+        if base is not None:
+            self.state["bases"][str(shard)] = {"number": base, "count": count}
+        self.state["published"][str(shard)] = count
+        self.save()
+
+
+class Partition:
+    """Partition of the certificates of an issuer by serial range.
+
+    Each partition has its own CRL, published at `url`, where "{shard}" is
+    replaced by the partition number, followed by "-delta" for delta CRL.
+    """
+
+    def __init__(self, url: str, shards: int = 1):
+        if "{shard}" not in url:
+            raise ValueError("The CRL URL must contain {shard}")
+        self.template = url
+        self.shards = shards
+
+    def shard(self, serial: int) -> int:
+        return min((serial * self.shards) >> SERIAL_BITS, self.shards - 1)
+
+    def name(self, shard: int, delta: bool = False) -> str:
+        return f"{shard}-delta" if delta else str(shard)
+
+    def url(self, shard: int, delta: bool = False) -> str:
+        return self.template.replace("{shard}", self.name(shard, delta))
+
+    def filename(self, shard: int, delta: bool = False) -> str:
+        """Name of the CRL file, the last component of its URL."""
+        return self.url(shard, delta).rsplit("/", 1)[-1]
+
+    def distribution_point(self, shard: int, delta: bool = False):
+        from . import dependencies as d
+
+        return d.x509.DistributionPoint(
+            full_name=[d.x509.UniformResourceIdentifier(self.url(shard, delta))],
+            relative_name=None,
+            reasons=None,
+            crl_issuer=None,
+        )
+
+    def distribution_points(self, serial: int):
+        """CRL distribution points extension of a certificate."""
+        from . import dependencies as d
+
+        return d.x509.CRLDistributionPoints(
+            [self.distribution_point(self.shard(serial))]
+        )
+
+    def issuing_distribution_point(self, shard: int):
+        from . import dependencies as d
+
+        return d.x509.IssuingDistributionPoint(
+            full_name=[d.x509.UniformResourceIdentifier(self.url(shard))],
+            relative_name=None,
+            only_contains_user_certs=False,
+            only_contains_ca_certs=False,
+            only_some_reasons=None,
+            indirect_crl=False,
+            only_contains_attribute_certs=False,
+        )
+
+
+def revoked_entry(item: dict) -> bytes:
+    """Encode a revokedCertificates entry."""
+    from . import dependencies as d
+
+    content = der_integer(int(item["serial"], 16)) + der_time(
+        datetime.fromisoformat(item["date"])
+    )
+    reason = d.x509.ReasonFlags(item.get("reason", "unspecified"))
+    if reason != d.x509.ReasonFlags.unspecified:
+        content += der(0x30, der_extension(d.x509.CRLReason(reason)))
+    return der(0x30, content)
+
+
+def write_crl(
+    signer,
+    issuer,
+    revoked: typing.Iterable[dict],
+    this_update: datetime,
+    next_update: datetime,
+    extensions: typing.Iterable[tuple[typing.Any, bool]],
+    output: typing.BinaryIO,
+    pem: bool = False,
+) -> int:
+    """Build, sign and write a CRL, returning the number of revoked entries.
+
+    The revoked entries are encoded to a temporary file, so that they are
+    never all in memory, then the TBS structure is hashed while being read
+    back and only the digest is signed by `signer` (a `PivPrivateKey`).
+    """
+    from . import dependencies as d
+
+    count = 0
+    with tempfile.TemporaryFile() as entries:
+        for item in revoked:
+            entries.write(revoked_entry(item))
+            count += 1
+        size = entries.tell()
+
+        head = (
+            der_integer(1)
+            + SIGNATURE_ALGORITHM
+            + issuer.subject.public_bytes()
+            + der_time(this_update)
+            + der_time(next_update)
+        )
+        if size:
+            head += bytes([0x30]) + der_length(size)
+        tail = der(
+            0xA0,
+            der(
+                0x30,
+                b"".join(
+                    der_extension(extension, critical)
+                    for extension, critical in extensions
+                ),
+            ),
+        )
+        tbs_length = len(head) + size + len(tail)
+        tbs_head = bytes([0x30]) + der_length(tbs_length) + head
+
+        def tbs() -> typing.Iterator[bytes]:
+            yield tbs_head
+            entries.seek(0)
+            while chunk := entries.read(CHUNK):
+                yield chunk
+            yield tail
+
+        h = d.hashes.Hash(d.hashes.SHA384())
+        for chunk in tbs():
+            h.update(chunk)
+        signature = signer.sign(
+            h.finalize(), d.ec.ECDSA(d.Prehashed(d.hashes.SHA384()))
+        )
+        trailer = SIGNATURE_ALGORITHM + der(0x03, b"\x00" + signature)
+        crl_head = bytes([0x30]) + der_length(
+            len(tbs_head) + size + len(tail) + len(trailer)
+        )
+
+        def crl() -> typing.Iterator[bytes]:
+            yield crl_head
+            yield from tbs()
+            yield trailer
+
+        if not pem:
+            for chunk in crl():
+                output.write(chunk)
+            return count
+        output.write(b"-----BEGIN X509 CRL-----\n")
+        pending = b""
+        for chunk in crl():
+            pending += chunk
+            # Encode by multiples of 48 bytes, which are 64 characters lines
+            cut = len(pending) - len(pending) % 48
+            encoded = base64.b64encode(pending[:cut])
+            pending = pending[cut:]
+            for start in range(0, len(encoded), 64):
+                output.write(encoded[start : start + 64] + b"\n")
+        if pending:
+            output.write(base64.b64encode(pending) + b"\n")
+        output.write(b"-----END X509 CRL-----\n")
+    return count
+
+
+def write_crl_file(path: Path, *args, pem: bool = False) -> int:
+    """Write a CRL atomically, so that a published CRL is never truncated."""
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as output:
+        count = write_crl(*args, output, pem=pem)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(tmp, path)
+    return count
+
+
+def publish(
+    signer,
+    issuer,
+    revoked: typing.Callable[[], typing.Iterable[dict]],
+    partition: Partition,
+    state: CrlState,
+    out_dir: Path,
+    days: int,
+    pem: bool = False,
+    delta: bool = False,
+    everything: bool = False,
+) -> list[str]:
+    """Write the CRL of the partitions which changed, returning their names.
+
+    A partition changed when certificates were revoked since its last full
+    CRL, or since its last delta CRL with `delta`.
+
+    A full CRL becomes the base of the delta CRL of its partition: an empty
+    delta CRL is written along with it, and advertised by its freshest CRL
+    extension. With `delta`, only delta CRL are written, with the certificates
+    revoked since the base. Each call of `revoked` iterates over the revoked
+    certificates of the issuer, in the order of revocation.
+    """
+    from . import dependencies as d
+
+    counts = [0] * partition.shards
+    for item in revoked():
+        counts[partition.shard(int(item["serial"], 16))] += 1
+    state.partition(partition.shards)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    this_update = datetime.now(timezone.utc)
+    next_update = this_update + timedelta(days=days)
+    written = []
+
+    def entries(shard: int) -> typing.Iterator[dict]:
+        for item in revoked():
+            if partition.shard(int(item["serial"], 16)) == shard:
+                yield item
+
+    def write(shard, delta_of, items, extensions) -> int:
+        name = partition.name(shard, delta_of is not None)
+        number = state.next_number()
+        extensions = [
+            (d.x509.CRLNumber(number), False),
+            (issuer.authority_key_identifier, False),
+            (partition.issuing_distribution_point(shard), True),
+        ] + extensions
+        if delta_of is not None:
+            extensions.append((d.x509.DeltaCRLIndicator(delta_of), True))
+        count = write_crl_file(
+            out_dir / partition.filename(shard, delta_of is not None),
+            signer,
+            issuer,
+            items,
+            this_update,
+            next_update,
+            extensions,
+            pem=pem,
+        )
+        logger.info(f"CRL {name} with {count} revoked certificates written")
+        written.append(name)
+        return number
+
+    for shard, count in enumerate(counts):
+        base = state.base(shard)
+        if delta:
+            published = state.published(shard)
+        else:
+            published = None if base is None else base["count"]
+        if not everything and published == count:
+            logger.debug(f"CRL {partition.name(shard)} unchanged")
+            continue
+        if delta:
+            if base is None:
+                raise RuntimeError(
+                    f"No full CRL {partition.name(shard)} to build a delta CRL on!"
+                )
+            write(
+                shard,
+                base["number"],
+                itertools.islice(entries(shard), base["count"], None),
+                [],
+            )
+            state.publish(shard, count)
+            continue
+        freshest = d.x509.FreshestCRL([partition.distribution_point(shard, True)])
+        number = write(shard, None, entries(shard), [(freshest, False)])
+        write(shard, number, [], [])
+        state.publish(shard, count, base=number)
+    return written
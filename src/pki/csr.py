@@ -0,0 +1,152 @@
+import itertools
+import logging
+import sys
+import typing
+
+from .pipeline import Pipeline
+
+logger = logging.getLogger("offline-pki.csr")
+
+# Batches up to this size are checked inline, without starting processes
+INLINE_CSR = 2
+
+
+def verify_csr(csr) -> None:
+    """Check the signature of a CSR."""
+    from . import dependencies as d
+
+    public_key = csr.public_key()
+    if (
+        isinstance(public_key, d.rsa.RSAPublicKey)
+        and csr.signature_hash_algorithm is not None
+    ):
+        public_key.verify(
+            csr.signature,
+            csr.tbs_certrequest_bytes,
+            d.padding.PKCS1v15(),
+            csr.signature_hash_algorithm,
+        )
+    elif isinstance(public_key, d.ec.EllipticCurvePublicKey):
+        if csr.signature_hash_algorithm is None:
+            raise ValueError("No hash algorithm in CSR")
+        public_key.verify(
+            csr.signature,
+            csr.tbs_certrequest_bytes,
+            d.ec.ECDSA(csr.signature_hash_algorithm),
+        )
+    else:
+        raise ValueError(f"Unsupported public key {public_key}")
+
+
+def check_csr(item: tuple[str, bytes]) -> tuple[str, bytes, typing.Optional[str]]:
+    """Parse a PEM-encoded CSR and check its signature.
+
+    The name and the PEM-encoded CSR are returned with an error message if the
+    CSR is invalid. This is meant to be run in another process.
+    """
+    from . import dependencies as d
+
+    name, pem = item
+    try:
+        verify_csr(d.x509.load_pem_x509_csr(pem))
+    except d.InvalidSignature:
+        return name, pem, "invalid signature"
+    except ValueError as e:
+        return name, pem, str(e) or e.__class__.__name__
+    return name, pem, None
+
+
+class CsrVerifier:
+    """Check CSR signatures of a batch in a pool of processes.
+
+    Results are returned in the input order. Invalid CSR are logged and
+    recorded in `failures` without aborting the batch, as are the CSR
+    rejected by the policy in `rejections`. Small batches are checked inline.
+    """
+
+    def __init__(self, workers: int, depth: int):
+        self.workers = workers
+        self.depth = depth
+        self.failures: list[tuple[str, str]] = []
+        self.rejections: list[tuple[str, str]] = []
+
+    def verify(
+        self, items: typing.Iterable[tuple[str, bytes]]
+    ) -> typing.Iterator[tuple[str, bytes, typing.Optional[str]]]:
+        """Check each (name, PEM) and return them with an optional error."""
+        items = iter(items)
+        head = list(itertools.islice(items, INLINE_CSR + 1))
+        if self.workers == 1 or len(head) <= INLINE_CSR:
+            yield from map(check_csr, itertools.chain(head, items))
+            return
+        from concurrent.futures import ProcessPoolExecutor
+
+        yield from Pipeline(
+            check_csr,
+            itertools.chain(head, items),
+            workers=self.workers,
+            depth=self.depth,
+            executor=ProcessPoolExecutor,
+        )
+
+    def valid(
+        self, items: typing.Iterable[tuple[str, bytes]]
+    ) -> typing.Iterator[tuple[str, bytes]]:
+        """Only return valid CSR, recording the invalid ones."""
+        for name, pem, error in self.verify(items):
+            if error is not None:
+                logger.error(f"Invalid CSR in {name}: {error}")
+                self.failures.append((name, error))
+                continue
+            yield name, pem
+
+    def reject(self, name: str, reason: str) -> None:
+        """Record a valid CSR which should not be signed."""
+        logger.error(f"CSR in {name} rejected: {reason}")
+        self.rejections.append((name, reason))
+
+    def check(self) -> None:
+        """Raise an error if some CSR were invalid or rejected."""
+        errors = []
+        if self.failures:
+            errors.append(f"{len(self.failures)} CSR could not be verified")
+        if self.rejections:
+            errors.append(f"{len(self.rejections)} CSR rejected by the policy")
+        if errors:
+            raise RuntimeError(", ".join(errors) + "!")
+
+
+def iter_csrs(source: typing.TextIO) -> typing.Iterator[bytes]:
+    """Lazily split a PEM bundle into PEM-encoded CSR."""
+    block = None
+    for line in source:
+        if line.startswith("-----BEGIN ") and "CERTIFICATE REQUEST-----" in line:
+            block = [line]
+        elif block is not None:
+            block.append(line)
+            if line.startswith("-----END "):
+                yield "".join(block).encode("ascii")
+                block = None
+    if block is not None:
+        raise ValueError(f"Truncated CSR in {source.name}")
+
+
+def is_stdin(source: typing.TextIO) -> bool:
+    return source is sys.stdin or getattr(source, "name", None) == "<stdin>"
+
+
+def iter_csr_files(
+    sources: list[typing.TextIO],
+) -> typing.Iterator[tuple[str, bytes]]:
+    """Lazily split several PEM bundles into PEM-encoded CSR.
+
+    Each CSR is returned with the name of the file containing it. Each file is
+    closed once read, except the standard input, which is still needed to
+    confirm the signature.
+    """
+    for source in sources:
+        logger.debug(f"Load CSR file {source.name}")
+        for pem in iter_csrs(source):
+            yield source.name, pem
+        if not is_stdin(source):
+            source.close()
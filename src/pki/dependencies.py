@@ -1,10 +1,18 @@
+import warnings
+from cryptography.utils import CryptographyDeprecationWarning
+
+# yubikit still uses TripleDES for the default management key type
+warnings.filterwarnings(
+    "ignore", category=CryptographyDeprecationWarning, message=".*TripleDES.*"
+)
+
 from ykman.device import list_all_devices
 from ykman.piv import (
     pivman_change_pin,
     pivman_set_mgm_key,
     sign_certificate_builder,
 )
-from yubikit.core import TRANSPORT
+from yubikit.core import TRANSPORT, NotSupportedError
 from yubikit.core.smartcard import SmartCardConnection, ApduError, SW
 from yubikit.management import ManagementSession, DeviceConfig, CAPABILITY
 from yubikit.piv import (
@@ -17,6 +25,9 @@ from yubikit.piv import (
 )
 
 from cryptography import x509
+from cryptography.x509 import ocsp
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec, rsa, padding
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
@@ -0,0 +1,485 @@
+import bisect
+import contextlib
+import fcntl
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import typing
+import click
+from datetime import datetime, timezone
+from pathlib import Path
+
+logger = logging.getLogger("offline-pki.ledger")
+
+LEDGER = "ledger.jsonl"
+CERTIFICATES = "certificates.der"
+LOCK = "lock"
+# Entries written with a single fsync
+BATCH = 1000
+# Index segments before they are merged
+MAX_SEGMENTS = 8
+
+
+def ledger_dir() -> Path:
+    directory = os.environ.get("OFFLINE_PKI_LEDGER")
+    if directory:
+        return Path(directory)
+    return Path(click.get_app_dir("offline-pki")) / "ledger"
+
+
+def fsync_dir(directory: Path) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def general_name(name) -> str:
+    from . import dependencies as d
+
+    if isinstance(name, d.x509.DNSName):
+        return f"DNS:{name.value}"
+    if isinstance(name, d.x509.IPAddress):
+        return f"IP:{name.value}"
+    if isinstance(name, d.x509.RFC822Name):
+        return f"EMAIL:{name.value}"
+    if isinstance(name, d.x509.UniformResourceIdentifier):
+        return f"URI:{name.value}"
+    if isinstance(name, d.x509.DirectoryName):
+        return f"DN:{name.value.rfc4514_string()}"
+    return f"{name.__class__.__name__}:{name.value}"
+
+
+def entry(cert, csr=None) -> dict:
+    """Describe an issued certificate for the ledger."""
+    from . import dependencies as d
+
+    try:
+        sans = [
+            general_name(name)
+            for name in cert.extensions.get_extension_for_class(
+                d.x509.SubjectAlternativeName
+            ).value
+        ]
+    except d.x509.ExtensionNotFound:
+        sans = []
+    spki = d.hashes.Hash(d.hashes.SHA256())
+    spki.update(
+        cert.public_key().public_bytes(
+            d.serialization.Encoding.DER,
+            d.serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+    )
+    result = {
+        "serial": f"{cert.serial_number:x}",
+        "subject": cert.subject.rfc4514_string(),
+        "sans": sans,
+        "not_before": cert.not_valid_before_utc.isoformat(),
+        "not_after": cert.not_valid_after_utc.isoformat(),
+        "issuer": cert.issuer.rfc4514_string(),
+        "spki_sha256": spki.finalize().hex(),
+        "csr_sha256": None,
+    }
+    if csr is not None:
+        h = d.hashes.Hash(d.hashes.SHA256())
+        h.update(csr.public_bytes(d.serialization.Encoding.DER))
+        result["csr_sha256"] = h.finalize().hex()
+    return result
+
+
+def subject_key(subject: str) -> bytes:
+    from . import dependencies as d
+
+    h = d.hashes.Hash(d.hashes.SHA256())
+    h.update(subject.encode("utf-8"))
+    return h.finalize()
+
+
+def expiry_key(timestamp: datetime) -> bytes:
+    # Shifted, so that the keys are ordered like the timestamps
+    return struct.pack(">Q", int(timestamp.timestamp()) + 2**63)
+
+
+def term_key(term: str) -> bytes:
+    from . import dependencies as d
+
+    h = d.hashes.Hash(d.hashes.SHA256())
+    h.update(term.lower().encode("utf-8"))
+    return h.finalize()
+
+
+def dns_terms(name: str) -> list[str]:
+    """Terms of a DNS name: the name, and its parent domains as suffixes."""
+    labels = name.lower().rstrip(".").split(".")
+    return [f"dns:{'.'.join(labels)}"] + [
+        f"dns-suffix:{'.'.join(labels[nb:])}" for nb in range(1, len(labels))
+    ]
+
+
+def terms(e: dict) -> list[str]:
+    """Searchable terms of an entry: SAN, subject attributes and public key."""
+    from . import dependencies as d
+
+    result = {f"spki:{e['spki_sha256']}"}
+    for san in e["sans"]:
+        kind, value = san.split(":", 1)
+        if kind == "DNS":
+            result.update(dns_terms(value))
+        else:
+            result.add(f"{kind.lower()}:{value.lower()}")
+    for attribute in d.x509.Name.from_rfc4514_string(e["subject"]):
+        result.add(f"rdn:{attribute.rfc4514_string().lower()}")
+    return sorted(result)
+
+
+def dns_query(name: str) -> list[str]:
+    """Terms of the certificates covering a DNS name.
+
+    A name is covered by itself or by a wildcard on its parent domain, and a
+    wildcard query matches all the names below its domain.
+    """
+    name = name.lower().rstrip(".")
+    if name.startswith("*."):
+        return [f"dns-suffix:{name[2:]}"]
+    parent = name.split(".", 1)
+    return [f"dns:{name}"] + ([f"dns:*.{parent[1]}"] if len(parent) > 1 else [])
+
+
+# Fixed-size keys of each index, from a ledger entry
+INDEXES: dict[str, tuple[int, typing.Callable[[dict], list[bytes]]]] = {
+    "serial": (20, lambda e: [int(e["serial"], 16).to_bytes(20, "big")]),
+    "subject": (32, lambda e: [subject_key(e["subject"])]),
+    "expiry": (8, lambda e: [expiry_key(datetime.fromisoformat(e["not_after"]))]),
+    # Inverted index of the terms of each entry
+    "term": (32, lambda e: [term_key(term) for term in terms(e)]),
+}
+
+
+class Segment:
+    """Sorted index records (fixed-size key, ledger offset) in a file."""
+
+    def __init__(self, path: Path, key_size: int):
+        self.path = path
+        self.key_size = key_size
+        self.record_size = key_size + 8
+        self.end = int(path.stem.rsplit("-", 1)[1], 16)
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.count = size // self.record_size
+        self.map = (
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        )
+
+    def key(self, nb: int) -> bytes:
+        start = nb * self.record_size
+        return self.map[start : start + self.key_size]
+
+    def offset(self, nb: int) -> int:
+        start = nb * self.record_size + self.key_size
+        return struct.unpack(">Q", self.map[start : start + 8])[0]
+
+    def range(self, low: bytes, high: bytes) -> typing.Iterator[tuple[bytes, int]]:
+        """Records with low <= key < high, by binary search."""
+        nb = bisect.bisect_left(SegmentKeys(self), low)
+        while nb < self.count and self.key(nb) < high:
+            yield self.key(nb), self.offset(nb)
+            nb += 1
+
+    def __iter__(self) -> typing.Iterator[tuple[bytes, int]]:
+        for nb in range(self.count):
+            yield self.key(nb), self.offset(nb)
+
+    def close(self) -> None:
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+
+class SegmentKeys(typing.Sequence[bytes]):
+    def __init__(self, segment: Segment):
+        self.segment = segment
+
+    def __len__(self) -> int:
+        return self.segment.count
+
+    def __getitem__(self, nb):
+        return self.segment.key(nb)
+
+
+class Index:
+    """Secondary index of the ledger, as a few sorted segments.
+
+    Each batch of entries adds a new sorted segment, and segments are merged
+    when there are too many of them, so a lookup is a binary search in a
+    bounded number of memory-mapped files.
+    """
+
+    def __init__(self, directory: Path, name: str, key_size: int):
+        self.directory = directory
+        self.name = name
+        self.key_size = key_size
+        self.segments = [
+            Segment(path, key_size) for path in sorted(directory.glob(f"{name}-*.idx"))
+        ]
+
+    @property
+    def end(self) -> int:
+        return max((segment.end for segment in self.segments), default=0)
+
+    def write(self, records: typing.Iterable[tuple[bytes, int]], end: int) -> None:
+        path = self.directory / f"{self.name}-{end:016x}.idx"
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as output:
+            for key, offset in records:
+                output.write(key + struct.pack(">Q", offset))
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(tmp, path)
+        self.segments.append(Segment(path, self.key_size))
+
+    def add(self, records: list[tuple[bytes, int]], end: int) -> None:
+        self.write(sorted(records), end)
+        if len(self.segments) > MAX_SEGMENTS:
+            logger.debug(f"Merge {len(self.segments)} segments of {self.name} index")
+            segments, self.segments = self.segments, []
+            self.write(heapq.merge(*segments), end)
+            for segment in segments:
+                segment.close()
+                # The last segment was replaced by the merged one.
+                if segment.path != self.segments[0].path:
+                    segment.path.unlink()
+
+    def range(self, low: bytes, high: bytes) -> list[int]:
+        """Ledger offsets of the entries with low <= key < high, by key."""
+        return [
+            offset
+            for _, offset in heapq.merge(
+                *(segment.range(low, high) for segment in self.segments)
+            )
+        ]
+
+    def lookup(self, key: bytes) -> list[int]:
+        # Keys have a fixed size, so only the key itself is lower than this.
+        return self.range(key, key + b"\x00")
+
+    def close(self) -> None:
+        for segment in self.segments:
+            segment.close()
+
+
+class Ledger:
+    """Append-only ledger of the issued certificates.
+
+    Entries are appended to a JSON lines file, and the DER-encoded
+    certificates to another file. Entries are written by batches, with a
+    single fsync for each batch, followed by the new index segments. Indexes
+    missing entries, for example after a crash, are completed when the ledger
+    is opened.
+
+    A certificate should only be handed out once its entry is written: the
+    callback given to `record()` is called then.
+    """
+
+    def __init__(self, directory: typing.Optional[Path] = None):
+        self.directory = directory or ledger_dir()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.pending: list[
+            tuple[dict, bytes, typing.Optional[typing.Callable[[], None]]]
+        ] = []
+        self.lock = open(self.directory / LOCK, "a")
+        self.indexes: dict[str, Index] = {}
+        with self.locked():
+            self.recover()
+            self.reindex()
+
+    @contextlib.contextmanager
+    def locked(self) -> typing.Iterator[None]:
+        """Prevent other processes from writing to the ledger."""
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+
+    def recover(self) -> None:
+        """Drop a partially written last entry."""
+        path = self.directory / LEDGER
+        if not path.exists():
+            return
+        with open(path, "rb+") as ledger:
+            size = ledger.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            ledger.seek(size - 1)
+            if ledger.read(1) == b"\n":
+                return
+            data = path.read_bytes()
+            end = data.rfind(b"\n") + 1
+            logger.warning(f"Drop partially written entry at {end} in {path}")
+            ledger.truncate(end)
+
+    def reindex(self) -> None:
+        """Load the indexes and add the entries missing from them."""
+        for index in self.indexes.values():
+            index.close()
+        self.indexes = {
+            name: Index(self.directory, name, size)
+            for name, (size, _) in INDEXES.items()
+        }
+        path = self.directory / LEDGER
+        size = path.stat().st_size if path.exists() else 0
+        for name, index in self.indexes.items():
+            if index.end >= size:
+                continue
+            logger.info(f"Index ledger entries from {index.end} in {name} index")
+            records = []
+            with open(path, "rb") as ledger:
+                ledger.seek(index.end)
+                offset = index.end
+                for line in ledger:
+                    records.extend(
+                        (key, offset) for key in INDEXES[name][1](json.loads(line))
+                    )
+                    offset += len(line)
+            index.add(records, size)
+
+    def record(
+        self,
+        cert,
+        csr=None,
+        recorded: typing.Optional[typing.Callable[[], None]] = None,
+    ) -> None:
+        """Record an issued certificate, written with the next batch.
+
+        `recorded` is called once the entry is safely written, to output the
+        certificate.
+        """
+        from . import dependencies as d
+
+        self.pending.append(
+            (
+                entry(cert, csr),
+                cert.public_bytes(d.serialization.Encoding.DER),
+                recorded,
+            )
+        )
+        if len(self.pending) >= BATCH:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the pending entries and their index records."""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        with self.locked():
+            self.reindex()
+            with open(self.directory / CERTIFICATES, "ab") as certificates, open(
+                self.directory / LEDGER, "ab"
+            ) as ledger:
+                der_offset = certificates.seek(0, os.SEEK_END)
+                offset = ledger.seek(0, os.SEEK_END)
+                records: dict[str, list[tuple[bytes, int]]] = {
+                    name: [] for name in INDEXES
+                }
+                for item, der, _ in pending:
+                    item["der_offset"] = der_offset
+                    item["der_length"] = len(der)
+                    item["recorded"] = datetime.now(timezone.utc).isoformat()
+                    certificates.write(der)
+                    der_offset += len(der)
+                    line = (json.dumps(item, sort_keys=True) + "\n").encode("utf-8")
+                    ledger.write(line)
+                    for name, (_, keys) in INDEXES.items():
+                        records[name].extend((key, offset) for key in keys(item))
+                    offset += len(line)
+                certificates.flush()
+                os.fsync(certificates.fileno())
+                ledger.flush()
+                os.fsync(ledger.fileno())
+            for name, index in self.indexes.items():
+                index.add(records[name], offset)
+            fsync_dir(self.directory)
+        logger.info(f"{len(pending)} certificates recorded in {self.directory}")
+        for _, _, recorded in pending:
+            if recorded is not None:
+                recorded()
+
+    def read(self, offsets: typing.Iterable[int]) -> list[dict]:
+        entries = []
+        with open(self.directory / LEDGER, "rb") as ledger:
+            for offset in offsets:
+                ledger.seek(offset)
+                entries.append(json.loads(ledger.readline()))
+        return entries
+
+    def certificate(self, item: dict):
+        """Load the certificate of an entry."""
+        from . import dependencies as d
+
+        with open(self.directory / CERTIFICATES, "rb") as certificates:
+            certificates.seek(item["der_offset"])
+            return d.x509.load_der_x509_certificate(
+                certificates.read(item["der_length"])
+            )
+
+    def by_serial(self, serial: int) -> list[dict]:
+        return self.read(self.indexes["serial"].lookup(serial.to_bytes(20, "big")))
+
+    def by_subject(self, subject: str) -> list[dict]:
+        return self.read(self.indexes["subject"].lookup(subject_key(subject)))
+
+    def expiring(self, after: datetime, before: datetime) -> list[dict]:
+        """Entries expiring between two dates, by expiry."""
+        return self.read(
+            self.indexes["expiry"].range(expiry_key(after), expiry_key(before))
+        )
+
+    def search(self, queries: list[list[str]]) -> list[dict]:
+        """Entries matching all the queries, each a list of alternative terms."""
+        offsets: typing.Optional[set[int]] = None
+        for query in queries:
+            found = set()
+            for term in query:
+                found.update(self.indexes["term"].lookup(term_key(term)))
+            offsets = found if offsets is None else offsets & found
+            if not offsets:
+                return []
+        return self.read(sorted(offsets or ()))
+
+    def renewed(self, item: dict) -> bool:
+        """Whether a certificate was issued again for the same subject and key.
+
+        Entries are appended, so a renewal is recorded after the certificate.
+        """
+        return any(
+            other["spki_sha256"] == item["spki_sha256"]
+            and other["issuer"] == item["issuer"]
+            and other["der_offset"] > item["der_offset"]
+            for other in self.by_subject(item["subject"])
+        )
+
+    def __iter__(self) -> typing.Iterator[dict]:
+        path = self.directory / LEDGER
+        if not path.exists():
+            return
+        with open(path, "rb") as ledger:
+            for line in ledger:
+                yield json.loads(line)
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            for index in self.indexes.values():
+                index.close()
+            self.lock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,361 @@
+import logging
+import mmap
+import os
+import struct
+import time
+import typing
+import click
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from .yubikey import click_pin, yubikey_one, YUBIKEY
+
+logger = logging.getLogger("offline-pki.ocsp")
+
+# Hash algorithms of the CertID of the requests answered, in the file order
+CERT_ID_HASHES = ("sha1", "sha256")
+# Header: magic, slot count, response count, this update, next update, and
+# the hashes of the issuer name and public key with each algorithm
+MAGIC = b"OCSPRSP2"
+HEADER = struct.Struct(">8sQQqq20s20s32s32s")
+# Slot: serial number, offset of the DER-encoded responses and length of the
+# response for each algorithm (0 if it was not signed)
+SLOT = struct.Struct(">20sQII")
+
+
+def slot_count(count: int) -> int:
+    """Power of two with a load factor of at most one half."""
+    slots = 1
+    while slots < 2 * count:
+        slots *= 2
+    return slots
+
+
+def slot_of(serial: bytes, slots: int) -> int:
+    # Serial numbers are random, so their low bits are used as hash
+    return int.from_bytes(serial[-8:], "big") & (slots - 1)
+
+
+def hash_algorithm(name: str):
+    from . import dependencies as d
+
+    return {"sha1": d.hashes.SHA1, "sha256": d.hashes.SHA256}[name]()
+
+
+def issuer_key_hash(public_key, algorithm: str = "sha1") -> bytes:
+    """Hash of the issuer public key, as in OCSP requests."""
+    from . import dependencies as d
+
+    h = d.hashes.Hash(hash_algorithm(algorithm))
+    h.update(
+        public_key.public_bytes(
+            d.serialization.Encoding.X962,
+            d.serialization.PublicFormat.UncompressedPoint,
+        )
+    )
+    return h.finalize()
+
+
+def issuer_name_hash(name, algorithm: str = "sha1") -> bytes:
+    from . import dependencies as d
+
+    h = d.hashes.Hash(hash_algorithm(algorithm))
+    h.update(name.public_bytes())
+    return h.finalize()
+
+
+def issuer_hashes(name, public_key) -> dict[str, tuple[bytes, bytes]]:
+    """Hashes of the issuer name and public key with each CertID algorithm."""
+    return {
+        algorithm: (
+            issuer_name_hash(name, algorithm),
+            issuer_key_hash(public_key, algorithm),
+        )
+        for algorithm in CERT_ID_HASHES
+    }
+
+
+class ResponseWriter:
+    """Write pre-signed OCSP responses to a file indexed by serial number.
+
+    The file starts with a header and an open addressing hash table of
+    fixed-size slots, followed by the responses. Responses are written as
+    they are added, and the table at the end, so only the slots are kept in
+    memory. The file is replaced atomically when closed.
+
+    Each certificate has a response for each hash algorithm of the CertID of
+    OCSP requests, as a response should use the same CertID as the request.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        count: int,
+        this_update: datetime,
+        next_update: datetime,
+        hashes: dict[str, tuple[bytes, bytes]],
+    ):
+        self.path = path
+        self.tmp = path.with_suffix(".tmp")
+        self.slots: list[typing.Optional[tuple[bytes, int, int, int]]] = [None] * (
+            slot_count(count)
+        )
+        self.header = HEADER.pack(
+            MAGIC,
+            len(self.slots),
+            count,
+            int(this_update.timestamp()),
+            int(next_update.timestamp()),
+            *(value for algorithm in CERT_ID_HASHES for value in hashes[algorithm]),
+        )
+        self.output = open(self.tmp, "wb")
+        self.offset = self.output.seek(HEADER.size + SLOT.size * len(self.slots))
+        self.count = 0
+
+    def add(self, serial: int, responses: dict[str, bytes]) -> None:
+        """Add the responses for a certificate, by CertID hash algorithm."""
+        key = serial.to_bytes(20, "big")
+        nb = slot_of(key, len(self.slots))
+        while self.slots[nb] is not None:
+            if self.slots[nb][0] == key:
+                raise RuntimeError(f"Duplicate response for {serial:x}")
+            nb = (nb + 1) % len(self.slots)
+        ordered = [responses.get(algorithm, b"") for algorithm in CERT_ID_HASHES]
+        self.slots[nb] = (key, self.offset, *(len(data) for data in ordered))
+        for data in ordered:
+            self.output.write(data)
+            self.offset += len(data)
+        self.count += 1
+
+    def close(self) -> None:
+        self.output.seek(0)
+        self.output.write(self.header)
+        empty = SLOT.pack(bytes(20), 0, 0, 0)
+        self.output.write(
+            b"".join(SLOT.pack(*slot) if slot else empty for slot in self.slots)
+        )
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        self.output.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self) -> None:
+        self.output.close()
+        self.tmp.unlink()
+
+
+class Responses:
+    """Read-only, memory-mapped pre-signed OCSP responses."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as responses:
+            self.inode = os.fstat(responses.fileno()).st_ino
+            self.map = mmap.mmap(responses.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, self.count, this_update, next_update, *hashes = (
+            HEADER.unpack_from(self.map)
+        )
+        if magic != MAGIC:
+            raise RuntimeError(f"{path} is not an OCSP responses file")
+        # Hashes of the issuer name and public key, by CertID hash algorithm
+        self.hashes = {
+            algorithm: (hashes[2 * nb], hashes[2 * nb + 1])
+            for nb, algorithm in enumerate(CERT_ID_HASHES)
+        }
+        self.this_update = datetime.fromtimestamp(this_update, timezone.utc)
+        self.next_update = datetime.fromtimestamp(next_update, timezone.utc)
+
+    def get(self, serial: int, algorithm: str = "sha1") -> typing.Optional[bytes]:
+        """Response for a certificate, with a CertID hashed with `algorithm`."""
+        try:
+            key = serial.to_bytes(20, "big")
+        except OverflowError:
+            return None
+        nb = slot_of(key, self.slots)
+        while True:
+            found, offset, *lengths = SLOT.unpack_from(
+                self.map, HEADER.size + SLOT.size * nb
+            )
+            if not any(lengths):
+                return None
+            if found == key:
+                for other, length in zip(CERT_ID_HASHES, lengths):
+                    if other == algorithm:
+                        return self.map[offset : offset + length] or None
+                    offset += length
+                return None
+            nb = (nb + 1) % self.slots
+
+    def changed(self) -> bool:
+        """Whether the file was replaced since it was opened."""
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return False
+
+    def close(self) -> None:
+        self.map.close()
+
+
+@click.group()
+def ocsp() -> None:
+    """Pre-signed OCSP responses."""
+
+
+@ocsp.command("sign")
+@click_pin(YUBIKEY.INTERMEDIATE)
+@click.option(
+    "--hours",
+    default=7 * 24,
+    help="Validity of the responses in hours",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--out-file",
+    required=True,
+    help="Output file for the responses",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+)
+@click.option(
+    "--cert-id-hash",
+    "algorithms",
+    multiple=True,
+    default=CERT_ID_HASHES,
+    help="Hash algorithm of the CertID of the requests to answer",
+    type=click.Choice(CERT_ID_HASHES),
+)
+def ocsp_sign(
+    pin: str, hours: int, out_file: Path, algorithms: tuple[str, ...]
+) -> None:
+    """Pre-sign OCSP responses for the valid certificates of the ledger.
+
+    A response is signed by the intermediate key for each certificate issued
+    by it and not expired, in a single session. The status of revoked
+    certificates comes from the revocation store. The responses are written
+    to a file indexed by serial number, to be served by `ocsp serve` or any
+    responder able to read it.
+
+    A request is answered with the same CertID hash algorithm, so a response
+    is signed for each algorithm given with --cert-id-hash (SHA-1 and SHA-256
+    by default).
+    """
+    from . import dependencies as d
+    from .cache import get_issuer
+    from .crl import RevocationStore
+    from .ledger import Ledger
+    from .signing import PivPrivateKey
+
+    with yubikey_one(YUBIKEY.INTERMEDIATE).open_connection(
+        d.SmartCardConnection
+    ) as conn:
+        piv = d.PivSession(conn)
+        issuer = get_issuer(piv)
+        if issuer.self_signed:
+            raise RuntimeError(
+                "The inserted key does not look like an intermediate YubiKey!"
+            )
+        name = issuer.subject.rfc4514_string()
+        this_update = datetime.now(timezone.utc)
+        next_update = this_update + timedelta(hours=hours)
+        revoked = {
+            int(item["serial"], 16): item for item in RevocationStore().revoked(name)
+        }
+        with Ledger() as ledger:
+            serials = [
+                int(item["serial"], 16)
+                for item in ledger
+                if item["issuer"] == name
+                and datetime.fromisoformat(item["not_after"]) > this_update
+            ]
+        if not serials:
+            raise RuntimeError(f"No valid certificate issued by {name}!")
+        click.confirm(
+            f"Sign {len(serials) * len(set(algorithms))} OCSP responses for "
+            f"{len(serials)} certificates?",
+            abort=True,
+        )
+
+        piv.verify_pin(pin)
+        signer = PivPrivateKey(
+            piv, key_type=issuer.key_type, public_key=issuer.public_key
+        )
+        hashes = issuer_hashes(issuer.subject, issuer.public_key)
+        writer = ResponseWriter(
+            out_file, len(serials), this_update, next_update, hashes
+        )
+        try:
+            start = time.perf_counter()
+            for serial in serials:
+                item = revoked.get(serial)
+                responses = {}
+                for algorithm in set(algorithms):
+                    name_hash, key_hash = hashes[algorithm]
+                    builder = d.ocsp.OCSPResponseBuilder().add_response_by_hash(
+                        issuer_name_hash=name_hash,
+                        issuer_key_hash=key_hash,
+                        serial_number=serial,
+                        algorithm=hash_algorithm(algorithm),
+                        cert_status=(
+                            d.ocsp.OCSPCertStatus.GOOD
+                            if item is None
+                            else d.ocsp.OCSPCertStatus.REVOKED
+                        ),
+                        this_update=this_update,
+                        next_update=next_update,
+                        revocation_time=(
+                            None
+                            if item is None
+                            else datetime.fromisoformat(item["date"])
+                        ),
+                        revocation_reason=(
+                            None if item is None else d.x509.ReasonFlags(item["reason"])
+                        ),
+                    )
+                    response = builder.responder_id(
+                        d.ocsp.OCSPResponderEncoding.HASH, issuer.certificate
+                    ).sign(signer, d.hashes.SHA384())
+                    responses[algorithm] = response.public_bytes(
+                        d.serialization.Encoding.DER
+                    )
+                writer.add(serial, responses)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"{writer.count} OCSP responses ({len(revoked)} revoked) signed in "
+        f"{elapsed:.1f}s and saved to {out_file}"
+    )
+
+
+@ocsp.command("serve")
+@click.option(
+    "--responses",
+    required=True,
+    help="File of pre-signed responses",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+)
+@click.option("--host", default="127.0.0.1", help="Address to listen on")
+@click.option(
+    "--port", default=8080, help="Port to listen on", type=click.IntRange(0, 65535)
+)
+def ocsp_serve(responses: Path, host: str, port: int) -> None:
+    """Serve pre-signed OCSP responses over HTTP.
+
+    Responses are looked up by serial number in the memory-mapped file, which
+    is reloaded when replaced by a new one.
+    """
+    from .responder import Responder
+
+    server = Responder((host, port), responses)
+    logger.info(
+        f"Serve {server.responses.count} OCSP responses valid until "
+        f"{server.responses.next_update.isoformat()} on {host}:{port}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
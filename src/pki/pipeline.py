@@ -0,0 +1,89 @@
+import logging
+import time
+import typing
+import contextlib
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+logger = logging.getLogger("offline-pki.pipeline")
+
+T = typing.TypeVar("T")
+U = typing.TypeVar("U")
+
+
+class Pipeline(typing.Generic[T, U]):
+    """Prepare items in a pool while the previous ones are consumed.
+
+    Items are prepared by up to `workers` threads (or processes, depending on
+    the executor) and returned in order. At most `depth` items are prepared in
+    advance: the input iterator is only consumed when there is room, providing
+    backpressure. `depth` can be changed while iterating, for example to hold
+    off preparation until the operator confirmed. The consumer should wrap its
+    own work with `stage()` to measure how busy it is.
+    """
+
+    def __init__(
+        self,
+        prepare: typing.Callable[[T], U],
+        items: typing.Iterable[T],
+        workers: int = 2,
+        depth: int = 8,
+        executor: typing.Callable[[int], Executor] = ThreadPoolExecutor,
+    ):
+        self.prepare = prepare
+        self.items = items
+        self.workers = workers
+        self.depth = max(depth, 1)
+        self.executor = executor
+        self.count = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.started: typing.Optional[float] = None
+        self.stopped: typing.Optional[float] = None
+
+    def __iter__(self) -> typing.Iterator[U]:
+        items = iter(self.items)
+        queue: deque = deque()
+        executor = self.executor(self.workers)
+        try:
+            while True:
+                while len(queue) < self.depth:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                    queue.append(executor.submit(self.prepare, item))
+                if not queue:
+                    return
+                future = queue.popleft()
+                start = time.perf_counter()
+                result = future.result()
+                if self.started is not None:
+                    self.waiting += time.perf_counter() - start
+                yield result
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @contextlib.contextmanager
+    def stage(self) -> typing.Iterator[None]:
+        """Account the time spent by the consumer on one item."""
+        start = time.perf_counter()
+        if self.started is None:
+            self.started = start
+        try:
+            yield
+        finally:
+            self.stopped = time.perf_counter()
+            self.busy += self.stopped - start
+            self.count += 1
+
+    def report(self, stage: str) -> None:
+        """Log how busy the consumer stage was."""
+        if self.started is None or self.stopped is None:
+            return
+        elapsed = self.stopped - self.started
+        logger.info(
+            f"{stage}: {self.count} items in {elapsed:.2f}s, "
+            f"busy {self.busy / elapsed * 100 if elapsed else 100:.0f}% of the time, "
+            f"{self.waiting:.2f}s waiting for preparation"
+        )
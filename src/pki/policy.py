@@ -0,0 +1,281 @@
+import ipaddress
+import logging
+import typing
+from pathlib import Path
+
+logger = logging.getLogger("offline-pki.policy")
+
+
+class PolicyError(ValueError):
+    pass
+
+
+class DnsTrie:
+    """DNS name constraints, as a trie of reversed labels.
+
+    As in RFC 5280, "example.com" matches the name and all its subdomains,
+    while ".example.com" only matches the subdomains.
+    """
+
+    def __init__(self):
+        self.root: dict = {}
+
+    def add(self, constraint: str) -> None:
+        subdomains = constraint.startswith(".")
+        node = self.root
+        for label in reversed(constraint.lower().strip(".").split(".")):
+            node = node.setdefault(label, {})
+        # None is not a label, so it marks the end of a constraint
+        node[None] = node.get(None, True) and subdomains
+
+    def match(self, name: str) -> bool:
+        node = self.root
+        for label in reversed(name.lower().rstrip(".").split(".")):
+            # A constraint ends here, and the name is in one of its subdomains
+            if None in node:
+                return True
+            node = node.get(label)
+            if node is None:
+                return False
+        return node.get(None) is False
+
+    def intersects(self, name: str) -> bool:
+        """Whether some of the names covered by a wildcard name match.
+
+        "*.example.com" intersects any constraint in "example.com", such as
+        "bad.example.com". Other names are matched as with `match()`.
+        """
+        if not name.startswith("*."):
+            return self.match(name)
+        node = self.root
+        for label in reversed(name[2:].lower().rstrip(".").split(".")):
+            if None in node:
+                return True
+            node = node.get(label)
+            if node is None:
+                return False
+        return bool(node)
+
+    def __bool__(self) -> bool:
+        return bool(self.root)
+
+
+class IpRadix:
+    """IP address constraints, as a binary trie of network prefixes."""
+
+    def __init__(self):
+        self.roots: dict[int, list] = {}
+
+    def add(self, network) -> None:
+        # A node is [child 0, child 1, whether a network ends here]
+        node = self.roots.setdefault(network.version, [None, None, False])
+        bits = int(network.network_address)
+        for nb in range(network.prefixlen):
+            bit = (bits >> (network.max_prefixlen - 1 - nb)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        node[2] = True
+
+    def match(self, address) -> bool:
+        if isinstance(address, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            address = address.network_address
+        node = self.roots.get(address.version)
+        bits = int(address)
+        for nb in range(address.max_prefixlen):
+            if node is None:
+                return False
+            if node[2]:
+                return True
+            node = node[(bits >> (address.max_prefixlen - 1 - nb)) & 1]
+        return node is not None and node[2]
+
+    def __bool__(self) -> bool:
+        return bool(self.roots)
+
+
+class EmailMap:
+    """Email constraints: mailboxes, hosts, and domains with a leading dot.
+
+    A host with a leading "@" is also accepted, as it is a common mistake.
+    """
+
+    def __init__(self):
+        self.mailboxes: set[str] = set()
+        self.hosts: set[str] = set()
+        self.domains = DnsTrie()
+
+    def add(self, constraint: str) -> None:
+        constraint = constraint.lower().removeprefix("@")
+        if "@" in constraint:
+            self.mailboxes.add(constraint)
+        elif constraint.startswith("."):
+            self.domains.add(constraint)
+        else:
+            self.hosts.add(constraint)
+
+    def match(self, address: str) -> bool:
+        address = address.lower()
+        host = address.rsplit("@", 1)[-1]
+        return (
+            address in self.mailboxes or host in self.hosts or self.domains.match(host)
+        )
+
+    def __bool__(self) -> bool:
+        return bool(self.mailboxes or self.hosts or self.domains)
+
+
+class DirectoryNames:
+    """Directory name constraints, matched by RDN prefix."""
+
+    def __init__(self):
+        self.names: list[tuple] = []
+
+    def add(self, name) -> None:
+        self.names.append(tuple(name.rdns))
+
+    def match(self, name) -> bool:
+        rdns = tuple(name.rdns)
+        return any(rdns[: len(prefix)] == prefix for prefix in self.names)
+
+    def __bool__(self) -> bool:
+        return bool(self.names)
+
+
+class Subtrees:
+    """Compiled subtrees of a name constraints extension."""
+
+    def __init__(self, subtrees: typing.Iterable):
+        from . import dependencies as d
+
+        self.dns = DnsTrie()
+        self.ip = IpRadix()
+        self.email = EmailMap()
+        self.dn = DirectoryNames()
+        for name in subtrees or ():
+            if isinstance(name, d.x509.DNSName):
+                self.dns.add(name.value)
+            elif isinstance(name, d.x509.IPAddress):
+                self.ip.add(name.value)
+            elif isinstance(name, d.x509.RFC822Name):
+                self.email.add(name.value)
+            elif isinstance(name, d.x509.DirectoryName):
+                self.dn.add(name.value)
+            else:
+                logger.warning(f"Ignore unsupported name constraint {name}")
+
+    def matcher(self, kind: str):
+        return getattr(self, kind)
+
+
+class NameConstraintsPolicy:
+    """Check the names of certificates against name constraints.
+
+    Each name of a type with permitted subtrees should match one of them, and
+    no name should match an excluded subtree. The names are the subject, its
+    email addresses, and the subject alternative names.
+    """
+
+    def __init__(self, constraints, source: str):
+        self.source = source
+        self.permitted = Subtrees(constraints.permitted_subtrees)
+        self.excluded = Subtrees(constraints.excluded_subtrees)
+
+    def check(self, names: list[tuple[str, typing.Any]]) -> None:
+        for kind, name in names:
+            value = name.rfc4514_string() if kind == "dn" else name
+            excluded = self.excluded.matcher(kind)
+            # A wildcard is excluded as soon as one of its names is
+            if excluded.intersects(name) if kind == "dns" else excluded.match(name):
+                raise PolicyError(f"{value} is excluded by {self.source}")
+            permitted = self.permitted.matcher(kind)
+            if permitted and not permitted.match(name):
+                raise PolicyError(f"{value} is not permitted by {self.source}")
+
+
+def certificate_names(subject, extensions) -> list[tuple[str, typing.Any]]:
+    """Names of a certificate subject to name constraints, with their type."""
+    from . import dependencies as d
+
+    names: list[tuple[str, typing.Any]] = [("dn", subject)] if subject.rdns else []
+    names += [
+        ("email", attribute.value)
+        for attribute in subject.get_attributes_for_oid(d.NameOID.EMAIL_ADDRESS)
+    ]
+    try:
+        sans = extensions.get_extension_for_class(d.x509.SubjectAlternativeName).value
+    except d.x509.ExtensionNotFound:
+        return names
+    for name in sans:
+        if isinstance(name, d.x509.DNSName):
+            names.append(("dns", name.value))
+        elif isinstance(name, d.x509.IPAddress):
+            names.append(("ip", name.value))
+        elif isinstance(name, d.x509.RFC822Name):
+            names.append(("email", name.value))
+        elif isinstance(name, d.x509.DirectoryName):
+            names.append(("dn", name.value))
+    return names
+
+
+class Policy:
+    """Pre-sign checks of the certificates issued by a CA.
+
+    The name constraints of the CA certificate and of its issuers are compiled
+    once, so checking a certificate is linear in the length of its names.
+    """
+
+    def __init__(self, certificates: typing.Iterable):
+        from . import dependencies as d
+
+        self.constraints = []
+        for certificate in certificates:
+            try:
+                constraints = certificate.extensions.get_extension_for_class(
+                    d.x509.NameConstraints
+                ).value
+            except d.x509.ExtensionNotFound:
+                continue
+            source = certificate.subject.rfc4514_string()
+            logger.debug(f"Name constraints of {source} loaded")
+            self.constraints.append(NameConstraintsPolicy(constraints, source))
+
+    def check(self, subject, extensions) -> None:
+        """Raise `PolicyError` if the certificate should not be issued."""
+        if not self.constraints:
+            return
+        names = certificate_names(subject, extensions)
+        for constraints in self.constraints:
+            constraints.check(names)
+
+
+def load_policy(issuer, root_cert: typing.Optional[Path] = None) -> Policy:
+    """Load the policy of an intermediate CA and its root.
+
+    The root certificate is read from `root_cert`, or found in the certificate
+    cache: it is there once the root YubiKey has been used on this machine.
+    """
+    from . import dependencies as d
+    from .cache import cache_dir
+
+    certificates = [issuer.certificate]
+    if root_cert is not None:
+        paths = [root_cert]
+    else:
+        paths = sorted(cache_dir().glob("*.pem"))
+    for path in paths:
+        try:
+            certificate = d.x509.load_pem_x509_certificate(path.read_bytes())
+            issuer.certificate.verify_directly_issued_by(certificate)
+        except (ValueError, TypeError, d.InvalidSignature):
+            continue
+        certificates.append(certificate)
+        break
+    else:
+        if root_cert is not None:
+            raise RuntimeError(f"{root_cert} is not the issuer of {issuer.subject}")
+        logger.warning(
+            "Root certificate not found in the cache, only the name constraints "
+            "of the intermediate certificate are checked"
+        )
+    return Policy(certificates)
@@ -0,0 +1,203 @@
+import logging
+import os
+import tomllib
+import typing
+import click
+from pathlib import Path
+
+logger = logging.getLogger("offline-pki.profile")
+
+PROFILES = "profiles.toml"
+
+KEY_USAGES = (
+    "digital_signature",
+    "content_commitment",
+    "key_encipherment",
+    "data_encipherment",
+    "key_agreement",
+    "key_cert_sign",
+    "crl_sign",
+    "encipher_only",
+    "decipher_only",
+)
+
+CA_KEY_USAGE = ["digital_signature", "key_cert_sign", "crl_sign"]
+
+# Built-in profiles, the configuration file can change or add profiles
+DEFAULT_PROFILES: dict[str, dict[str, typing.Any]] = {
+    "root": {
+        "days": 365 * 20,
+        "ca": True,
+        "key_usage": CA_KEY_USAGE,
+        "subject_key_identifier": False,
+    },
+    "sub-ca": {
+        "days": 365 * 4,
+        "ca": True,
+        "key_usage": CA_KEY_USAGE,
+        "subject_key_identifier": False,
+    },
+    "server": {
+        "days": 365,
+        "key_usage": ["digital_signature", "key_encipherment"],
+        "extended_key_usage": ["server_auth"],
+    },
+    "client": {
+        "days": 365,
+        "key_usage": ["digital_signature"],
+        "extended_key_usage": ["client_auth"],
+    },
+    "short-lived": {
+        "days": 7,
+        "key_usage": ["digital_signature"],
+        "extended_key_usage": ["server_auth", "client_auth"],
+    },
+}
+
+OPTIONS: dict[str, typing.Any] = {
+    "days": 365,
+    "ca": False,
+    "path_length": None,
+    "key_usage": [],
+    "extended_key_usage": [],
+    "subject_key_identifier": True,
+    "copy_extensions": ["subject_alternative_name"],
+}
+
+
+def profiles_path() -> Path:
+    path = os.environ.get("OFFLINE_PKI_PROFILES")
+    if path:
+        return Path(path)
+    return Path(click.get_app_dir("offline-pki")) / PROFILES
+
+
+def extension_oid(name: str):
+    from . import dependencies as d
+
+    oid = getattr(d.x509.oid.ExtensionOID, name.upper(), None)
+    if not isinstance(oid, d.x509.ObjectIdentifier):
+        raise ValueError(f"unknown extension {name}")
+    return oid
+
+
+def extended_key_usage_oid(name: str):
+    from . import dependencies as d
+
+    if name[:1].isdigit():
+        return d.x509.ObjectIdentifier(name)
+    oid = getattr(d.x509.oid.ExtendedKeyUsageOID, name.upper(), None)
+    if not isinstance(oid, d.x509.ObjectIdentifier):
+        raise ValueError(f"unknown extended key usage {name}")
+    return oid
+
+
+class Profile:
+    """Certificate profile, validated and compiled once for a batch.
+
+    The static extensions, including the authority key identifier if provided,
+    are encoded when the profile is loaded and added as is to each
+    certificate. Only the subject key identifier and the extensions copied
+    from the CSR are built for each certificate.
+    """
+
+    def __init__(self, name: str, options: dict, authority_key_identifier=None) -> None:
+        from . import dependencies as d
+
+        unknown = set(options) - set(OPTIONS)
+        if unknown:
+            raise ValueError(f"unknown options {', '.join(sorted(unknown))}")
+        options = {**OPTIONS, **options}
+        self.name = name
+        self.days = options["days"]
+        if not isinstance(self.days, int) or self.days < 1:
+            raise ValueError("days should be a positive integer")
+        self.subject_key_identifier = bool(options["subject_key_identifier"])
+        self.copy = {extension_oid(name) for name in options["copy_extensions"]}
+
+        extensions: list[tuple[typing.Any, bool]] = [
+            (
+                d.x509.BasicConstraints(
+                    ca=bool(options["ca"]), path_length=options["path_length"]
+                ),
+                True,
+            )
+        ]
+        if options["key_usage"]:
+            unknown = set(options["key_usage"]) - set(KEY_USAGES)
+            if unknown:
+                raise ValueError(f"unknown key usages {', '.join(sorted(unknown))}")
+            extensions.append(
+                (
+                    d.x509.KeyUsage(
+                        **{usage: usage in options["key_usage"] for usage in KEY_USAGES}
+                    ),
+                    True,
+                )
+            )
+        if options["extended_key_usage"]:
+            extensions.append(
+                (
+                    d.x509.ExtendedKeyUsage(
+                        [
+                            extended_key_usage_oid(usage)
+                            for usage in options["extended_key_usage"]
+                        ]
+                    ),
+                    False,
+                )
+            )
+        if authority_key_identifier is not None:
+            extensions.append((authority_key_identifier, False))
+        self.static = [
+            (d.x509.UnrecognizedExtension(value.oid, value.public_bytes()), critical)
+            for value, critical in extensions
+        ]
+        self.oids = {extension.oid for extension, _ in self.static}
+
+    def extensions(self, public_key, csr_extensions=()) -> list[tuple]:
+        """Extensions of a certificate, with the allowed CSR extensions."""
+        from . import dependencies as d
+
+        result = list(self.static)
+        if self.subject_key_identifier:
+            result.append(
+                (d.x509.SubjectKeyIdentifier.from_public_key(public_key), False)
+            )
+        for extension in csr_extensions:
+            if extension.oid in self.copy and extension.oid not in self.oids:
+                result.append((extension.value, extension.critical))
+            else:
+                logger.debug(f"Ignore extension {extension.oid.dotted_string} of CSR")
+        return result
+
+
+def load_profiles(path: typing.Optional[Path] = None) -> dict[str, dict]:
+    """Options of the profiles, the built-in ones updated by the file."""
+    path = path or profiles_path()
+    profiles = {name: dict(options) for name, options in DEFAULT_PROFILES.items()}
+    if not path.exists():
+        return profiles
+    try:
+        with open(path, "rb") as config:
+            data = tomllib.load(config)
+    except tomllib.TOMLDecodeError as e:
+        raise RuntimeError(f"Invalid profiles file {path}: {e}")
+    for name, options in data.items():
+        if not isinstance(options, dict):
+            raise RuntimeError(f"Invalid profile {name} in {path}")
+        profiles.setdefault(name, {}).update(options)
+    return profiles
+
+
+def load_profile(name: str, authority_key_identifier=None) -> Profile:
+    """Load, check and compile a profile."""
+    profiles = load_profiles()
+    if name not in profiles:
+        raise RuntimeError(
+            f"Unknown profile {name}, available: {', '.join(sorted(profiles))}"
+        )
+    try:
+        return Profile(name, profiles[name], authority_key_identifier)
+    except (ValueError, TypeError) as e:
+        raise RuntimeError(f"Invalid profile {name}: {e}")
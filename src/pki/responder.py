@@ -0,0 +1,97 @@
+import http.server
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+
+from .ocsp import Responses
+
+logger = logging.getLogger("offline-pki.responder")
+
+# Larger POST requests are rejected without being read
+MAX_REQUEST = 64 * 1024
+
+
+class ResponderHandler(http.server.BaseHTTPRequestHandler):
+    """Answer OCSP requests, with POST or GET, from pre-signed responses."""
+
+    server: "Responder"
+
+    def do_GET(self) -> None:
+        import base64
+        import urllib.parse
+
+        # The request is the whole path, as base64 may contain "/"
+        try:
+            request = base64.b64decode(
+                urllib.parse.unquote(self.path.split("/", 1)[-1]), validate=True
+            )
+        except ValueError:
+            # An empty request is malformed
+            request = b""
+        self.answer(request)
+
+    def do_POST(self) -> None:
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if 0 <= length <= MAX_REQUEST:
+            self.answer(self.rfile.read(length))
+        else:
+            self.close_connection = True
+            self.answer(b"")
+
+    def answer(self, data: bytes) -> None:
+        from . import dependencies as d
+
+        responses = self.server.current()
+        try:
+            request = d.ocsp.load_der_ocsp_request(data)
+        except ValueError:
+            response = d.ocsp.OCSPResponseBuilder.build_unsuccessful(
+                d.ocsp.OCSPResponseStatus.MALFORMED_REQUEST
+            ).public_bytes(d.serialization.Encoding.DER)
+        else:
+            # Only requests for the certificates of the issuer are answered,
+            # with a CertID hashed with the same algorithm as the request.
+            try:
+                algorithm = request.hash_algorithm.name
+            except d.UnsupportedAlgorithm:
+                algorithm = None
+            response = None
+            if responses.hashes.get(algorithm) == (
+                request.issuer_name_hash,
+                request.issuer_key_hash,
+            ):
+                response = responses.get(request.serial_number, algorithm)
+            if response is None:
+                response = d.ocsp.OCSPResponseBuilder.build_unsuccessful(
+                    d.ocsp.OCSPResponseStatus.UNAUTHORIZED
+                ).public_bytes(d.serialization.Encoding.DER)
+        max_age = (responses.next_update - datetime.now(timezone.utc)).total_seconds()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/ocsp-response")
+        self.send_header("Content-Length", str(len(response)))
+        self.send_header("Cache-Control", f"max-age={max(int(max_age), 0)}")
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class Responder(http.server.ThreadingHTTPServer):
+    """HTTP OCSP responder, reloading the responses file when replaced."""
+
+    def __init__(self, address: tuple[str, int], path: Path):
+        super().__init__(address, ResponderHandler)
+        self.path = path
+        self.responses = Responses(path)
+
+    def current(self) -> Responses:
+        if self.responses.changed():
+            logger.info(f"Reload OCSP responses from {self.path}")
+            # The previous mapping is left to the garbage collector, as
+            # other threads may still be reading it.
+            self.responses = Responses(self.path)
+        return self.responses
@@ -0,0 +1,83 @@
+import logging
+import shlex
+import threading
+import click
+
+logger = logging.getLogger("offline-pki.shell")
+
+PROMPT = "offline-pki> "
+
+
+def warm_up() -> None:
+    """Import the dependencies while the operator types the first command."""
+    from . import dependencies  # noqa: F401
+
+
+def run(ctx: click.Context, args: list[str]) -> None:
+    """Run a command line as a subcommand of the main group."""
+    from .yubikey import roles
+
+    group = ctx.parent.command
+    name, command, args = group.resolve_command(ctx.parent, args)
+    if command is ctx.command:
+        raise click.UsageError("Already in the shell")
+    # As in a new process, a YubiKey may be used for another role
+    roles.clear()
+    with command.make_context(name, args, parent=ctx.parent) as sub:
+        command.invoke(sub)
+
+
+@click.command("shell")
+@click.pass_context
+def shell(ctx: click.Context) -> None:
+    """Run several commands in a single process.
+
+    Commands are typed without the program name, such as `yubikey info` or
+    `certificate sign --csr-file request.pem`. The dependencies are only
+    imported once, and the plugged YubiKeys are only listed again when one is
+    plugged or unplugged. Type `help` for the list of commands, and `exit` or
+    Ctrl-D to quit.
+    """
+    from .yubikey import cached_devices
+
+    try:
+        # Line editing and history
+        import readline  # noqa: F401
+    except ImportError:
+        pass
+
+    threading.Thread(target=warm_up, daemon=True).start()
+    with cached_devices():
+        while True:
+            try:
+                line = input(PROMPT)
+            except EOFError:
+                click.echo()
+                break
+            except KeyboardInterrupt:
+                click.echo()
+                continue
+            try:
+                args = shlex.split(line)
+            except ValueError as e:
+                logger.error(f"Invalid command line: {e}")
+                continue
+            if not args:
+                continue
+            if args[0] in ("exit", "quit"):
+                break
+            if args[0] == "help":
+                click.echo(ctx.parent.get_help())
+                continue
+            try:
+                run(ctx, args)
+            except click.exceptions.Exit:
+                pass
+            except click.ClickException as e:
+                e.show()
+            except click.Abort:
+                click.echo("Aborted!", err=True)
+            except KeyboardInterrupt:
+                click.echo("Interrupted!", err=True)
+            except Exception as e:
+                logger.exception("%s", e)
@@ -0,0 +1,109 @@
+import logging
+import typing
+
+from .dependencies import (
+    KEY_TYPE,
+    SLOT,
+    PivSession,
+    Prehashed,
+    ec,
+    hashes,
+    serialization,
+    x509,
+)
+
+logger = logging.getLogger("offline-pki.signing")
+
+CURVES = {
+    KEY_TYPE.ECCP256: ec.SECP256R1,
+    KEY_TYPE.ECCP384: ec.SECP384R1,
+}
+
+
+class PivPrivateKey(ec.EllipticCurvePrivateKey):
+    """EC private key stored in a PIV slot.
+
+    This can be used directly with cryptography builders: the TBS structure is
+    encoded once, hashed on the host and only the digest is sent to the
+    YubiKey. Only signing is supported and the PIN should have been verified
+    before.
+    """
+
+    def __init__(
+        self,
+        piv: PivSession,
+        slot: SLOT = SLOT.SIGNATURE,
+        key_type: KEY_TYPE = KEY_TYPE.ECCP384,
+        public_key: typing.Optional[ec.EllipticCurvePublicKey] = None,
+    ):
+        if key_type not in CURVES:
+            raise ValueError(f"Unsupported key type {key_type}")
+        self._piv = piv
+        self._slot = slot
+        self._key_type = key_type
+        self._public_key = public_key
+
+    @property
+    def curve(self) -> ec.EllipticCurve:
+        return CURVES[self._key_type]()
+
+    @property
+    def key_size(self) -> int:
+        return self.curve.key_size
+
+    def public_key(self) -> ec.EllipticCurvePublicKey:
+        if self._public_key is None:
+            self._public_key = self._piv.get_slot_metadata(self._slot).public_key
+        return self._public_key
+
+    def sign(
+        self,
+        data: bytes,
+        signature_algorithm: ec.EllipticCurveSignatureAlgorithm,
+    ) -> bytes:
+        if not isinstance(signature_algorithm, ec.ECDSA):
+            raise ValueError(f"Unsupported signature algorithm {signature_algorithm}")
+        algorithm = signature_algorithm.algorithm
+        if isinstance(algorithm, Prehashed):
+            digest = data
+        else:
+            h = hashes.Hash(algorithm)
+            h.update(data)
+            digest = h.finalize()
+            algorithm = Prehashed(algorithm)
+        logger.debug(f"Sign {len(digest)}-byte digest with slot {self._slot}")
+        return self._piv.sign(self._slot, self._key_type, digest, algorithm)
+
+    def exchange(self, algorithm, peer_public_key) -> bytes:
+        raise NotImplementedError("Key exchange is not supported")
+
+    def private_numbers(self) -> ec.EllipticCurvePrivateNumbers:
+        raise NotImplementedError("Private key is not exportable")
+
+    def private_bytes(
+        self,
+        encoding: serialization.Encoding,
+        format: serialization.PrivateFormat,
+        encryption_algorithm: serialization.KeySerializationEncryption,
+    ) -> bytes:
+        raise NotImplementedError("Private key is not exportable")
+
+    def __copy__(self) -> "PivPrivateKey":
+        return self
+
+    def __deepcopy__(self, memo) -> "PivPrivateKey":
+        return self
+
+
+def sign_certificate_builder(
+    piv: PivSession,
+    builder: x509.CertificateBuilder,
+    slot: SLOT = SLOT.SIGNATURE,
+    key_type: KEY_TYPE = KEY_TYPE.ECCP384,
+    hash_algorithm: typing.Type[hashes.HashAlgorithm] = hashes.SHA384,
+    public_key: typing.Optional[ec.EllipticCurvePublicKey] = None,
+) -> x509.Certificate:
+    """Sign a certificate builder with the key in the provided slot."""
+    return builder.sign(
+        PivPrivateKey(piv, slot, key_type, public_key), hash_algorithm()
+    )
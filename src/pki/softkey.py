@@ -0,0 +1,448 @@
+import json
+import logging
+import os
+import struct
+import time
+import typing
+from pathlib import Path
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from yubikit.core import TRANSPORT, Tlv, Version, YubiKeyDevice
+from yubikit.core.smartcard import AID, SW, SmartCardConnection
+from yubikit.management import CAPABILITY, FORM_FACTOR, DeviceInfo
+from yubikit.piv import KEY_TYPE, MANAGEMENT_KEY_TYPE, PIN_POLICY, TOUCH_POLICY
+
+logger = logging.getLogger("offline-pki.softkey")
+
+VERSION = Version(5, 7, 1)
+DEFAULT_PIN = b"123456"
+DEFAULT_PUK = b"12345678"
+DEFAULT_MANAGEMENT = bytes.fromhex("010203040506070801020304050607080102030405060708")
+PIN_ATTEMPTS = 3
+MAX_RESPONSE = 0x100
+REBOOT_DELAY = 0.2
+
+SLOT_CARD_MANAGEMENT = 0x9B
+PIN_P2 = 0x80
+PUK_P2 = 0x81
+
+CURVES = {
+    KEY_TYPE.ECCP256: (ec.SECP256R1, hashes.SHA256),
+    KEY_TYPE.ECCP384: (ec.SECP384R1, hashes.SHA384),
+}
+
+
+class SoftKeyError(Exception):
+    """Error returned as a status word."""
+
+    def __init__(self, sw: int):
+        self.sw = sw
+
+
+def _pin(data: bytes) -> bytes:
+    return data.rstrip(b"\xff")
+
+
+class SoftKey:
+    """File-backed state of a software YubiKey.
+
+    Only the parts of the PIV and management applications used by this program
+    are implemented. Only EC keys and AES management keys are supported.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        state = json.loads(path.read_text())
+        self.serial: int = state["serial"]
+        self.rebooting_until: float = state.get("rebooting_until", 0)
+        self.capabilities: int = state.get("capabilities", int(CAPABILITY(0x3F)))
+        self.pin = bytes.fromhex(state.get("pin", DEFAULT_PIN.hex()))
+        self.puk = bytes.fromhex(state.get("puk", DEFAULT_PUK.hex()))
+        self.pin_retries: int = state.get("pin_retries", PIN_ATTEMPTS)
+        self.puk_retries: int = state.get("puk_retries", PIN_ATTEMPTS)
+        self.management_key = bytes.fromhex(
+            state.get("management_key", DEFAULT_MANAGEMENT.hex())
+        )
+        self.management_key_type = MANAGEMENT_KEY_TYPE(
+            state.get("management_key_type", MANAGEMENT_KEY_TYPE.AES192)
+        )
+        self.keys: dict[int, dict] = {
+            int(slot): key for slot, key in state.get("keys", {}).items()
+        }
+        self.objects: dict[int, bytes] = {
+            int(oid): bytes.fromhex(data)
+            for oid, data in state.get("objects", {}).items()
+        }
+
+    @classmethod
+    def create(cls, directory: Path, serial: int) -> "SoftKey":
+        """Create a new software YubiKey in the provided directory."""
+        path = directory / f"{serial}.json"
+        path.write_text(json.dumps({"serial": serial}))
+        return cls(path)
+
+    def save(self) -> None:
+        state = {
+            "serial": self.serial,
+            "rebooting_until": self.rebooting_until,
+            "capabilities": self.capabilities,
+            "pin": self.pin.hex(),
+            "puk": self.puk.hex(),
+            "pin_retries": self.pin_retries,
+            "puk_retries": self.puk_retries,
+            "management_key": self.management_key.hex(),
+            "management_key_type": int(self.management_key_type),
+            "keys": {str(slot): key for slot, key in self.keys.items()},
+            "objects": {str(oid): data.hex() for oid, data in self.objects.items()},
+        }
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state))
+        os.replace(tmp, self.path)
+
+    def reset(self) -> None:
+        self.pin = DEFAULT_PIN
+        self.puk = DEFAULT_PUK
+        self.pin_retries = PIN_ATTEMPTS
+        self.puk_retries = PIN_ATTEMPTS
+        self.management_key = DEFAULT_MANAGEMENT
+        self.management_key_type = MANAGEMENT_KEY_TYPE.AES192
+        self.keys = {}
+        self.objects = {}
+
+    def device_info(self) -> bytes:
+        return (
+            Tlv(0x01, struct.pack(">H", 0x3F))
+            + Tlv(0x02, struct.pack(">I", self.serial))
+            + Tlv(0x03, struct.pack(">H", self.capabilities))
+            + Tlv(0x04, bytes([FORM_FACTOR.USB_A_KEYCHAIN]))
+            + Tlv(0x05, bytes(VERSION))
+        )
+
+    def private_key(self, slot: int) -> ec.EllipticCurvePrivateKey:
+        key = serialization.load_pem_private_key(
+            self.keys[slot]["private"].encode("ascii"), None
+        )
+        assert isinstance(key, ec.EllipticCurvePrivateKey)  # noqa: S101
+        return key
+
+    def store_key(
+        self,
+        slot: int,
+        key_type: KEY_TYPE,
+        private_key: ec.EllipticCurvePrivateKey,
+        policies: dict[int, bytes],
+        generated: bool,
+    ) -> None:
+        self.keys[slot] = {
+            "type": int(key_type),
+            "private": private_key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            ).decode("ascii"),
+            "pin_policy": policies.get(0xAA, bytes([PIN_POLICY.ONCE]))[0],
+            "touch_policy": policies.get(0xAB, bytes([TOUCH_POLICY.NEVER]))[0],
+            "generated": generated,
+        }
+
+
+class SoftConnection(SmartCardConnection):
+    """Smart card connection to a software YubiKey.
+
+    APDU are decoded and handled in software, after waiting for the configured
+    latency. The total number of APDU exchanged is kept in `apdus`.
+    """
+
+    apdus = 0
+
+    def __init__(self, key: SoftKey, latency: float):
+        self.key = key
+        self.latency = latency
+        self.application: typing.Optional[bytes] = None
+        self.authenticated = False
+        self.pin_verified = False
+        self.witness: typing.Optional[bytes] = None
+        self.chained = b""
+        self.remaining = b""
+        self.dirty = False
+
+    @property
+    def transport(self) -> TRANSPORT:
+        return TRANSPORT.USB
+
+    def close(self) -> None:
+        if self.dirty:
+            self.key.save()
+            self.dirty = False
+
+    def send_and_receive(self, apdu: bytes) -> tuple[bytes, int]:
+        SoftConnection.apdus += 1
+        if self.latency:
+            time.sleep(self.latency)
+        cla, ins, p1, p2 = apdu[:4]
+        body = apdu[4:]
+        if len(body) > 3 and body[0] == 0:
+            # Extended APDU
+            (lc,) = struct.unpack(">H", body[1:3])
+            data = body[3 : 3 + lc]
+        elif len(body) > 1:
+            data = body[1 : 1 + body[0]]
+        else:
+            data = b""
+        if ins == 0xC0:
+            return self._respond(self.remaining)
+        if cla & 0x10:
+            self.chained += data
+            return b"", SW.OK
+        data, self.chained = self.chained + data, b""
+        try:
+            return self._respond(self._dispatch(ins, p1, p2, data))
+        except SoftKeyError as e:
+            return b"", e.sw
+
+    def _respond(self, response: bytes) -> tuple[bytes, int]:
+        response, self.remaining = response[:MAX_RESPONSE], response[MAX_RESPONSE:]
+        if self.remaining:
+            return response, 0x6100 | min(len(self.remaining), 0xFF)
+        return response, SW.OK
+
+    def _dispatch(self, ins: int, p1: int, p2: int, data: bytes) -> bytes:
+        if ins == 0xA4:
+            if AID.PIV.startswith(data) or data.startswith(AID.PIV):
+                self.application = AID.PIV
+                self.authenticated = self.pin_verified = False
+                return b""
+            if data == AID.MANAGEMENT:
+                self.application = AID.MANAGEMENT
+                return f"Virtual mgr - FW version {VERSION}".encode("ascii")
+            raise SoftKeyError(SW.FILE_NOT_FOUND)
+        if self.application == AID.PIV:
+            return self._piv(ins, p1, p2, data)
+        if self.application == AID.MANAGEMENT:
+            return self._management(ins, p1, p2, data)
+        raise SoftKeyError(SW.CONDITIONS_NOT_SATISFIED)
+
+    def _management(self, ins: int, p1: int, p2: int, data: bytes) -> bytes:
+        if ins == 0x1D:
+            tlvs = self.key.device_info()
+            return bytes([len(tlvs)]) + tlvs
+        if ins == 0x1C:
+            config = Tlv.parse_dict(data[1:])
+            if 0x03 in config:
+                self.key.capabilities = int.from_bytes(config[0x03], "big")
+                self.dirty = True
+            if 0x0C in config:
+                self.key.rebooting_until = time.time() + REBOOT_DELAY
+                self.dirty = True
+            return b""
+        raise SoftKeyError(SW.INVALID_INSTRUCTION)
+
+    def _check_pin(self, p2: int, value: bytes) -> None:
+        attribute = "pin" if p2 == PIN_P2 else "puk"
+        retries = getattr(self.key, f"{attribute}_retries")
+        if retries == 0:
+            raise SoftKeyError(SW.AUTH_METHOD_BLOCKED)
+        if _pin(value) != getattr(self.key, attribute):
+            setattr(self.key, f"{attribute}_retries", retries - 1)
+            self.dirty = True
+            raise SoftKeyError(0x63C0 | (retries - 1))
+        if retries != PIN_ATTEMPTS:
+            setattr(self.key, f"{attribute}_retries", PIN_ATTEMPTS)
+            self.dirty = True
+
+    def _require_authentication(self) -> None:
+        if not self.authenticated:
+            raise SoftKeyError(SW.SECURITY_CONDITION_NOT_SATISFIED)
+        self.dirty = True
+
+    def _management_cipher(self) -> Cipher:
+        return Cipher(
+            algorithms.AES(self.key.management_key), modes.ECB()
+        )  # noqa: S305
+
+    def _piv(self, ins: int, p1: int, p2: int, data: bytes) -> bytes:
+        key = self.key
+        if ins == 0xFD:
+            return bytes(VERSION)
+        if ins == 0xF8:
+            return struct.pack(">I", key.serial)
+        if ins == 0xF7:
+            if p2 == SLOT_CARD_MANAGEMENT:
+                return (
+                    Tlv(0x01, bytes([key.management_key_type]))
+                    + Tlv(0x02, bytes([0, TOUCH_POLICY.NEVER]))
+                    + Tlv(0x05, bytes([key.management_key == DEFAULT_MANAGEMENT]))
+                )
+            if p2 in (PIN_P2, PUK_P2):
+                value, retries, default = (
+                    (key.pin, key.pin_retries, DEFAULT_PIN)
+                    if p2 == PIN_P2
+                    else (key.puk, key.puk_retries, DEFAULT_PUK)
+                )
+                return Tlv(0x05, bytes([value == default])) + Tlv(
+                    0x06, bytes([PIN_ATTEMPTS, retries])
+                )
+            if p2 not in key.keys:
+                raise SoftKeyError(SW.REFERENCE_DATA_NOT_FOUND)
+            slot = key.keys[p2]
+            point = (
+                key.private_key(p2)
+                .public_key()
+                .public_bytes(
+                    serialization.Encoding.X962,
+                    serialization.PublicFormat.UncompressedPoint,
+                )
+            )
+            return (
+                Tlv(0x01, bytes([slot["type"]]))
+                + Tlv(0x02, bytes([slot["pin_policy"], slot["touch_policy"]]))
+                + Tlv(0x03, bytes([1 if slot["generated"] else 2]))
+                + Tlv(0x04, Tlv(0x86, point))
+            )
+        if ins == 0x20:
+            if not data:
+                if self.pin_verified:
+                    return b""
+                raise SoftKeyError(0x63C0 | key.pin_retries)
+            self._check_pin(p2, data)
+            self.pin_verified = True
+            return b""
+        if ins == 0x24:
+            self._check_pin(p2, data[:8])
+            if p2 == PIN_P2:
+                key.pin = _pin(data[8:])
+            else:
+                key.puk = _pin(data[8:])
+            self.dirty = True
+            return b""
+        if ins == 0x2C:
+            self._check_pin(PUK_P2, data[:8])
+            key.pin = _pin(data[8:])
+            key.pin_retries = PIN_ATTEMPTS
+            self.dirty = True
+            return b""
+        if ins == 0xFB:
+            if key.pin_retries or key.puk_retries:
+                raise SoftKeyError(SW.CONDITIONS_NOT_SATISFIED)
+            key.reset()
+            self.authenticated = self.pin_verified = False
+            self.dirty = True
+            return b""
+        if ins == 0x87:
+            request = Tlv.parse_dict(Tlv.unpack(0x7C, data))
+            if p2 == SLOT_CARD_MANAGEMENT:
+                return self._authenticate(request)
+            return self._sign(p1, p2, request)
+        if ins == 0xFF:
+            self._require_authentication()
+            if data[0] == MANAGEMENT_KEY_TYPE.TDES:
+                raise SoftKeyError(SW.INCORRECT_PARAMETERS)
+            key.management_key_type = MANAGEMENT_KEY_TYPE(data[0])
+            key.management_key = Tlv.unpack(SLOT_CARD_MANAGEMENT, data[1:])
+            return b""
+        if ins == 0xCB:
+            oid = int.from_bytes(Tlv.unpack(0x5C, data), "big")
+            if oid not in key.objects:
+                raise SoftKeyError(SW.FILE_NOT_FOUND)
+            return Tlv(0x53, key.objects[oid])
+        if ins == 0xDB:
+            self._require_authentication()
+            tlvs = Tlv.parse_dict(data)
+            oid = int.from_bytes(tlvs[0x5C], "big")
+            if tlvs[0x53]:
+                key.objects[oid] = tlvs[0x53]
+            else:
+                key.objects.pop(oid, None)
+            return b""
+        if ins == 0xFE:
+            self._require_authentication()
+            key_type = KEY_TYPE(p1)
+            if key_type not in CURVES:
+                raise SoftKeyError(SW.INCORRECT_PARAMETERS)
+            tlvs = Tlv.parse_dict(data)
+            private_key = ec.derive_private_key(
+                int.from_bytes(tlvs[0x06], "big"), CURVES[key_type][0]()
+            )
+            key.store_key(p2, key_type, private_key, tlvs, False)
+            return b""
+        if ins == 0x47:
+            self._require_authentication()
+            tlvs = Tlv.parse_dict(Tlv.unpack(0xAC, data))
+            key_type = KEY_TYPE(tlvs[0x80][0])
+            if key_type not in CURVES:
+                raise SoftKeyError(SW.INCORRECT_PARAMETERS)
+            private_key = ec.generate_private_key(CURVES[key_type][0]())
+            key.store_key(p2, key_type, private_key, tlvs, True)
+            point = private_key.public_key().public_bytes(
+                serialization.Encoding.X962,
+                serialization.PublicFormat.UncompressedPoint,
+            )
+            return Tlv(0x7F49, Tlv(0x86, point))
+        raise SoftKeyError(SW.INVALID_INSTRUCTION)
+
+    def _authenticate(self, request: dict[int, bytes]) -> bytes:
+        cipher = self._management_cipher()
+        if 0x80 in request and not request[0x80]:
+            self.witness = os.urandom(self.key.management_key_type.challenge_len)
+            encryptor = cipher.encryptor()
+            witness = encryptor.update(self.witness) + encryptor.finalize()
+            return Tlv(0x7C, Tlv(0x80, witness))
+        if self.witness is None or request.get(0x80) != self.witness:
+            self.witness = None
+            raise SoftKeyError(SW.SECURITY_CONDITION_NOT_SATISFIED)
+        self.witness = None
+        self.authenticated = True
+        encryptor = cipher.encryptor()
+        response = encryptor.update(request[0x81]) + encryptor.finalize()
+        return Tlv(0x7C, Tlv(0x82, response))
+
+    def _sign(self, p1: int, slot: int, request: dict[int, bytes]) -> bytes:
+        if slot not in self.key.keys or self.key.keys[slot]["type"] != p1:
+            raise SoftKeyError(SW.INCORRECT_PARAMETERS)
+        if (
+            self.key.keys[slot]["pin_policy"] != PIN_POLICY.NEVER
+            and not self.pin_verified
+        ):
+            raise SoftKeyError(SW.SECURITY_CONDITION_NOT_SATISFIED)
+        _, hash_algorithm = CURVES[KEY_TYPE(p1)]
+        signature = self.key.private_key(slot).sign(
+            request[0x81], ec.ECDSA(Prehashed(hash_algorithm()))
+        )
+        return Tlv(0x7C, Tlv(0x82, signature))
+
+
+class SoftDevice(YubiKeyDevice):
+    """Software YubiKey stored in a file."""
+
+    def __init__(self, path: Path, latency: float = 0):
+        super().__init__(TRANSPORT.USB, f"soft:{path}")
+        self.path = path
+        self.latency = latency
+
+    def supports_connection(self, connection_type) -> bool:
+        return issubclass(connection_type, SmartCardConnection)
+
+    def open_connection(self, connection_type):
+        if not self.supports_connection(connection_type):
+            raise ValueError("Unsupported Connection type")
+        return SoftConnection(SoftKey(self.path), self.latency)
+
+
+def list_soft_devices(
+    directory: Path, latency: float = 0
+) -> list[tuple[SoftDevice, DeviceInfo]]:
+    """List software YubiKeys stored in a directory and its subdirectories.
+
+    YubiKeys are unplugged for a short while when they reboot.
+    """
+    devices = []
+    for path in sorted(directory.rglob("*.json")):
+        key = SoftKey(path)
+        if key.rebooting_until > time.time():
+            continue
+        info = DeviceInfo.parse_tlvs(Tlv.parse_dict(key.device_info()), VERSION)
+        devices.append((SoftDevice(path, latency), info))
+    return devices
@@ -0,0 +1,123 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+logger = logging.getLogger("offline-pki.tracing")
+
+PIV_METHODS = (
+    "authenticate",
+    "verify_pin",
+    "sign",
+    "put_certificate",
+    "put_key",
+    "generate_key",
+)
+
+
+class Tracer:
+    """Record timing spans of the key operations.
+
+    Nothing is recorded unless `install()` is called: the instrumented
+    functions are only replaced by timed wrappers at this point, so there is
+    no overhead when profiling is off.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events: list[dict] = []
+        self.patched: list[tuple[typing.Any, str, typing.Any]] = []
+        self.lock = threading.Lock()
+
+    def record(self, name: str, start: float, stop: float) -> None:
+        with self.lock:
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": "offline-pki",
+                    "ph": "X",
+                    "ts": (start - self.origin) * 1e6,
+                    "dur": (stop - start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                }
+            )
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def wrap(self, name: str, function: typing.Callable) -> typing.Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.span(name):
+                return function(*args, **kwargs)
+
+        wrapper.__traced__ = True  # type: ignore[attr-defined]
+        return wrapper
+
+    def patch(self, owner: typing.Any, attribute: str, name: str) -> None:
+        """Replace a function or a method by a timed wrapper."""
+        original = getattr(owner, attribute)
+        if getattr(original, "__traced__", False):
+            return
+        self.patched.append((owner, attribute, original))
+        setattr(owner, attribute, self.wrap(name, original))
+
+    def install(self) -> None:
+        """Instrument device enumeration and PIV operations."""
+        from . import dependencies as d
+        from . import yubikey
+
+        list_devices = yubikey.list_devices
+
+        @functools.wraps(list_devices)
+        def traced_list_devices(*args, **kwargs):
+            with self.span("enumerate"):
+                devices = list(list_devices(*args, **kwargs))
+            for device, _ in devices:
+                self.patch(type(device), "open_connection", "open_connection")
+            return devices
+
+        traced_list_devices.__traced__ = True  # type: ignore[attr-defined]
+        self.patched.append((yubikey, "list_devices", list_devices))
+        yubikey.list_devices = traced_list_devices
+        self.patch(d.PivSession, "__init__", "PivSession")
+        for method in PIV_METHODS:
+            self.patch(d.PivSession, method, f"piv.{method}")
+
+    def uninstall(self) -> None:
+        """Restore the instrumented functions."""
+        for owner, attribute, original in reversed(self.patched):
+            setattr(owner, attribute, original)
+        self.patched = []
+
+    def write(self, output: typing.TextIO) -> None:
+        """Write the spans as Chrome trace events."""
+        json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, output)
+
+    def summary(self) -> None:
+        """Log the time spent in each operation."""
+        totals: dict[str, list[float]] = {}
+        for event in self.events:
+            totals.setdefault(event["name"], []).append(event["dur"] / 1000)
+        logger.info(
+            f"{'operation': <20} {'count': >6} {'total': >12} "
+            f"{'mean': >10} {'max': >10}"
+        )
+        for name, durations in sorted(
+            totals.items(), key=lambda item: sum(item[1]), reverse=True
+        ):
+            logger.info(
+                f"{name: <20} {len(durations): >6} {sum(durations): >9.1f} ms "
+                f"{sum(durations) / len(durations): >7.1f} ms "
+                f"{max(durations): >7.1f} ms"
+            )
@@ -0,0 +1,180 @@
+import logging
+import os
+import time
+import typing
+from pathlib import Path
+
+logger = logging.getLogger("offline-pki.watcher")
+
+PNP_NOTIFICATION = "\\\\?PnP?\\Notification"
+POLL_INTERVAL = 1.0
+SOFT_POLL_INTERVAL = 0.01
+
+
+class Watcher:
+    """Wait for YubiKeys to be plugged or unplugged.
+
+    `snapshot()` records the current state, and `wait()` returns as soon as
+    it changed, so that a change happening between the snapshot and the wait
+    is not missed. `removed` has the fingerprints of the YubiKeys unplugged
+    since the watcher was created, even if they are back. This implementation
+    only waits for a fixed interval, so it does not notify changes.
+    """
+
+    notifies = False
+
+    def __init__(self, interval: float = POLL_INTERVAL):
+        self.interval = interval
+        self.removed: set[str] = set()
+
+    def snapshot(self) -> None:
+        pass
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        """Wait for a change, returning False on timeout."""
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        return True
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PcscWatcher(Watcher):
+    """Wait for changes of the PC/SC readers with SCardGetStatusChange.
+
+    Each YubiKey is a reader, so plugging or unplugging one is notified by the
+    PnP pseudo-reader, and a reboot changes the state of its reader. A reader
+    counts its events in the upper bits of its state, so a reader unplugged
+    and plugged again between two calls is still noticed.
+    """
+
+    notifies = True
+
+    def __init__(self):
+        from smartcard import scard
+
+        self.scard = scard
+        hresult, self.context = scard.SCardEstablishContext(scard.SCARD_SCOPE_USER)
+        if hresult != scard.SCARD_S_SUCCESS:
+            raise OSError(scard.SCardGetErrorMessage(hresult))
+        self.states: list[tuple[str, int]] = []
+        self.removed: set[str] = set()
+        self.snapshot()
+
+    def update(self, states: list[tuple[str, int, bytes]]) -> None:
+        """Record new reader states, and the readers removed since the last ones."""
+        scard = self.scard
+        known = dict(self.states)
+        self.states = [
+            (reader, state & ~scard.SCARD_STATE_CHANGED) for reader, state, _ in states
+        ]
+        current = dict(self.states)
+        for reader, state in known.items():
+            if (
+                reader not in current
+                or current[reader] & scard.SCARD_STATE_UNKNOWN
+                or current[reader] >> 16 != state >> 16
+            ):
+                self.removed.add(reader)
+
+    def snapshot(self) -> None:
+        scard = self.scard
+        hresult, readers = scard.SCardListReaders(self.context, [])
+        if hresult != scard.SCARD_S_SUCCESS:
+            readers = []
+        states = [(reader, scard.SCARD_STATE_UNAWARE) for reader in readers]
+        states.append((PNP_NOTIFICATION, scard.SCARD_STATE_UNAWARE))
+        hresult, states = scard.SCardGetStatusChange(self.context, 0, states)
+        if hresult not in (scard.SCARD_S_SUCCESS, scard.SCARD_E_TIMEOUT):
+            raise OSError(scard.SCardGetErrorMessage(hresult))
+        self.update(states)
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        scard = self.scard
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # Wait by chunks, so that Ctrl-C is handled.
+            remaining = POLL_INTERVAL
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.monotonic())
+            hresult, states = scard.SCardGetStatusChange(
+                self.context, max(int(remaining * 1000), 0), self.states
+            )
+            if hresult != scard.SCARD_E_TIMEOUT:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        if hresult != scard.SCARD_S_SUCCESS:
+            raise OSError(scard.SCardGetErrorMessage(hresult))
+        self.update(states)
+        return True
+
+    def close(self) -> None:
+        self.scard.SCardReleaseContext(self.context)
+
+
+class SoftWatcher(Watcher):
+    """Simulated reader for software YubiKeys.
+
+    The directory is polled, a change being a software YubiKey appearing,
+    disappearing or rebooting. The end of its last reboot is recorded with
+    each software YubiKey, so a reboot is noticed even once it is over.
+    """
+
+    notifies = True
+
+    def __init__(self, directory: Path):
+        super().__init__(SOFT_POLL_INTERVAL)
+        self.directory = directory
+        self.state = self.current()
+
+    def current(self) -> dict[str, tuple[float, bool]]:
+        from .softkey import SoftKey
+
+        now = time.time()
+        state = {}
+        for path in sorted(self.directory.rglob("*.json")):
+            rebooting_until = SoftKey(path).rebooting_until
+            state[f"soft:{path}"] = (rebooting_until, rebooting_until <= now)
+        return state
+
+    def snapshot(self) -> None:
+        state = self.current()
+        for fingerprint, (rebooting_until, _) in self.state.items():
+            if (
+                fingerprint not in state
+                or not state[fingerprint][1]
+                or state[fingerprint][0] != rebooting_until
+            ):
+                self.removed.add(fingerprint)
+        self.state = state
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.current() == self.state:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.interval)
+        self.snapshot()
+        return True
+
+
+def device_watcher() -> Watcher:
+    """Get the best watcher available.
+
+    When PC/SC notifications are not available, the devices are polled.
+    """
+    soft = os.environ.get("OFFLINE_PKI_SOFT_KEYS")
+    if soft:
+        return SoftWatcher(Path(soft))
+    try:
+        return PcscWatcher()
+    except (ImportError, OSError) as e:
+        logger.debug(f"PC/SC notifications not available, polling instead: {e}")
+        return Watcher()
@@ -1,15 +1,21 @@
+import contextlib
+import json
 import logging
+import os
 import warnings
 import re
-import secrets
+import threading
 import time
 import click
+import typing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import StrEnum, unique
-
+from pathlib import Path
 
 DEFAULT_PIN = "123456"
 DEFAULT_PUK = "12345678"
 DEFAULT_MANAGEMENT = bytes.fromhex("010203040506070801020304050607080102030405060708")
+REBOOT_TIMEOUT = 10.0
 
 logger = logging.getLogger("offline-pki.yubikey")
 
@@ -20,6 +26,20 @@ class YUBIKEY(StrEnum):
     INTERMEDIATE = "Intermediate"
 
 
+@unique
+class ROLE(StrEnum):
+    ROOT = "root"
+    INTERMEDIATE = "intermediate"
+    EMPTY = "empty"
+
+
+# Roles expected by default for each YubiKey.
+EXPECTED = {
+    YUBIKEY.ROOT: frozenset({ROLE.ROOT}),
+    YUBIKEY.INTERMEDIATE: frozenset({ROLE.INTERMEDIATE}),
+}
+
+
 def validate_pin(ctx, param, value):
     if not re.match(r"[0-9]{6,8}", value):
         raise click.BadParameter("PIN should be 6 to 8 numeric string")
@@ -35,6 +55,8 @@ def validate_puk(ctx, param, value):
 def validate_management_key(ctx, param, val):
     try:
         if val == ".":
+            import secrets
+
             val = secrets.token_bytes(32)
             logger.warning(f"Using random management key: {val.hex()}")
             return val
@@ -49,21 +71,220 @@ def validate_management_key(ctx, param, val):
     )
 
 
-def yubikey_one(yk: YUBIKEY):
-    """Get exactly one YubiKey."""
+def list_devices(yk: typing.Optional[YUBIKEY] = None):
+    """List plugged YubiKeys, from the device cache if enabled."""
+    if device_cache is not None:
+        return device_cache.get(yk)
+    return enumerate_devices(yk)
+
+
+def enumerate_devices(yk: typing.Optional[YUBIKEY] = None):
+    """List plugged YubiKeys.
+
+    When OFFLINE_PKI_SOFT_KEYS is set, software YubiKeys stored in this
+    directory are used instead. If a subdirectory is named after the expected
+    YubiKey ("root" or "intermediate"), only the keys in it are considered
+    plugged.
+    """
     from . import dependencies as d
 
-    click.pause(f'Plug YubiKey "{yk}"...')
-    devices = list(d.list_all_devices())
-    for nb, di in enumerate(devices):
-        device, info = di
-        logger.info(f"{nb: >2}: {device.fingerprint}")
-        logger.info(f"SN: {info.serial}")
-        if len(devices) == 1:
-            return device
-    if len(devices) == 0:
-        raise RuntimeError("No YubiKey found!")
-    raise RuntimeError("Too many YubiKeys found!")
+    soft = os.environ.get("OFFLINE_PKI_SOFT_KEYS")
+    if not soft:
+        return d.list_all_devices()
+
+    from .softkey import list_soft_devices
+
+    directory = Path(soft)
+    if yk is not None and (directory / yk.name.lower()).is_dir():
+        directory = directory / yk.name.lower()
+    latency = float(os.environ.get("OFFLINE_PKI_SOFT_LATENCY", "0")) / 1000
+    return list_soft_devices(directory, latency)
+
+
+# Enumeration is not done concurrently, as in parallel resets.
+enumeration = threading.Lock()
+# Serial of the YubiKeys already used in this process, with their role.
+roles: dict[int, YUBIKEY] = {}
+# Role of the YubiKeys already classified in this process, by serial.
+classified: dict[int, ROLE] = {}
+
+
+def classify(device, info) -> typing.Optional[ROLE]:
+    """Tell the role of a YubiKey from the content of its signature slot.
+
+    A YubiKey with a self-signed certificate is a root YubiKey, and one with
+    another certificate matching its key is an intermediate YubiKey.
+    """
+    from . import dependencies as d
+    from .cache import get_issuer
+
+    if info.serial in classified:
+        return classified[info.serial]
+    try:
+        with device.open_connection(d.SmartCardConnection) as conn:
+            issuer = get_issuer(d.PivSession(conn))
+    except d.ApduError as e:
+        # No key in the slot, or a key without its certificate yet
+        if e.sw not in (d.SW.REFERENCE_DATA_NOT_FOUND, d.SW.FILE_NOT_FOUND):
+            logger.warning(f"Cannot classify YubiKey {info.serial}: {e}")
+            return None
+        role = ROLE.EMPTY
+    except RuntimeError:
+        # A new key without its certificate yet
+        role = ROLE.EMPTY
+    else:
+        role = ROLE.ROOT if issuer.self_signed else ROLE.INTERMEDIATE
+    logger.debug(f"YubiKey {info.serial} is {role}")
+    classified[info.serial] = role
+    return role
+
+
+def forget(serial: int) -> None:
+    """Forget the role of a YubiKey whose signature slot was modified."""
+    classified.pop(serial, None)
+
+
+class DeviceCache:
+    """Plugged YubiKeys, kept between commands run in the same process.
+
+    The YubiKeys are listed again, and their roles classified again, once
+    the watcher tells that a YubiKey was plugged, unplugged or rebooted.
+    Without notifications from the watcher, nothing is cached.
+    """
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.soft = os.environ.get("OFFLINE_PKI_SOFT_KEYS")
+        self.devices: dict[typing.Optional[YUBIKEY], list] = {}
+        self.lock = threading.Lock()
+
+    def get(self, yk: typing.Optional[YUBIKEY] = None) -> list:
+        # Benchmarks use their own software YubiKeys, not watched
+        if os.environ.get("OFFLINE_PKI_SOFT_KEYS") != self.soft:
+            return enumerate_devices(yk)
+        with self.lock:
+            if not self.watcher.notifies or self.watcher.wait(0):
+                self.invalidate()
+            if yk not in self.devices:
+                self.devices[yk] = list(enumerate_devices(yk))
+            return self.devices[yk]
+
+    def invalidate(self) -> None:
+        if self.devices:
+            logger.debug("YubiKeys changed, list them again")
+        self.devices.clear()
+        classified.clear()
+
+
+# Cache of the plugged YubiKeys, only enabled by `cached_devices()`.
+device_cache: typing.Optional[DeviceCache] = None
+
+
+@contextlib.contextmanager
+def cached_devices() -> typing.Iterator[DeviceCache]:
+    """Keep the list of plugged YubiKeys until they change."""
+    global device_cache
+    from .watcher import device_watcher
+
+    with device_watcher() as watcher:
+        device_cache = DeviceCache(watcher)
+        try:
+            yield device_cache
+        finally:
+            device_cache = None
+
+
+def yubikey_one(
+    yk: YUBIKEY,
+    exclude: typing.Collection[int] = (),
+    expected: typing.Optional[typing.Collection[ROLE]] = None,
+):
+    """Get exactly one YubiKey, waiting for it to be plugged.
+
+    YubiKeys already used for another role, or whose serial is excluded, are
+    ignored, so that the operator has time to swap them. Other YubiKeys are
+    only chosen if they were already used for this role, or if their role is
+    expected, so that a key is never generated on the wrong YubiKey: with
+    only a YubiKey of another role plugged, this waits for it to be swapped.
+    If several YubiKeys could still be chosen, the one already used for this
+    role is preferred, otherwise the operator is asked to choose.
+    """
+    from .watcher import device_watcher
+
+    expected = EXPECTED[yk] if expected is None else expected
+    prompted = None
+    with device_watcher() as watcher:
+        while True:
+            watcher.snapshot()
+            plugged = [
+                (device, info)
+                for device, info in list_devices(yk)
+                if info.serial not in exclude and roles.get(info.serial, yk) == yk
+            ]
+            devices = []
+            unexpected = []
+            for device, info in plugged:
+                role = classify(device, info)
+                if roles.get(info.serial) == yk or role in expected:
+                    devices.append((device, info))
+                else:
+                    unexpected.append(f"{info.serial} is {role or 'unknown'}")
+            if len(devices) > 1:
+                devices = [
+                    (device, info)
+                    for device, info in devices
+                    if roles.get(info.serial) == yk
+                ] or devices
+            if len(devices) > 1:
+                serial = click.prompt(
+                    f'Several YubiKeys could be "{yk}", serial to use',
+                    type=click.Choice([str(info.serial) for _, info in devices]),
+                    err=True,
+                )
+                devices = [di for di in devices if str(di[1].serial) == serial]
+            if len(devices) == 1:
+                device, info = devices[0]
+                logger.info(f"{device.fingerprint}")
+                logger.info(f"SN: {info.serial}")
+                roles[info.serial] = yk
+                return device
+            message = f'Plug YubiKey "{yk}"...'
+            if unexpected:
+                message = (
+                    f'Plug YubiKey "{yk}" ({", ".join(sorted(expected))} expected, '
+                    f"YubiKey {', '.join(unexpected)})..."
+                )
+            if message != prompted:
+                click.echo(message, err=True)
+                prompted = message
+            watcher.wait()
+
+
+def wait_reboot(watcher, device, serial: int, timeout: float = REBOOT_TIMEOUT):
+    """Wait for a YubiKey to disappear and come back.
+
+    The watcher should have been created before the reboot was requested: it
+    tells whether the YubiKey was unplugged since, as the YubiKey may be back
+    before the YubiKeys are listed again, for example when several YubiKeys
+    are listed in turn.
+    """
+    deadline = time.monotonic() + timeout
+    rebooted = False
+    while True:
+        if watcher.wait(max(deadline - time.monotonic(), 0)):
+            watcher.snapshot()
+            with enumeration, warnings.catch_warnings():
+                warnings.filterwarnings("ignore", message="Failed opening device")
+                devices = [
+                    found for found, info in list_devices() if info.serial == serial
+                ]
+            rebooted = rebooted or device.fingerprint in watcher.removed
+            if not devices:
+                rebooted = True
+            elif rebooted or not watcher.notifies:
+                return devices[0]
+        elif time.monotonic() >= deadline:
+            raise RuntimeError("no YubiKey found")
 
 
 def click_pin(yk: str):
@@ -93,50 +314,167 @@ def yubikey() -> None:
     """YubiKey management."""
 
 
+def inventory(device, info, certificate: bool = True) -> dict:
+    """Describe a YubiKey and the content of its signature slot.
+
+    The certificate is read through the local cache, and not at all when
+    `certificate` is false.
+    """
+    from . import dependencies as d
+    from .cache import fingerprint, get_issuer
+
+    result: dict[str, typing.Any] = {
+        "serial": info.serial,
+        "device": device.fingerprint,
+        "version": str(info.version),
+        "form_factor": str(info.form_factor),
+    }
+    with device.open_connection(d.SmartCardConnection) as conn:
+        piv = d.PivSession(conn)
+        try:
+            result["pin_retries"] = piv.get_pin_metadata().attempts_remaining
+            result["puk_retries"] = piv.get_puk_metadata().attempts_remaining
+        except d.NotSupportedError:
+            result["pin_retries"] = piv.get_pin_attempts()
+            result["puk_retries"] = None
+        try:
+            metadata = piv.get_slot_metadata(d.SLOT.SIGNATURE)
+        except d.ApduError as e:
+            if e.sw != d.SW.REFERENCE_DATA_NOT_FOUND:
+                raise
+            result["slot"] = None
+            return result
+        slot: dict[str, typing.Any] = {
+            "slot": f"{d.SLOT.SIGNATURE:02x}",
+            "key_type": metadata.key_type.name,
+            "algorithm": getattr(metadata.public_key, "curve", metadata.key_type).name,
+            "pin_policy": metadata.pin_policy.name,
+            "touch_policy": metadata.touch_policy.name,
+            "generated": metadata.generated,
+            "public_key_sha256": fingerprint(metadata.public_key),
+            "certificate": None,
+        }
+        result["slot"] = slot
+        if certificate:
+            cert = get_issuer(piv).certificate
+            slot["certificate"] = {
+                "issuer": cert.issuer.rfc4514_string(),
+                "subject": cert.subject.rfc4514_string(),
+                "serial": cert.serial_number,
+                "not_before": cert.not_valid_before_utc.isoformat(),
+                "not_after": cert.not_valid_after_utc.isoformat(),
+                "sha256": cert.fingerprint(d.hashes.SHA256()).hex(),
+                "pem": cert.public_bytes(encoding=d.serialization.Encoding.PEM).decode(
+                    "utf-8"
+                ),
+            }
+    return result
+
+
 @yubikey.command("info")
-def yubikey_info() -> None:
-    """Display information about the inserted YubiKeys."""
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["text", "json"]),
+    default="text",
+    help="Output format",
+)
+@click.option(
+    "--metadata-only",
+    is_flag=True,
+    default=False,
+    help="Do not read the certificates",
+)
+def yubikey_info(output_format: str, metadata_only: bool) -> None:
+    """Display information about the inserted YubiKeys.
+
+    All the YubiKeys are queried concurrently. With --format json, the
+    inventory is written to the standard output.
+    """
+    devices = list(list_devices())
+    with ThreadPoolExecutor(max(len(devices), 1)) as executor:
+        futures = [
+            executor.submit(inventory, device, info, not metadata_only)
+            for device, info in devices
+        ]
+    results = []
+    for (_, info), future in zip(devices, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logger.error(f"[{info.serial}] Cannot read YubiKey: {e}")
+            results.append({"serial": info.serial, "error": str(e)})
+
+    if output_format == "json":
+        click.echo(json.dumps(results, indent=2))
+        return
+    for nb, result in enumerate(results):
+        if "error" in result:
+            continue
+        logger.info(f"{nb: >2}: {result['device']}")
+        logger.info(f"SN: {result['serial']}")
+        logger.info(f"Version: {result['version']}")
+        logger.info(f"PIN retries: {result['pin_retries']}")
+        if result["puk_retries"] is not None:
+            logger.info(f"PUK retries: {result['puk_retries']}")
+        slot = result["slot"]
+        logger.info(f"Slot {slot['slot'] if slot else '9c'}:")
+        if slot is None:
+            logger.info("  Empty")
+            continue
+        logger.info(f"  Private key type: {slot['key_type']}")
+        cert = slot["certificate"]
+        logger.info("  Public key: ")
+        logger.info(f"    Algorithm:  {slot['algorithm']}")
+        if cert is None:
+            continue
+        logger.info(f"    Issuer:     {cert['issuer']}")
+        logger.info(f"    Subject:    {cert['subject']}")
+        logger.info(f"    Serial:     {cert['serial']}")
+        logger.info(f"    Not before: {cert['not_before']}")
+        logger.info(f"    Not after:  {cert['not_after']}")
+        logger.info(f"    PEM:\n{cert['pem']}")
+
+
+def reset_device(
+    device, info, new_pin: str, new_puk: str, new_management_key: bytes
+) -> None:
+    """Only enable PIV on a YubiKey, reset it and set its credentials."""
     from . import dependencies as d
+    from .watcher import device_watcher
 
-    for nb, di in enumerate(d.list_all_devices()):
-        device, info = di
-        logger.info(f"{nb: >2}: {device.fingerprint}")
-        logger.info(f"SN: {info.serial}")
-        logger.info(f"Version: {info.version}")
+    serial = info.serial
+    with device_watcher() as watcher:
         with device.open_connection(d.SmartCardConnection) as conn:
-            piv = d.PivSession(conn)
-            logger.info(f"Slot {d.SLOT.SIGNATURE}:")
-            try:
-                data = piv.get_slot_metadata(d.SLOT.SIGNATURE)
-            except d.ApduError as e:
-                if e.sw == d.SW.REFERENCE_DATA_NOT_FOUND:
-                    logger.info("  Empty")
-                    continue
-            logger.info(f"  Private key type: {data.key_type}")
-            cert = piv.get_certificate(d.SLOT.SIGNATURE)
-            pkey = data.public_key
-            algorithm = pkey.curve.name
-            issuer = cert.issuer.rfc4514_string()
-            subject = cert.subject.rfc4514_string()
-            serial = cert.serial_number
-            not_before = cert.not_valid_before_utc.isoformat()
-            not_after = cert.not_valid_after_utc.isoformat()
-            pem_data = cert.public_bytes(encoding=d.serialization.Encoding.PEM).decode(
-                "utf-8"
-            )
-            logger.info("  Public key: ")
-            logger.info(f"    Algorithm:  {algorithm}")
-            logger.info(f"    Issuer:     {issuer}")
-            logger.info(f"    Subject:    {subject}")
-            logger.info(f"    Serial:     {serial}")
-            logger.info(f"    Not before: {not_before}")
-            logger.info(f"    Not after:  {not_after}")
-            logger.info(f"    PEM:\n{pem_data}")
+            mgt = d.ManagementSession(conn)
+            logger.debug(f"[{serial}] Only enable PIV application")
+            config = d.DeviceConfig({}, None, None, None)
+            config.enabled_capabilities = {
+                d.TRANSPORT.NFC: d.CAPABILITY(0),
+                d.TRANSPORT.USB: d.CAPABILITY.PIV,
+            }
+            mgt.write_device_config(config, True, None, None)
+        logger.info(f"[{serial}] Wait for YubiKey to reboot")
+        device = wait_reboot(watcher, device, serial)
+    with device.open_connection(d.SmartCardConnection) as conn:
+        piv = d.PivSession(conn)
+        logger.info(f"[{serial}] Reset PIV application")
+        piv.reset()
+        forget(serial)
+        logger.debug(f"[{serial}] Set management key")
+        piv.authenticate(DEFAULT_MANAGEMENT)
+        d.pivman_set_mgm_key(piv, new_management_key, d.MANAGEMENT_KEY_TYPE.AES256)
+        logger.debug(f"[{serial}] Set PIN and PUK code")
+        piv.change_puk(DEFAULT_PUK, new_puk)
+        d.pivman_change_pin(piv, DEFAULT_PIN, new_pin)
 
 
 @yubikey.command("reset")
-@click.confirmation_option(
-    prompt="This will reset the connected YubiKey. Are you sure?"
+@click.option(
+    "--yes",
+    is_flag=True,
+    default=False,
+    help="Reset the plugged YubiKeys without confirmation",
 )
 @click.option(
     "--new-pin",
@@ -164,51 +502,80 @@ def yubikey_info() -> None:
     type=click.UNPROCESSED,
     callback=validate_management_key,
 )
-def yubikey_reset(new_pin: str, new_puk: str, new_management_key: bytes) -> None:
-    """Reset the inserted YubiKeys."""
-    from . import dependencies as d
+def yubikey_reset(
+    yes: bool, new_pin: str, new_puk: str, new_management_key: bytes
+) -> None:
+    """Reset the inserted YubiKeys.
 
-    found = False
-    for nb, di in enumerate(d.list_all_devices()):
-        found = True
+    The plugged YubiKeys are listed with their role, and the operator is asked
+    to confirm before they are reset. YubiKeys are reset in parallel. A
+    YubiKey failing to be reset does not prevent the others from being reset.
+    """
+    devices = list(list_devices())
+    if not devices:
+        raise RuntimeError("No YubiKey found!")
+    for nb, di in enumerate(devices):
         device, info = di
         logger.info(f"{nb: >2}: {device.fingerprint}")
         logger.info(f"SN: {info.serial}")
         logger.info(f"Version: {info.version}")
-        with device.open_connection(d.SmartCardConnection) as conn:
-            mgt = d.ManagementSession(conn)
-            logger.debug("Only enable PIV application")
-            config = d.DeviceConfig({}, None, None, None)
-            config.enabled_capabilities = {
-                d.TRANSPORT.NFC: d.CAPABILITY(0),
-                d.TRANSPORT.USB: d.CAPABILITY.PIV,
-            }
-            mgt.write_device_config(config, True, None, None)
-        logger.debug("Wait a bit for YubiKey to reboot")
-        for retry in reversed(range(5)):
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", message="Failed opening device")
-                time.sleep(1)
-                for _, di2 in enumerate(d.list_all_devices()):
-                    device2, info2 = di2
-                    if info2.serial == info.serial:
-                        device = device2
-                        break
-                else:
-                    if retry > 0:
-                        continue
-                    raise RuntimeError("no YubiKey found")
-                break
-        with device.open_connection(d.SmartCardConnection) as conn:
-            piv = d.PivSession(conn)
-            logger.debug("Reset PIV application")
-            piv.reset()
-            logger.debug("Set management key")
-            piv.authenticate(DEFAULT_MANAGEMENT)
-            d.pivman_set_mgm_key(piv, new_management_key, d.MANAGEMENT_KEY_TYPE.AES256)
-            logger.debug("Set PIN and PUK code")
-            piv.change_puk(DEFAULT_PUK, new_puk)
-            d.pivman_change_pin(piv, DEFAULT_PIN, new_pin)
-        logger.info("YubiKey reset successful!")
-    if not found:
-        raise RuntimeError("No YubiKey found!")
+        logger.info(f"Role: {classify(device, info) or 'unknown'}")
+    if not yes:
+        click.confirm(
+            f"This will reset {len(devices)} YubiKeys ("
+            + ", ".join(str(info.serial) for _, info in devices)
+            + "). Are you sure?",
+            abort=True,
+        )
+
+    failures = []
+    with ThreadPoolExecutor(len(devices)) as executor:
+        futures = {
+            executor.submit(
+                reset_device, device, info, new_pin, new_puk, new_management_key
+            ): info.serial
+            for device, info in devices
+        }
+        for future in as_completed(futures):
+            serial = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"[{serial}] YubiKey reset failed: {e}")
+                failures.append(serial)
+            else:
+                logger.info(f"[{serial}] YubiKey reset successful!")
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} YubiKeys could not be reset: "
+            + ", ".join(str(serial) for serial in sorted(failures))
+        )
+
+
+@yubikey.command("soft-create")
+@click.option(
+    "--count",
+    default=1,
+    help="Number of software YubiKeys to create",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--role",
+    type=click.Choice([yk.name.lower() for yk in YUBIKEY]),
+    help="Only plug the created YubiKeys when this one is expected",
+)
+def yubikey_soft_create(count: int, role: typing.Optional[str]) -> None:
+    """Create software YubiKeys, for tests and benchmarks."""
+    import secrets
+    from .softkey import SoftKey
+
+    soft = os.environ.get("OFFLINE_PKI_SOFT_KEYS")
+    if not soft:
+        raise click.UsageError("--soft-keys is needed to create software YubiKeys")
+    directory = Path(soft)
+    if role is not None:
+        directory = directory / role
+    directory.mkdir(parents=True, exist_ok=True)
+    for _ in range(count):
+        key = SoftKey.create(directory, secrets.randbelow(90000000) + 10000000)
+        logger.info(f"Software YubiKey created in {key.path}")
@@ -0,0 +1,147 @@
+import typing
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from yubikit.core.smartcard import SmartCardConnection
+from yubikit.piv import SLOT, PivSession
+
+from pki.certificate import certificate
+from pki.softkey import SoftDevice, SoftKey
+from pki.yubikey import roles, yubikey
+
+PIN = "654321"
+PUK = "87654321"
+MANAGEMENT_KEY = "ab" * 32
+
+
+class CA:
+    """Root and intermediate software YubiKeys, initialized once."""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.environ = {
+            "OFFLINE_PKI_SOFT_KEYS": str(directory / "keys"),
+            "OFFLINE_PKI_CACHE_DIR": str(directory / "cache"),
+            "OFFLINE_PKI_LEDGER": str(directory / "ledger"),
+        }
+
+    def certificate(self, role: str) -> x509.Certificate:
+        """Certificate in the signature slot of a software YubiKey."""
+        (path,) = (self.directory / "keys" / role).glob("*.json")
+        with SoftDevice(path).open_connection(SmartCardConnection) as connection:
+            return PivSession(connection).get_certificate(SLOT.SIGNATURE)
+
+    @property
+    def root(self) -> x509.Certificate:
+        return self.certificate("root")
+
+    @property
+    def intermediate(self) -> x509.Certificate:
+        return self.certificate("intermediate")
+
+
+def invoke(environ: dict, command, args: list[str], input=None):
+    """Run a command as in a new process, failing the test if it fails."""
+    # A YubiKey may be used for another role in a new process
+    roles.clear()
+    result = CliRunner(env=environ).invoke(
+        command, args, input=input, catch_exceptions=False
+    )
+    assert result.exit_code == 0, result.output
+    return result
+
+
+@pytest.fixture(scope="session")
+def ca(tmp_path_factory) -> CA:
+    ca = CA(tmp_path_factory.mktemp("ca"))
+    for serial, role in enumerate(("root", "intermediate"), start=1):
+        (ca.directory / "keys" / role).mkdir(parents=True)
+        SoftKey.create(ca.directory / "keys" / role, serial)
+    invoke(
+        ca.environ,
+        yubikey,
+        [
+            "reset",
+            "--yes",
+            f"--new-pin={PIN}",
+            f"--new-puk={PUK}",
+            f"--new-management-key={MANAGEMENT_KEY}",
+        ],
+    )
+    invoke(
+        ca.environ,
+        certificate,
+        ["root", "init", f"--management-key={MANAGEMENT_KEY}"],
+        "y\nn\n",
+    )
+    invoke(
+        ca.environ,
+        certificate,
+        ["intermediate", f"--management-key={MANAGEMENT_KEY}", f"--pin={PIN}"],
+        "y\n",
+    )
+    return ca
+
+
+@pytest.fixture
+def ledger_dir(tmp_path) -> Path:
+    return tmp_path / "ledger"
+
+
+@pytest.fixture
+def run(ca, ledger_dir) -> typing.Callable:
+    """Run a command with the CA YubiKeys and a ledger of its own."""
+    environ = {**ca.environ, "OFFLINE_PKI_LEDGER": str(ledger_dir)}
+
+    def run(command, args: list[str], input=None):
+        return invoke(environ, command, args, input)
+
+    return run
+
+
+def new_csr(common_name: str, dns: typing.Sequence[str] = ()) -> bytes:
+    """PEM-encoded CSR for a new key."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    builder = x509.CertificateSigningRequestBuilder().subject_name(
+        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    )
+    if dns:
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName([x509.DNSName(name) for name in dns]),
+            critical=False,
+        )
+    return builder.sign(key, hashes.SHA256()).public_bytes(serialization.Encoding.PEM)
+
+
+@pytest.fixture
+def make_csr() -> typing.Callable[..., bytes]:
+    return new_csr
+
+
+@pytest.fixture
+def sign(run, tmp_path) -> typing.Callable[..., list[x509.Certificate]]:
+    """Sign CSR with the intermediate YubiKey, returning the certificates."""
+
+    def sign(*csrs: bytes, args: typing.Sequence[str] = ()):
+        csr_file = tmp_path / "request.csr"
+        out_file = tmp_path / "signed.crt"
+        csr_file.write_bytes(b"".join(csrs))
+        run(
+            certificate,
+            [
+                "sign",
+                f"--pin={PIN}",
+                "--yes",
+                f"--csr-file={csr_file}",
+                f"--out-file={out_file}",
+                *args,
+            ],
+        )
+        return x509.load_pem_x509_certificates(out_file.read_bytes())
+
+    return sign
@@ -0,0 +1,94 @@
+import socket
+import threading
+
+import pytest
+from click.testing import CliRunner
+from cryptography import x509
+from yubikit.core.smartcard import SmartCardConnection
+from yubikit.piv import KEY_TYPE, PivSession
+
+from pki.agent import AgentClient, AgentServer, SigningAgent, agent
+from pki.cache import Issuer
+from pki.ledger import Ledger
+from pki.softkey import SoftDevice
+
+from conftest import PIN
+
+
+@pytest.fixture
+def socket_path(ca, ledger_dir, tmp_path):
+    """Socket of an agent signing with the intermediate software YubiKey."""
+    (path,) = (ca.directory / "keys" / "intermediate").glob("*.json")
+    intermediate = ca.intermediate
+    issuer = Issuer(intermediate, KEY_TYPE.from_public_key(intermediate.public_key()))
+    socket_path = str(tmp_path / "agent.sock")
+    with SoftDevice(path).open_connection(SmartCardConnection) as connection, Ledger(
+        ledger_dir
+    ) as ledger:
+        piv = PivSession(connection)
+        piv.verify_pin(PIN)
+        server = AgentServer(socket_path, SigningAgent(piv, issuer, ledger))
+        thread = threading.Thread(target=server.serve_until_stopped)
+        thread.start()
+        try:
+            yield socket_path
+        finally:
+            with AgentClient(socket_path) as client:
+                client.request("stop")
+            thread.join()
+
+
+def test_sign(ca, socket_path, make_csr, ledger_dir, tmp_path):
+    csr_file = tmp_path / "request.csr"
+    csr_file.write_bytes(make_csr("www", ["www.example.com"]) + make_csr("mail"))
+    out_file = tmp_path / "signed.crt"
+    result = CliRunner().invoke(
+        agent,
+        [
+            "sign",
+            "--yes",
+            f"--socket={socket_path}",
+            f"--csr-file={csr_file}",
+            f"--out-file={out_file}",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+
+    certs = x509.load_pem_x509_certificates(out_file.read_bytes())
+    assert [cert.subject.rfc4514_string() for cert in certs] == ["CN=www", "CN=mail"]
+    for cert in certs:
+        cert.verify_directly_issued_by(ca.intermediate)
+    # Returned once recorded
+    with Ledger(ledger_dir) as ledger:
+        for cert in certs:
+            (item,) = ledger.by_serial(cert.serial_number)
+            assert ledger.certificate(item) == cert
+
+
+def test_sign_unconfirmed(socket_path, make_csr, tmp_path):
+    csr_file = tmp_path / "request.csr"
+    csr_file.write_bytes(make_csr("www"))
+    result = CliRunner().invoke(
+        agent,
+        ["sign", f"--socket={socket_path}", f"--csr-file={csr_file}"],
+        input="n\n",
+    )
+    assert "Aborted!" in result.output
+    assert "BEGIN CERTIFICATE" not in result.output
+
+
+def test_single_agent(socket_path):
+    with pytest.raises(RuntimeError, match="already running"):
+        AgentServer(socket_path, None)
+    with AgentClient(socket_path) as client:
+        assert client.request("ping") == {"issuer": "CN=Intermediate CA"}
+
+
+def test_stale_socket(tmp_path):
+    path = str(tmp_path / "agent.sock")
+    # Bound, but nobody listens anymore
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(path)
+    server = AgentServer(path, None)
+    server.server_close()
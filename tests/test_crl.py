@@ -0,0 +1,81 @@
+from cryptography import x509
+
+from pki.certificate import certificate
+
+from conftest import PIN
+
+URL = "http://crl.example.com/{shard}.crl"
+
+
+def revoke(run, cert: x509.Certificate, reason: str = "keyCompromise") -> None:
+    run(
+        certificate,
+        ["revoke", f"--serial={cert.serial_number:x}", f"--reason={reason}"],
+    )
+
+
+def publish(run, out_dir, *args: str) -> None:
+    run(
+        certificate,
+        ["crl", f"--pin={PIN}", f"--out-dir={out_dir}", f"--url={URL}", *args],
+    )
+
+
+def load(ca, path) -> x509.CertificateRevocationList:
+    crl = x509.load_pem_x509_crl(path.read_bytes())
+    assert crl.is_signature_valid(ca.intermediate.public_key())
+    assert crl.issuer == ca.intermediate.subject
+    return crl
+
+
+def serials(crl: x509.CertificateRevocationList) -> set[int]:
+    return {revoked.serial_number for revoked in crl}
+
+
+def test_single_crl(ca, run, sign, make_csr, tmp_path):
+    cert, other = sign(make_csr("a"), make_csr("b"))
+    revoke(run, cert, "superseded")
+    out_file = tmp_path / "ca.crl"
+    run(certificate, ["crl", f"--pin={PIN}", f"--out-file={out_file}"])
+
+    crl = load(ca, out_file)
+    assert serials(crl) == {cert.serial_number}
+    entry = crl.get_revoked_certificate_by_serial_number(cert.serial_number)
+    reason = entry.extensions.get_extension_for_class(x509.CRLReason).value
+    assert reason.reason == x509.ReasonFlags.superseded
+
+
+def test_full_and_delta(ca, run, sign, make_csr, tmp_path):
+    first, second, third = sign(make_csr("a"), make_csr("b"), make_csr("c"))
+    out_dir = tmp_path / "crl"
+
+    revoke(run, first)
+    publish(run, out_dir)
+    full = load(ca, out_dir / "0.crl")
+    delta = load(ca, out_dir / "0-delta.crl")
+    number = full.extensions.get_extension_for_class(x509.CRLNumber).value.crl_number
+    assert serials(full) == {first.serial_number}
+    assert serials(delta) == set()
+    indicator = delta.extensions.get_extension_for_class(x509.DeltaCRLIndicator)
+    assert indicator.value.crl_number == number
+    freshest = full.extensions.get_extension_for_class(x509.FreshestCRL).value
+    assert freshest[0].full_name == [
+        x509.UniformResourceIdentifier("http://crl.example.com/0-delta.crl")
+    ]
+
+    revoke(run, second)
+    publish(run, out_dir, "--delta")
+    assert x509.load_pem_x509_crl((out_dir / "0.crl").read_bytes()) == full
+    delta = load(ca, out_dir / "0-delta.crl")
+    assert serials(delta) == {second.serial_number}
+    indicator = delta.extensions.get_extension_for_class(x509.DeltaCRLIndicator)
+    assert indicator.value.crl_number == number
+    delta_number = delta.extensions.get_extension_for_class(x509.CRLNumber).value
+    assert delta_number.crl_number > number
+
+    # A new full CRL has all the revoked certificates, and an empty delta CRL
+    revoke(run, third)
+    publish(run, out_dir)
+    full = load(ca, out_dir / "0.crl")
+    assert serials(full) == {c.serial_number for c in (first, second, third)}
+    assert serials(load(ca, out_dir / "0-delta.crl")) == set()
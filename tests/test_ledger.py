@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from pki import ledger as ledger_module
+from pki.ledger import LEDGER, Ledger
+
+
+@pytest.fixture(scope="module")
+def key():
+    return ec.generate_private_key(ec.SECP256R1())
+
+
+def make_cert(key, name: str, days: int = 30) -> x509.Certificate:
+    """Self-signed certificate for a DNS name."""
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    now = datetime.now(timezone.utc)
+    return (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=days))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.DNSName(name)]), critical=False
+        )
+        .sign(key, hashes.SHA256())
+    )
+
+
+def test_lookup(key, tmp_path):
+    certs = [make_cert(key, f"host{nb}.example.com", nb + 1) for nb in range(5)]
+    with Ledger(tmp_path) as ledger:
+        for cert in certs:
+            ledger.record(cert)
+
+    with Ledger(tmp_path) as ledger:
+        assert len(list(ledger)) == 5
+        (item,) = ledger.by_serial(certs[2].serial_number)
+        assert ledger.certificate(item) == certs[2]
+        (item,) = ledger.by_subject("CN=host3.example.com")
+        assert item["serial"] == f"{certs[3].serial_number:x}"
+        (item,) = ledger.search([["dns:host4.example.com"]])
+        assert item["sans"] == ["DNS:host4.example.com"]
+        now = datetime.now(timezone.utc)
+        expiring = ledger.expiring(now, now + timedelta(days=3, hours=1))
+        assert [item["subject"] for item in expiring] == [
+            "CN=host0.example.com",
+            "CN=host1.example.com",
+            "CN=host2.example.com",
+        ]
+
+
+def test_recorded_after_flush(key, tmp_path):
+    recorded = []
+    with Ledger(tmp_path) as ledger:
+        cert = make_cert(key, "www.example.com")
+        ledger.record(cert, recorded=lambda: recorded.append(cert.serial_number))
+        # Not written yet, so not handed out
+        assert recorded == []
+        assert not (tmp_path / LEDGER).exists()
+        ledger.flush()
+        assert recorded == [cert.serial_number]
+        assert (tmp_path / LEDGER).read_bytes().count(b"\n") == 1
+
+
+def test_batch(key, tmp_path, monkeypatch):
+    monkeypatch.setattr(ledger_module, "BATCH", 2)
+    recorded = []
+    with Ledger(tmp_path) as ledger:
+        for nb in range(3):
+            ledger.record(
+                make_cert(key, f"host{nb}"), recorded=lambda: recorded.append(1)
+            )
+        # The first batch is full, so written
+        assert len(recorded) == 2
+    assert len(recorded) == 3
+
+
+def test_partial_entry(key, tmp_path):
+    """A crash while appending an entry leaves a partial line, dropped on open."""
+    first, second = make_cert(key, "first"), make_cert(key, "second")
+    with Ledger(tmp_path) as ledger:
+        ledger.record(first)
+    with open(tmp_path / LEDGER, "ab") as output:
+        output.write(b'{"serial": "12')
+
+    with Ledger(tmp_path) as ledger:
+        assert [item["subject"] for item in ledger] == ["CN=first"]
+        ledger.record(second)
+    with Ledger(tmp_path) as ledger:
+        assert [item["subject"] for item in ledger] == ["CN=first", "CN=second"]
+        (item,) = ledger.by_serial(second.serial_number)
+        assert ledger.certificate(item) == second
+
+
+def test_missing_index(key, tmp_path):
+    """A crash before the index segments are written, after the entries."""
+    certs = [make_cert(key, f"host{nb}") for nb in range(3)]
+    with Ledger(tmp_path) as ledger:
+        ledger.record(certs[0])
+    with Ledger(tmp_path) as ledger:
+        ledger.record(certs[1])
+        ledger.record(certs[2])
+    # Drop the index segments of the second batch
+    for name in ("serial", "subject", "expiry", "term"):
+        segments = sorted(tmp_path.glob(f"{name}-*.idx"))
+        assert len(segments) == 2
+        segments[-1].unlink()
+
+    with Ledger(tmp_path) as ledger:
+        for cert in certs:
+            (item,) = ledger.by_serial(cert.serial_number)
+            assert ledger.certificate(item) == cert
+        assert len(ledger.search([["rdn:cn=host2"]])) == 1
@@ -0,0 +1,122 @@
+import base64
+import threading
+import urllib.parse
+import urllib.request
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509 import ocsp
+
+from pki.certificate import certificate
+from pki.ocsp import ocsp as ocsp_group
+from pki.responder import Responder
+
+from conftest import PIN
+
+
+@pytest.fixture
+def responder(ca, run, sign, make_csr, tmp_path):
+    """Responder serving responses for a good and a revoked certificate."""
+    good, revoked = sign(make_csr("good"), make_csr("revoked"))
+    run(certificate, ["revoke", f"--serial={revoked.serial_number:x}"])
+    responses = tmp_path / "responses"
+    run(ocsp_group, ["sign", f"--pin={PIN}", f"--out-file={responses}"], "y\n")
+
+    server = Responder(("127.0.0.1", 0), responses)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}", good, revoked
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def request(ca, cert: x509.Certificate, algorithm=hashes.SHA1()) -> bytes:
+    return (
+        ocsp.OCSPRequestBuilder()
+        .add_certificate(cert, ca.intermediate, algorithm)
+        .build()
+        .public_bytes(serialization.Encoding.DER)
+    )
+
+
+def post(url: str, data: bytes) -> ocsp.OCSPResponse:
+    with urllib.request.urlopen(
+        urllib.request.Request(
+            url, data, headers={"Content-Type": "application/ocsp-request"}
+        )
+    ) as response:
+        assert response.headers["Content-Type"] == "application/ocsp-response"
+        return ocsp.load_der_ocsp_response(response.read())
+
+
+def get(url: str, data: bytes) -> ocsp.OCSPResponse:
+    path = urllib.parse.quote(base64.b64encode(data).decode("ascii"), safe="")
+    with urllib.request.urlopen(f"{url}/{path}") as response:
+        return ocsp.load_der_ocsp_response(response.read())
+
+
+@pytest.mark.parametrize("algorithm", [hashes.SHA1(), hashes.SHA256()])
+def test_status(ca, responder, algorithm):
+    url, good, revoked = responder
+    for cert, status in (
+        (good, ocsp.OCSPCertStatus.GOOD),
+        (revoked, ocsp.OCSPCertStatus.REVOKED),
+    ):
+        for fetch in (post, get):
+            response = fetch(url, request(ca, cert, algorithm))
+            assert response.response_status == ocsp.OCSPResponseStatus.SUCCESSFUL
+            assert response.serial_number == cert.serial_number
+            assert response.certificate_status == status
+            assert response.hash_algorithm.name == algorithm.name
+            ca.intermediate.public_key().verify(
+                response.signature,
+                response.tbs_response_bytes,
+                ec.ECDSA(response.signature_hash_algorithm),
+            )
+
+
+def test_unknown(ca, responder):
+    url, good, _ = responder
+    # Same issuer, with a serial not in the responses
+    good_request = ocsp.load_der_ocsp_request(request(ca, good))
+    data = (
+        ocsp.OCSPRequestBuilder()
+        .add_certificate_by_hash(
+            good_request.issuer_name_hash,
+            good_request.issuer_key_hash,
+            x509.random_serial_number(),
+            hashes.SHA1(),
+        )
+        .build()
+        .public_bytes(serialization.Encoding.DER)
+    )
+    response = post(url, data)
+    assert response.response_status == ocsp.OCSPResponseStatus.UNAUTHORIZED
+
+
+def test_other_issuer(ca, responder):
+    url, good, _ = responder
+    # The root CA did not issue the certificate
+    data = (
+        ocsp.OCSPRequestBuilder()
+        .add_certificate(good, ca.root, hashes.SHA1())
+        .build()
+        .public_bytes(serialization.Encoding.DER)
+    )
+    response = post(url, data)
+    assert response.response_status == ocsp.OCSPResponseStatus.UNAUTHORIZED
+
+
+def test_malformed(responder):
+    url, _, _ = responder
+    assert post(url, b"junk").response_status == (
+        ocsp.OCSPResponseStatus.MALFORMED_REQUEST
+    )
+    with urllib.request.urlopen(f"{url}/not%20base64") as response:
+        status = ocsp.load_der_ocsp_response(response.read()).response_status
+    assert status == ocsp.OCSPResponseStatus.MALFORMED_REQUEST
@@ -0,0 +1,150 @@
+import ipaddress
+import re
+
+import pytest
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+
+from pki.policy import DnsTrie, EmailMap, IpRadix, NameConstraintsPolicy, PolicyError
+
+
+def trie(*constraints: str) -> DnsTrie:
+    dns = DnsTrie()
+    for constraint in constraints:
+        dns.add(constraint)
+    return dns
+
+
+@pytest.mark.parametrize(
+    "constraint,name,expected",
+    [
+        ("example.com", "example.com", True),
+        ("example.com", "www.example.com", True),
+        ("example.com", "a.b.example.com", True),
+        ("example.com", "WWW.Example.COM.", True),
+        ("example.com", "badexample.com", False),
+        ("example.com", "com", False),
+        (".example.com", "example.com", False),
+        (".example.com", "www.example.com", True),
+        ("www.example.com", "example.com", False),
+        ("www.example.com", "mail.example.com", False),
+    ],
+)
+def test_dns_match(constraint, name, expected):
+    assert trie(constraint).match(name) is expected
+
+
+def test_dns_match_both():
+    # "example.com" also matches the name, whatever the order of the constraints
+    assert trie(".example.com", "example.com").match("example.com")
+    assert trie("example.com", ".example.com").match("example.com")
+
+
+@pytest.mark.parametrize(
+    "name,expected",
+    [
+        ("*.example.com", True),
+        ("*.good.example.com", False),
+        ("*.bad.example.com", True),
+        ("*.com", True),
+        ("*.other.com", False),
+        ("bad.example.com", True),
+        ("good.example.com", False),
+    ],
+)
+def test_dns_intersects(name, expected):
+    assert trie("bad.example.com").intersects(name) is expected
+
+
+@pytest.mark.parametrize(
+    "name,expected",
+    [
+        ("10.1.2.3", True),
+        ("10.255.255.255", True),
+        ("11.0.0.0", False),
+        ("192.168.1.1", True),
+        ("192.168.2.1", False),
+        ("2001:db8::1", True),
+        ("2001:db9::1", False),
+    ],
+)
+def test_ip(name, expected):
+    radix = IpRadix()
+    for network in ("10.0.0.0/8", "192.168.1.0/24", "2001:db8::/32"):
+        radix.add(ipaddress.ip_network(network))
+    assert radix.match(ipaddress.ip_address(name)) is expected
+
+
+@pytest.mark.parametrize(
+    "name,expected",
+    [
+        ("admin@example.org", True),
+        ("other@example.org", False),
+        ("anyone@example.net", True),
+        ("anyone@mail.example.net", False),
+        ("anyone@mail.example.com", True),
+        ("anyone@example.com", False),
+    ],
+)
+def test_email(name, expected):
+    emails = EmailMap()
+    for constraint in ("admin@example.org", "@example.net", ".example.com"):
+        emails.add(constraint)
+    assert emails.match(name) is expected
+
+
+def constraints(permitted=None, excluded=None) -> NameConstraintsPolicy:
+    return NameConstraintsPolicy(
+        x509.NameConstraints(permitted_subtrees=permitted, excluded_subtrees=excluded),
+        "CN=Test CA",
+    )
+
+
+def dn(*rdns: tuple) -> x509.Name:
+    return x509.Name([x509.NameAttribute(oid, value) for oid, value in rdns])
+
+
+@pytest.mark.parametrize(
+    "names,error",
+    [
+        ([("dns", "www.example.com")], None),
+        ([("dns", "*.example.com")], "*.example.com is excluded by CN=Test CA"),
+        ([("dns", "*.www.example.com")], None),
+        ([("dns", "bad.example.com")], "bad.example.com is excluded by CN=Test CA"),
+        ([("dns", "*.example.org")], "*.example.org is not permitted by CN=Test CA"),
+        ([("ip", ipaddress.ip_address("10.0.0.1"))], None),
+        (
+            [("ip", ipaddress.ip_address("10.0.0.1")), ("dns", "www.example.org")],
+            "www.example.org is not permitted by CN=Test CA",
+        ),
+        (
+            [
+                (
+                    "dn",
+                    dn(
+                        (NameOID.ORGANIZATION_NAME, "Example"),
+                        (NameOID.COMMON_NAME, "www"),
+                    ),
+                )
+            ],
+            None,
+        ),
+        (
+            [("dn", dn((NameOID.ORGANIZATION_NAME, "Other")))],
+            "O=Other is not permitted by CN=Test CA",
+        ),
+    ],
+)
+def test_name_constraints(names, error):
+    policy = constraints(
+        permitted=[
+            x509.DNSName("example.com"),
+            x509.DirectoryName(dn((NameOID.ORGANIZATION_NAME, "Example"))),
+        ],
+        excluded=[x509.DNSName("bad.example.com")],
+    )
+    if error is None:
+        policy.check(names)
+    else:
+        with pytest.raises(PolicyError, match=re.escape(error)):
+            policy.check(names)
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import pytest
+
+from pki.softkey import SoftDevice, SoftKey
+from pki.watcher import SoftWatcher
+from pki.yubikey import enumeration, wait_reboot
+
+
+@pytest.fixture
+def soft_key(tmp_path, monkeypatch) -> SoftKey:
+    monkeypatch.setenv("OFFLINE_PKI_SOFT_KEYS", str(tmp_path))
+    return SoftKey.create(tmp_path, 42)
+
+
+def reboot(key: SoftKey, duration: float) -> None:
+    key.rebooting_until = time.time() + duration
+    key.save()
+
+
+def test_reboot(soft_key):
+    device = SoftDevice(soft_key.path)
+    with SoftWatcher(soft_key.path.parent) as watcher:
+        reboot(soft_key, 0.2)
+        found = wait_reboot(watcher, device, 42, timeout=5)
+    assert found.fingerprint == device.fingerprint
+
+
+def test_reboot_unseen(soft_key):
+    """The YubiKey is back before it was seen unplugged."""
+    device = SoftDevice(soft_key.path)
+    with SoftWatcher(soft_key.path.parent) as watcher:
+        reboot(soft_key, 0)
+        start = time.monotonic()
+        found = wait_reboot(watcher, device, 42, timeout=5)
+    assert found.fingerprint == device.fingerprint
+    assert time.monotonic() - start < 1
+
+
+def test_reboot_during_enumeration(soft_key):
+    """The whole reboot happens while another thread lists the YubiKeys."""
+    device = SoftDevice(soft_key.path)
+    with SoftWatcher(soft_key.path.parent) as watcher:
+        enumeration.acquire()
+        threading.Timer(0.3, enumeration.release).start()
+        reboot(soft_key, 0.05)
+        found = wait_reboot(watcher, device, 42, timeout=5)
+    assert found.fingerprint == device.fingerprint
+
+
+def test_no_reboot(soft_key):
+    device = SoftDevice(soft_key.path)
+    with SoftWatcher(soft_key.path.parent) as watcher:
+        with pytest.raises(RuntimeError, match="no YubiKey found"):
+            wait_reboot(watcher, device, 42, timeout=0.3)
@@ -0,0 +1,37 @@
+from cryptography import x509
+
+from pki.ledger import Ledger
+
+
+def test_chain(ca):
+    ca.intermediate.verify_directly_issued_by(ca.root)
+    constraints = ca.intermediate.extensions.get_extension_for_class(
+        x509.BasicConstraints
+    ).value
+    assert constraints.ca
+
+
+def test_sign(ca, sign, make_csr, ledger_dir):
+    cert, other = sign(
+        make_csr("www", ["www.example.com"]), make_csr("mail", ["mail.example.com"])
+    )
+    cert.verify_directly_issued_by(ca.intermediate)
+    other.verify_directly_issued_by(ca.intermediate)
+    assert cert.subject.rfc4514_string() == "CN=www"
+    sans = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    assert sans.get_values_for_type(x509.DNSName) == ["www.example.com"]
+    assert cert.serial_number != other.serial_number
+
+    with Ledger(ledger_dir) as ledger:
+        (item,) = ledger.by_serial(cert.serial_number)
+        assert item["subject"] == "CN=www"
+        assert item["sans"] == ["DNS:www.example.com"]
+        assert ledger.certificate(item) == cert
+
+
+def test_sign_profile(ca, sign, make_csr):
+    (cert,) = sign(make_csr("client"), args=["--cert-profile=client", "--days=7"])
+    cert.verify_directly_issued_by(ca.intermediate)
+    usage = cert.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value
+    assert list(usage) == [x509.oid.ExtendedKeyUsageOID.CLIENT_AUTH]
+    assert (cert.not_valid_after_utc - cert.not_valid_before_utc).days == 7
@@ -0,0 +1,19 @@
+import os
+from pathlib import Path
+
+import pytest
+
+import pki
+from pki.bench import HEAVY_MODULES, STARTUP_COMMANDS, import_time
+
+
+@pytest.mark.parametrize("command", STARTUP_COMMANDS)
+def test_help_is_light(monkeypatch, command):
+    """Showing help does not import the heavy dependencies."""
+    src = str(Path(pki.__file__).parent.parent)
+    monkeypatch.setenv(
+        "PYTHONPATH", os.pathsep.join(filter(None, [src, os.environ.get("PYTHONPATH")]))
+    )
+    _, modules = import_time(command.split())
+    imported = {module.split(".")[0] for module in modules}
+    assert not imported & set(HEAVY_MODULES)